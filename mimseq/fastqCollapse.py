@@ -0,0 +1,87 @@
+#! /usr/bin/env python3
+
+######################################################################################
+# Collapse identical reads in FASTQ files before alignment                          #
+#    each unique sequence is written once with its count in the read name           #
+#    (<index>_x<count>, see readDecoder.readWeight for use of counts downstream)    #
+######################################################################################
+
+import os, gzip, shutil, tempfile, heapq, logging
+from itertools import groupby
+from operator import itemgetter
+
+log = logging.getLogger(__name__)
+
+def readFastq(fq):
+# stream (gzipped) FASTQ as (sequence, quality) tuples
+
+	opener = gzip.open if fq.endswith(".gz") else open
+	with opener(fq, "rt") as fastq:
+		while True:
+			header = fastq.readline()
+			if not header:
+				break
+			seq = fastq.readline().rstrip("\n")
+			fastq.readline()
+			qual = fastq.readline().rstrip("\n")
+			yield(seq, qual)
+
+def spillRun(seq_counts, run_dir, runs):
+# write counts as run sorted by sequence and clear seq_counts
+
+	run_file = os.path.join(run_dir, "run{}.txt".format(len(runs)))
+	with open(run_file, "w") as run:
+		for seq in sorted(seq_counts):
+			count, qual = seq_counts[seq]
+			run.write(seq + "\t" + str(count) + "\t" + qual + "\n")
+	runs.append(run_file)
+	seq_counts.clear()
+
+def readRun(run_file):
+
+	with open(run_file, "r") as run:
+		for line in run:
+			seq, count, qual = line.rstrip("\n").split("\t")
+			yield(seq, int(count), qual)
+
+def mergeRuns(runs):
+# merge sorted runs, summing counts of sequences found in more than one run
+
+	merged = heapq.merge(*[readRun(run_file) for run_file in runs])
+	for seq, group in groupby(merged, key = itemgetter(0)):
+		group = list(group)
+		yield(seq, sum(count for _, count, _ in group), group[0][2])
+
+def collapseFastq(fq, collapsed_fq, max_sequences = 2000000):
+# count identical sequences in fq and write each unique sequence once to collapsed_fq, keeping the quality string of one occurence
+# at most max_sequences unique sequences are held in memory, beyond this counts are spilled to sorted runs which are merged at the end
+# returns number of reads and unique sequences
+
+	seq_counts = dict()
+	runs = list()
+	run_dir = tempfile.mkdtemp(dir = os.path.dirname(os.path.abspath(collapsed_fq)), prefix = ".collapse_")
+	total = 0
+	for seq, qual in readFastq(fq):
+		total += 1
+		try:
+			seq_counts[seq][0] += 1
+		except KeyError:
+			if len(seq_counts) >= max_sequences:
+				spillRun(seq_counts, run_dir, runs)
+			seq_counts[seq] = [1, qual]
+
+	unique = 0
+	with open(collapsed_fq, "w") as collapsed:
+		if runs:
+			spillRun(seq_counts, run_dir, runs)
+			counts = mergeRuns(runs)
+		else:
+			counts = ((seq, count, qual) for seq, (count, qual) in seq_counts.items())
+		for seq, count, qual in counts:
+			unique += 1
+			collapsed.write("@{}_x{}\n{}\n+\n{}\n".format(unique, count, seq, qual))
+	shutil.rmtree(run_dir, ignore_errors = True)
+
+	log.info("{} reads collapsed to {} unique sequences".format(total, unique))
+
+	return(total, unique)
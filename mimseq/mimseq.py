@@ -14,12 +14,15 @@
 
 from __future__ import absolute_import
 from . import version
-from .tRNAtools import modsToSNPIndex, generateGSNAPIndices, newModsParser, tidyFiles
-from .tRNAmap import mainAlign
+from .tRNAtools import modsToSNPIndex, generateGSNAPIndices, newModsParser, tidyFiles, getModomics, SequenceIndex
+from .tRNAmap import mainAlign, realignmentPlan
 from .getCoverage import getCoverage, plotCoverage
 from .mmQuant import generateModsTable, plotCCA
 from .ssAlign import structureParser, modContext 
 from .splitClusters import splitIsodecoder, unsplitClusters, getIsodecoderSizes, writeIsodecoderTranscripts
+from .refCache import modomicsSnapshot, referenceKey, restoreReference, storeReference, restoreGSNAPIndices, storeGSNAPIndices
+from . import ssAlign
+from .pipelineStages import PipelineStages, fileSignature, sampleSignature
 import sys, os, subprocess, logging, datetime, copy
 import argparse
 from pyfiglet import figlet_format
@@ -49,14 +52,15 @@ def restrictedFloat2(x):
 		raise argparse.ArgumentTypeError('{} not a real number'.format(x))
 
 def mimseq(trnas, trnaout, name, species, out, cluster, cluster_id, cov_diff, posttrans, control_cond, threads, max_multi, snp_tolerance, \
-	keep_temp, cca, double_cca, min_cov, mismatches, remap, remap_mismatches, misinc_thresh, mito_trnas, pretrnas, local_mod, p_adj, sample_data):
+	keep_temp, cca, double_cca, min_cov, mismatches, remap, remap_mismatches, misinc_thresh, mito_trnas, pretrnas, local_mod, modomics_blast, ref_cache, p_adj, sample_data, resume = False, collapse_reads = False, remap_all = False, cluster_engine = "usearch", deconv_max_positions = None):
 	
 # Main wrapper
 	# Integrity check for output folder argument...
 	try:
 		os.mkdir(out)
 	except FileExistsError:
-		raise FileExistsError("Output folder already exists!")
+		if not resume:
+			raise FileExistsError("Output folder already exists!")
 
 	if not out.endswith("/"):
 		out = out + "/"
@@ -80,117 +84,197 @@ def mimseq(trnas, trnaout, name, species, out, cluster, cluster_id, cov_diff, po
 	# main #
 	########
 
-	map_round = 1 #first round of mapping
-
-	# Parse tRNA and modifications, generate SNP index
-	modifications = os.path.dirname(os.path.realpath(__file__))
-	modifications += "/modifications"
-	coverage_bed, snp_tolerance, mismatch_dict, insert_dict, del_dict, mod_lists, Inosine_lists, Inosine_clusters, tRNA_dict, cluster_dict, cluster_perPos_mismatchMembers \
-	= modsToSNPIndex(trnas, trnaout, mito_trnas, modifications, name, out, double_cca, threads, snp_tolerance, cluster, cluster_id, posttrans, pretrnas, local_mod)
-	structureParser()
-	# Generate GSNAP indices
-	genome_index_path, genome_index_name, snp_index_path, snp_index_name = generateGSNAPIndices(species, name, out, map_round, snp_tolerance, cluster)
-
-	# Align
-	bams_list, coverageData = mainAlign(sample_data, name, genome_index_path, genome_index_name, \
-		snp_index_path, snp_index_name, out, threads, snp_tolerance, keep_temp, mismatches, map_round)
-
-	# define unique mismatches/insertions to assign reads to unique tRNA sequences
-	unique_isodecoderMMs = defaultdict(dict)
-	splitBool = list()
-	newSplitBool = list()
-	if cluster and cluster_id != 1:
-		cluster_dict2 = copy.deepcopy(cluster_dict) # copy so splitReadsIsodecoder does not edit main cluster_dict
-		unique_isodecoderMMs, splitBool, isodecoder_sizes = splitIsodecoder(cluster_perPos_mismatchMembers, insert_dict, del_dict, tRNA_dict, cluster_dict2, out, name)
-		unsplit = unsplitClusters(coverageData, coverage_bed, unique_isodecoderMMs, threads, cov_diff)
-		newSplitBool = list(set(splitBool).union(unsplit))
-	elif cluster and cluster_id == 1:
-		isodecoder_sizes = {iso:len(members) for iso, members in cluster_dict.items()}
-		writeIsodecoderTranscripts(out, name, cluster_dict, tRNA_dict)
-	elif not cluster:
-		isodecoder_sizes = getIsodecoderSizes(out, name, tRNA_dict)
-
-	# if remap and snp_tolerance are enabled, skip further analyses, find new mods, and redo alignment and coverage
-	if remap and (snp_tolerance or not mismatches == 0.0):
-		new_mods, new_Inosines, filtered_cov, filter_warning = generateModsTable(coverageData, out, name, threads, min_cov, mismatch_dict, insert_dict, del_dict, cluster_dict, cca, remap, misinc_thresh, mod_lists, Inosine_lists, tRNA_dict, Inosine_clusters, unique_isodecoderMMs, newSplitBool, isodecoder_sizes, cluster)
-		Inosine_clusters, snp_tolerance, newtRNA_dict, new_mod_lists, new_inosine_lists = newModsParser(out, name, new_mods, new_Inosines, mod_lists, Inosine_lists, tRNA_dict, cluster, remap, snp_tolerance)
-		map_round = 2
-		genome_index_path, genome_index_name, snp_index_path, snp_index_name = generateGSNAPIndices(species, name, out, map_round, snp_tolerance, cluster)
-		bams_list, coverageData = mainAlign(sample_data, name, genome_index_path, genome_index_name, \
-			snp_index_path, snp_index_name, out, threads, snp_tolerance, keep_temp, remap_mismatches, map_round)
-		remap = False
-	#else:
-	#	log.info("\n*** New modifications not discovered as remap is not enabled ***\n")
-
-	# redo checks for unsplit isodecoders based on coverage
-	if map_round == 2 and cluster_id != 1:
-		unsplit = unsplitClusters(coverageData, coverage_bed, unique_isodecoderMMs, threads, cov_diff)
-		newSplitBool = list(set(splitBool).union(unsplit))
-
-	# Misincorporation analysis
-	filter_warning = False
-	filtered_cov = list()
-	if snp_tolerance or not mismatches == 0.0:
-		if 'newtRNA_dict' in locals():
-			new_mods, new_Inosines, filtered_cov, filter_warning = generateModsTable(coverageData, out, name, threads, min_cov, mismatch_dict, insert_dict, del_dict, cluster_dict, cca, remap, misinc_thresh, new_mod_lists, Inosine_lists, newtRNA_dict, Inosine_clusters, unique_isodecoderMMs, newSplitBool, isodecoder_sizes, cluster)
-		else:
-			new_mods, new_Inosines, filtered_cov, filter_warning = generateModsTable(coverageData, out, name, threads, min_cov, mismatch_dict, insert_dict, del_dict, cluster_dict, cca, remap, misinc_thresh, mod_lists, Inosine_lists, tRNA_dict, Inosine_clusters, unique_isodecoderMMs, newSplitBool, isodecoder_sizes, cluster)
-
-	else:
-		log.info("*** Misincorporation analysis not possible; either --snp-tolerance must be enabled, or --max-mismatches must not be 0! ***\n")
+	# pipeline is run as named stages sharing one state dictionary (see pipelineStages)
+	# each completed stage is recorded in a manifest in the output folder, and with --resume valid stages are skipped
+	stages = PipelineStages(out, resume)
+	reference_params = {'trnas':fileSignature(trnas), 'trnaout':fileSignature(trnaout), 'mito_trnas':fileSignature(mito_trnas), 'cluster':cluster, 'cluster_id':cluster_id, 'cluster_engine':cluster_engine, \
+		'posttrans':posttrans, 'double_cca':double_cca, 'pretrnas':pretrnas, 'snp_tolerance':snp_tolerance, 'local_mod':local_mod, 'modomics_blast':modomics_blast, 'name':name}
+	# multi-mapping and unmapped reads are only kept from round 1 for realignment with remap (see tRNAmap.remapReads)
+	align_params = {'sample_data':sampleSignature(sample_data), 'mismatches':mismatches, 'keep_temp':keep_temp, 'collapse_reads':collapse_reads, 'remap':remap}
+	mods_params = {'min_cov':min_cov, 'misinc_thresh':misinc_thresh, 'cca':cca}
+	stage_params = {'reference':reference_params, 'index':{'species':species}, 'align':align_params, 'split':{'cov_diff':cov_diff, 'deconv_max_positions':deconv_max_positions}, \
+		'remap':dict(mods_params, remap = remap, remap_mismatches = remap_mismatches, remap_all = remap_all), 'mods':mods_params, \
+		'plots':{'control_cond':control_cond, 'mito_trnas':mito_trnas, 'double_cca':double_cca}, 'coverage':{'control_cond':control_cond}, \
+		'deseq':{'control_cond':control_cond, 'p_adj':p_adj}, 'tidy':{}}
+	if stages.complete():
+		# outputs of a completed run have been moved by tidyFiles so stages with changed parameters cannot be rerun in place
+		changed = stages.changed(stage_params)
+		if changed:
+			raise FileExistsError("Parameters of stages {} differ from the completed run in {}, rerun in a new output folder!".format(", ".join(changed), out))
+		log.info("All stages of this run are already complete with the same parameters. Nothing to resume.")
+		return
+
+	state = {'map_round':1, 'remap':remap, 'snp_tolerance':snp_tolerance} # first round of mapping
+	script_path = os.path.dirname(os.path.realpath(__file__))
 
-	# Output modification context file for plotting
-	mod_sites, cons_pos_list = modContext(out)
+	def referenceStage(state):
+		# Parse tRNA and modifications, generate SNP index
+		modifications = os.path.dirname(os.path.realpath(__file__))
+		modifications += "/modifications"
+		# if a reference cache is given, reference files and GSNAP indices are reused from previous runs with identical inputs (see refCache)
+		modomics = None
+		reference = None
+		state['ref_key'] = None
+		if ref_cache:
+			modomics_file, fetch = getModomics(local_mod)
+			modomics_file, modomics_snapshot = modomicsSnapshot(modomics_file, fetch)
+			modomics = (modomics_file, fetch)
+			additional_mods = os.path.dirname(os.path.realpath(__file__)) + "/data/additionalMods.txt"
+			state['ref_key'] = referenceKey([trnas, trnaout, mito_trnas, modifications, additional_mods], modomics_snapshot, \
+				{'cluster':cluster, 'cluster_id':cluster_id, 'cluster_engine':cluster_engine, 'posttrans':posttrans, 'double_cca':double_cca, 'pretrnas':pretrnas, 'snp_tolerance':snp_tolerance, 'modomics_blast':modomics_blast})
+			reference = restoreReference(ref_cache, state['ref_key'], out, name)
+		if not reference:
+			reference = modsToSNPIndex(trnas, trnaout, mito_trnas, modifications, name, out, double_cca, threads, snp_tolerance, cluster, cluster_id, posttrans, pretrnas, local_mod, modomics_blast, modomics, cluster_engine)
+			if ref_cache:
+				storeReference(ref_cache, state['ref_key'], out, name, reference[0], ssAlign.stkname, reference[1:])
+		state['coverage_bed'], state['snp_tolerance'], state['mismatch_dict'], state['insert_dict'], state['del_dict'], state['mod_lists'], state['Inosine_lists'], \
+			state['Inosine_clusters'], state['tRNA_dict'], state['cluster_dict'], state['cluster_perPos_mismatchMembers'] = reference
+		# tRNAs with identical sequences, used for isodecoder sizes and count splitting
+		state['seq_index'] = SequenceIndex(state['tRNA_dict'])
+		structureParser()
+
+	def indexStage(state):
+		# Generate GSNAP indices
+		gsnap_indices = restoreGSNAPIndices(ref_cache, state['ref_key'], species, name, out) if ref_cache else None
+		if not gsnap_indices:
+			gsnap_indices = generateGSNAPIndices(species, name, out, state['map_round'], state['snp_tolerance'], cluster)
+			if ref_cache:
+				storeGSNAPIndices(ref_cache, state['ref_key'], species, name, *gsnap_indices)
+		state['genome_index_path'], state['genome_index_name'], state['snp_index_path'], state['snp_index_name'] = gsnap_indices
+
+	def alignStage(state):
+		# Align
+		state['bams_list'], state['coverageData'] = mainAlign(sample_data, name, state['genome_index_path'], state['genome_index_name'], \
+			state['snp_index_path'], state['snp_index_name'], out, threads, state['snp_tolerance'], keep_temp, mismatches, state['map_round'], collapse_reads, \
+			state['remap'] and (state['snp_tolerance'] or not mismatches == 0.0))
+
+	def splitStage(state):
+		# define unique mismatches/insertions to assign reads to unique tRNA sequences
+		state['unique_isodecoderMMs'] = defaultdict(dict)
+		state['splitBool'] = list()
+		state['newSplitBool'] = list()
+		if cluster and cluster_id != 1:
+			cluster_dict2 = copy.deepcopy(state['cluster_dict']) # copy so splitReadsIsodecoder does not edit main cluster_dict
+			state['unique_isodecoderMMs'], state['splitBool'], state['isodecoder_sizes'] = splitIsodecoder(state['cluster_perPos_mismatchMembers'], state['insert_dict'], state['del_dict'], state['tRNA_dict'], cluster_dict2, out, name, state.get('seq_index'), deconv_max_positions)
+			unsplit = unsplitClusters(state['coverageData'], state['coverage_bed'], state['unique_isodecoderMMs'], threads, cov_diff, collapse_reads)
+			state['newSplitBool'] = list(set(state['splitBool']).union(unsplit))
+		elif cluster and cluster_id == 1:
+			state['isodecoder_sizes'] = {iso:len(members) for iso, members in state['cluster_dict'].items()}
+			writeIsodecoderTranscripts(out, name, state['cluster_dict'], state['tRNA_dict'])
+		elif not cluster:
+			state['isodecoder_sizes'] = getIsodecoderSizes(out, name, state['tRNA_dict'], state.get('seq_index'))
+
+	def remapStage(state):
+		# if remap and snp_tolerance are enabled, skip further analyses, find new mods, and redo alignment and coverage
+		if state['remap'] and (state['snp_tolerance'] or not mismatches == 0.0):
+			new_mods, new_Inosines, filtered_cov, filter_warning = generateModsTable(state['coverageData'], out, name, threads, min_cov, state['mismatch_dict'], state['insert_dict'], state['del_dict'], state['cluster_dict'], cca, state['remap'], misinc_thresh, state['mod_lists'], state['Inosine_lists'], state['tRNA_dict'], state['Inosine_clusters'], state['unique_isodecoderMMs'], state['newSplitBool'], state['isodecoder_sizes'], cluster, state.get('seq_index'), collapse_reads)
+			# clusters with new SNPs must be found before newModsParser adds new mods to mod_lists and Inosine_lists in place
+			changed_refs = realignmentPlan(new_mods, new_Inosines, state['mod_lists'], state['Inosine_lists'])
+			state['Inosine_clusters'], state['snp_tolerance'], state['newtRNA_dict'], state['new_mod_lists'], state['new_inosine_lists'] = newModsParser(out, name, new_mods, new_Inosines, state['mod_lists'], state['Inosine_lists'], state['tRNA_dict'], cluster, state['remap'], state['snp_tolerance'])
+			state['map_round'] = 2
+			state['genome_index_path'], state['genome_index_name'], state['snp_index_path'], state['snp_index_name'] = generateGSNAPIndices(species, name, out, state['map_round'], state['snp_tolerance'], cluster)
+			# only reads that were multi-mapped, unmapped or aligned to clusters with new SNPs are realigned unless remap_all (see tRNAmap.remapReads)
+			# kept round 1 alignments and realignment of unmapped reads to affected clusters only are valid if the mismatch limit is unchanged, otherwise all reads are realigned
+			remap_plan = None
+			if not remap_all and not remap_mismatches == mismatches:
+				log.info("--remap-mismatches differs from --max-mismatches: realigning all reads...")
+			elif not remap_all:
+				remap_plan = {'changed_refs':changed_refs, 'indices':None}
+				if changed_refs:
+					remap_plan['indices'] = generateGSNAPIndices(species, name, out, state['map_round'], state['snp_tolerance'], cluster, changed_refs)
+			state['bams_list'], state['coverageData'] = mainAlign(sample_data, name, state['genome_index_path'], state['genome_index_name'], \
+				state['snp_index_path'], state['snp_index_name'], out, threads, state['snp_tolerance'], keep_temp, remap_mismatches, state['map_round'], collapse_reads, False, remap_plan)
+			state['remap'] = False
+		#else:
+		#	log.info("\n*** New modifications not discovered as remap is not enabled ***\n")
+
+		# redo checks for unsplit isodecoders based on coverage
+		if state['map_round'] == 2 and cluster_id != 1:
+			unsplit = unsplitClusters(state['coverageData'], state['coverage_bed'], state['unique_isodecoderMMs'], threads, cov_diff, collapse_reads)
+			state['newSplitBool'] = list(set(state['splitBool']).union(unsplit))
+
+	def modsStage(state):
+		# Misincorporation analysis
+		state['filter_warning'] = False
+		state['filtered_cov'] = list()
+		if state['snp_tolerance'] or not mismatches == 0.0:
+			if 'newtRNA_dict' in state:
+				state['new_mods'], state['new_Inosines'], state['filtered_cov'], state['filter_warning'] = generateModsTable(state['coverageData'], out, name, threads, min_cov, state['mismatch_dict'], state['insert_dict'], state['del_dict'], state['cluster_dict'], cca, state['remap'], misinc_thresh, state['new_mod_lists'], state['Inosine_lists'], state['newtRNA_dict'], state['Inosine_clusters'], state['unique_isodecoderMMs'], state['newSplitBool'], state['isodecoder_sizes'], cluster, state.get('seq_index'), collapse_reads)
+			else:
+				state['new_mods'], state['new_Inosines'], state['filtered_cov'], state['filter_warning'] = generateModsTable(state['coverageData'], out, name, threads, min_cov, state['mismatch_dict'], state['insert_dict'], state['del_dict'], state['cluster_dict'], cca, state['remap'], misinc_thresh, state['mod_lists'], state['Inosine_lists'], state['tRNA_dict'], state['Inosine_clusters'], state['unique_isodecoderMMs'], state['newSplitBool'], state['isodecoder_sizes'], cluster, state.get('seq_index'), collapse_reads)
 
-	script_path = os.path.dirname(os.path.realpath(__file__))
-	
-	if snp_tolerance or not mismatches == 0.0:
-					# plot mods and stops, catch exception with command call and print log error if many clusters are filtered (known to cause issues with R code handling mods table)
-		log.info("Plotting modification and RT stop data...")
-		try:
-			modplot_cmd = ["Rscript", script_path + "/modPlot.R", out, str(mod_sites), str(cons_pos_list), str(misinc_thresh), str(mito_trnas), control_cond]
-			process = subprocess.Popen(modplot_cmd, stdout = subprocess.PIPE)
-			while True:
-				line = process.stdout.readline()
-				if not line:
-					break
-				line = line.decode("utf-8")
-				log.info(line.rstrip())
-			exitcode = process.wait()
-		except subprocess.CalledProcessError:
-			if filter_warning:
-				log.error("Error plotting modifications. Potentially caused by any clusters filtered by --min-cov: lower --min-cov or assess data quality and sequencing depth!")
-				raise
-		# CCA analysis (see mmQuant.generateModsTable and mmQuant.countMods_mp for initial counting of CCA vs CC ends)
-		if cca:
-			plotCCA(out, double_cca)
-
-	# Coverage and plots
-	sorted_aa = getCoverage(coverageData, out, control_cond, filtered_cov)
-	plotCoverage(out, mito_trnas, sorted_aa)
-
-	# DESeq2
-	sample_data = os.path.abspath(coverageData)
-
-	log.info("\n+----------------------------------------------+\
-	\n| Differential expression analysis with DESeq2 |\
-	\n+----------------------------------------------+")
-
-	deseq_cmd = ["Rscript", script_path + "/deseq.R", out, sample_data, control_cond, str(cluster_id), str(p_adj)]
-	#subprocess.check_call(deseq_cmd)
-	process = subprocess.Popen(deseq_cmd, stdout = subprocess.PIPE)
-	while True:
-		line = process.stdout.readline()
-		if not line:
-			break
-		line = line.decode("utf-8")
-		log.info(line.rstrip())
-	exitcode = process.wait()
-	deseq_out = out + "DESeq2"
-	log.info("DESeq2 outputs located in: {}".format(deseq_out))
-
-	# tidy files
-	tidyFiles(out, cca)
+		else:
+			log.info("*** Misincorporation analysis not possible; either --snp-tolerance must be enabled, or --max-mismatches must not be 0! ***\n")
+
+	def plotsStage(state):
+		# Output modification context file for plotting
+		mod_sites, cons_pos_list = modContext(out)
+
+		state['modplot_exitcode'] = 0
+		if state['snp_tolerance'] or not mismatches == 0.0:
+						# plot mods and stops, catch exception with command call and print log error if many clusters are filtered (known to cause issues with R code handling mods table)
+			log.info("Plotting modification and RT stop data...")
+			try:
+				modplot_cmd = ["Rscript", script_path + "/modPlot.R", out, str(mod_sites), str(cons_pos_list), str(misinc_thresh), str(mito_trnas), control_cond]
+				process = subprocess.Popen(modplot_cmd, stdout = subprocess.PIPE)
+				while True:
+					line = process.stdout.readline()
+					if not line:
+						break
+					line = line.decode("utf-8")
+					log.info(line.rstrip())
+				state['modplot_exitcode'] = process.wait()
+			except subprocess.CalledProcessError:
+				if state['filter_warning']:
+					log.error("Error plotting modifications. Potentially caused by any clusters filtered by --min-cov: lower --min-cov or assess data quality and sequencing depth!")
+					raise
+			# CCA analysis (see mmQuant.generateModsTable and mmQuant.countMods_mp for initial counting of CCA vs CC ends)
+			if cca:
+				plotCCA(out, double_cca)
+
+	def coverageStage(state):
+		# Coverage and plots
+		sorted_aa = getCoverage(state['coverageData'], out, control_cond, state['filtered_cov'])
+		plotCoverage(out, mito_trnas, sorted_aa)
+
+	def deseqStage(state):
+		# DESeq2
+		sample_data = os.path.abspath(state['coverageData'])
+
+		log.info("\n+----------------------------------------------+\
+		\n| Differential expression analysis with DESeq2 |\
+		\n+----------------------------------------------+")
+
+		deseq_cmd = ["Rscript", script_path + "/deseq.R", out, sample_data, control_cond, str(cluster_id), str(p_adj)]
+		#subprocess.check_call(deseq_cmd)
+		process = subprocess.Popen(deseq_cmd, stdout = subprocess.PIPE)
+		while True:
+			line = process.stdout.readline()
+			if not line:
+				break
+			line = line.decode("utf-8")
+			log.info(line.rstrip())
+		state['deseq_exitcode'] = process.wait()
+		deseq_out = out + "DESeq2"
+		log.info("DESeq2 outputs located in: {}".format(deseq_out))
+
+	stages.run("reference", stage_params['reference'], referenceStage, state, \
+		outputs = lambda state: [state['coverage_bed'], ssAlign.stkname])
+	stages.run("index", stage_params['index'], indexStage, state, \
+		outputs = lambda state: [state['genome_index_path']])
+	stages.run("align", stage_params['align'], alignStage, state, \
+		outputs = lambda state: state['bams_list'] + [state['coverageData']])
+	stages.run("split", stage_params['split'], splitStage, state)
+	stages.run("remap", stage_params['remap'], remapStage, state, \
+		outputs = lambda state: state['bams_list'] + [state['coverageData']])
+	stages.run("mods", stage_params['mods'], modsStage, state)
+	stages.run("plots", stage_params['plots'], plotsStage, state, \
+		succeeded = lambda state: state['modplot_exitcode'] == 0)
+	stages.run("coverage", stage_params['coverage'], coverageStage, state)
+	stages.run("deseq", stage_params['deseq'], deseqStage, state, \
+		succeeded = lambda state: state['deseq_exitcode'] == 0)
+
+	stages.run("tidy", stage_params['tidy'], lambda state: tidyFiles(out, cca), state)
 
 def main():
 
@@ -220,9 +304,16 @@ def main():
 		help = 'Disable usearch sequence clustering of tRNAs by isodecoder which drastically reduces the rate of multi-mapping reads. Default is enabled.')
 	options.add_argument('--cluster-id', metavar = 'clustering identity threshold', dest = 'cluster_id', type = restrictedFloat, nargs = '?', default = 0.97,\
 		required = False, help = 'Identity cutoff for usearch clustering between 0 and 1. Default is 0.97.')
+	options.add_argument('--cluster-engine', metavar = 'clustering engine', dest = 'cluster_engine', choices = ['usearch', 'builtin'], default = 'usearch', \
+		required = False, help = 'Engine used to cluster tRNA sequences: usearch, or builtin for greedy clustering by banded global alignment without usearch \
+		(identity includes terminal gaps, so clusters may differ slightly from usearch). Default is usearch.')
 	options.add_argument('--deconv-cov-ratio', metavar='deconvolution coverage threshold', dest='cov_diff', type = restrictedFloat, nargs = '?', default=0.5,\
 		required=False, help="Threshold for ratio between coverage at 3' end and mismatch used for deconvolution. Coverage reductions greater than the threshold will result in non-deconvoluted sequences. \
 			Default is 0.5 (i.e. less than 50%% reduction required for deconvolution).")
+	options.add_argument('--deconv-max-positions', metavar = 'maximum distinguishing positions', dest = 'deconv_max_positions', type = int, default = None, \
+		required = False, help = "Maximum number of positions searched for the smallest set of mismatches/indels distinguishing a unique sequence from others in its cluster for deconvolution. \
+			Limiting this reduces run time for large clusters, but sequences without a distinguishing set of at most this size are then deconvoluted with all their differences, \
+			i.e. reads must match all of them. Default is no limit.")
 	options.add_argument('--threads', metavar = 'thread number', required = False, dest = 'threads', type = int, \
 		help = 'Set processor threads to use during read alignment and read counting.')
 	options.add_argument('--posttrans-mod-off', required = False, dest = 'posttrans', action = 'store_true', \
@@ -239,6 +330,18 @@ def main():
 	options.add_argument('--local-modomics', required=False, dest = 'local_mod', action='store_true',\
 		help = "Disable retrieval of Modomics data from online. Instead use older locally stored data. Warning - this leads\
 			to usage of older Modomics data!")
+	options.add_argument('--collapse-reads', required = False, dest = 'collapse_reads', action = 'store_true',\
+		help = "Collapse identical reads in each FASTQ file before alignment. Unique sequences are aligned once and counted with their multiplicity\
+			in all downstream analyses, reducing alignment time and BAM file sizes. Default is false.")
+	options.add_argument('--resume', required = False, dest = 'resume', action = 'store_true',\
+		help = "Resume an interrupted run in the existing output directory. Completed pipeline stages with unchanged inputs and parameters\
+			are skipped, all other stages are rerun. Runs that already completed can not be resumed with changed parameters. Default is false.")
+	options.add_argument('--ref-cache', metavar = 'reference cache directory', required = False, dest = 'ref_cache', default = None,\
+		help = "Directory for caching reference files, SNP indices and GSNAP indices between runs. Runs with identical tRNA, mitochondrial tRNA and Modomics inputs\
+			and reference options reuse cached files instead of rebuilding them. Default is no cache.")
+	options.add_argument('--modomics-blast', required=False, dest = 'modomics_blast', action='store_true',\
+		help = "Match tRNA sequences to Modomics entries with blastn instead of exact sequence matching. Both require 100%% identity over the full tRNA length,\
+			this is slower and only included for comparison with older versions. Requires blastn.")
 	options.add_argument('--p-adj', required = False, dest = 'p_adj', type = restrictedFloat, default=0.05,\
 		help = "Adjusted p-value threshold for DESeq2 pairwise condition differential epxression dot plots. \
 			tRNAs with DESeq2 adjusted p-values equal to or below this value will be displayed as green or orange triangles for up- or down-regulated tRNAs, respectively. \
@@ -249,8 +352,9 @@ def main():
 		help = 'Maximum mismatches allowed. If specified between 0.0 and 1.0, then treated as a fraction of read length. Otherwise, treated as \
 		integer number of mismatches. Default is an automatic ultrafast value calculated by GSNAP; see GSNAP help for more info.')
 	align.add_argument('--remap-mismatches', metavar = 'allowed mismatches for remap', required = False, dest = 'remap_mismatches', type = float,\
-		help = 'Maximum number of mismatches allowed during remapping of all reads. Treated similarly to --max-mismatches. This is important to control misalignment of reads to similar clusters/tRNAs \
-		Note that the SNP index will be updated with new SNPs from the first round of alignment and so this should be relatively small to prohibit misalignment.')
+		help = 'Maximum number of mismatches allowed during remapping. Treated similarly to --max-mismatches. This is important to control misalignment of reads to similar clusters/tRNAs \
+		Note that the SNP index will be updated with new SNPs from the first round of alignment and so this should be relatively small to prohibit misalignment. \
+		If this differs from --max-mismatches, all reads are realigned (as with --remap-all).')
 	align.add_argument('--no-snp-tolerance', required = False, dest = 'snp_tolerance', action = 'store_false',\
 		help = 'Disable GSNAP SNP-tolerant read alignment, where known modifications from Modomics are mapped as SNPs. Default is enabled.')
 
@@ -278,7 +382,12 @@ def main():
 	remapping.add_argument('--remap', required = False, dest = 'remap', action = 'store_true',\
 		help = 'Enable detection of unannotated (potential) modifications from misincorporation data. These are defined as having a total misincorporation rate\
 		higher than the threshold set with --misinc-thresh. These modifications are then appended to already known ones, and read alignment is reperformed.\
-		Very useful for poorly annotated species in Modomics. Due to realignment and misincorporation parsing, enabling this option slows the analysis down considerably.')
+		Very useful for poorly annotated species in Modomics. Only multi-mapping and unmapped reads, and reads aligned to clusters with new modifications are realigned\
+		(unless --remap-all is set or --remap-mismatches differs from --max-mismatches).\
+		Due to realignment and misincorporation parsing, enabling this option slows the analysis down.')
+	remapping.add_argument('--remap-all', required = False, dest = 'remap_all', action = 'store_true',\
+		help = 'Realign all reads with --remap, instead of only multi-mapping and unmapped reads and reads aligned to clusters with new modifications. \
+		Always the case if --remap-mismatches differs from --max-mismatches. Default is false.')
 	remapping.add_argument('--misinc-thresh', metavar = 'threshold for unannotated mods', dest = 'misinc_thresh', type = restrictedFloat, nargs = '?', default = 0.1,\
 		required = False, help = 'Threshold of total misincorporation rate at a position in a cluster used to call unannotated modifications. Value between 0 and 1, default is 0.1  (10%% misincorporation).')
 
@@ -374,7 +483,7 @@ def main():
 			mimseq(args.trnas, args.trnaout, args.name, args.species, args.out, args.cluster, args.cluster_id, args.cov_diff, \
 				args.posttrans, args.control_cond, args.threads, args.max_multi, args.snp_tolerance, \
 				args.keep_temp, args.cca, args.double_cca, args.min_cov, args.mismatches, args.remap, args.remap_mismatches, \
-				args.misinc_thresh, args.mito, args.pretrnas, args.local_mod, args.p_adj, args.sampledata)
+				args.misinc_thresh, args.mito, args.pretrnas, args.local_mod, args.modomics_blast, args.ref_cache, args.p_adj, args.sampledata, args.resume, args.collapse_reads, args.remap_all, args.cluster_engine, args.deconv_max_positions)
 
 if __name__ == '__main__':
 	main()
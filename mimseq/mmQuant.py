@@ -7,13 +7,11 @@
 
 from __future__ import absolute_import
 import os, logging, pickle
-import re
 import pysam
 from itertools import groupby, combinations as comb
 from operator import itemgetter, le
 from .tRNAtools import countReads, newModsParser
 from .getCoverage import getBamList, filterCoverage
-from multiprocessing import Pool
 import multiprocessing.pool
 from functools import partial
 import pandas as pd
@@ -21,9 +19,14 @@ import numpy as np
 from collections import defaultdict
 import subprocess
 from .ssAlign import getAnticodon, clusterAnticodon, tRNAclassifier, tRNAclassifier_nogaps
+from .readDecoder import decodeAlignment, collapseAlignments
+from .referenceContext import ReferenceContext, getContext, contextPool
 
 log = logging.getLogger(__name__)
 
+# per-sample tables with more rows than this are spilled to disk by bamMods_mp workers rather than returned through the pool (see packTable)
+SPILL_ROWS = 5000000
+
 # custom classes to allow non-demonic processes allowing children processes to spawn more children sub-processes (i.e. multiprocessing within multiprocessing)
 class NoDaemonProcess(multiprocessing.Process):
     # make 'daemon' attribute always return False
@@ -40,6 +43,7 @@ class MyPool(multiprocessing.pool.Pool):
 
 def unknownMods(inputs, knownTable, cluster_dict, modTable, misinc_thresh, cov_table, min_cov, tRNA_dict, remap):
 # find unknown modifications with a total misincorporation threshold >= misinc_thresh
+# predicted mods are returned as a table, and also written to _predictedModstemp.csv before remapping so that round 2 can re-predict them
 
 	log.info('Finding potential unannotated mods for {}'.format(inputs))
 	new_mods_isodecoder = defaultdict(list)
@@ -61,179 +65,279 @@ def unknownMods(inputs, knownTable, cluster_dict, modTable, misinc_thresh, cov_t
 	except:
 		next
 
-	for isodecoder, data in modTable.items():
-		if cluster_dict:
-			cluster = [parent for parent, child in cluster_dict.items() if isodecoder in child][0]
-		# if cluster_dict is empty, then clustering is disabled and in this case isodecoder in modTable is the "cluster"
-		else:
-			cluster = isodecoder
-		short_isodecoder = "-".join(isodecoder.split("-")[:-1]) if not "chr" in isodecoder else isodecoder
-		anticodon = clusterAnticodon(cons_anticodon, short_isodecoder)
-		for pos in data.keys():
-			cov = cov_table.loc[(cov_table.isodecoder == isodecoder) & (cov_table.pos == pos), 'cov']
-			if (sum(modTable[isodecoder][pos].values()) >= misinc_thresh and any(cov >= min_cov) and pos-1 not in knownTable[isodecoder]): # misinc above threshold, cov above threshold and not previously known
-				# if one nucleotide dominates misinc. pattern (i.e. >= 0.9 of all misinc, likely a true SNP or misalignment)
-				if (max(modTable[isodecoder][pos].values()) / sum(modTable[isodecoder][pos].values()) > 0.95):
-					# if mod seems to be an inosine (i.e. A with G misinc at 34) add to list and modification SNPs file (see tRNAtools.ModsParser())
-					if (tRNA_dict[isodecoder]['sequence'][pos-1] == 'A' and list(modTable[isodecoder][pos].keys())[list(modTable[isodecoder][pos].values()).index(max(modTable[isodecoder][pos].values()))] == 'G' and pos-1 == min(anticodon)):
-						new_inosines_cluster[cluster].append(pos-1)
-						new_inosines_isodecoder[isodecoder].append(pos-1)
-				elif (max(modTable[isodecoder][pos].values()) / sum(modTable[isodecoder][pos].values()) <= 0.95 and not (pos-1 == min(anticodon) and tRNA_dict[isodecoder]['sequence'][pos-1] == 'A')):
-					new_mods_cluster[cluster].append(pos-1) #modTable had 1 based values - convert back to 0 based for mod_lists
-					new_mods_isodecoder[isodecoder].append(pos-1)
-
-	with open(inputs + "_predictedModstemp.csv", "w") as predMods:
-		#predMods.write("isodecoder\tpos\tidentity\tbam\n")
-		for isodecoder, data in new_mods_isodecoder.items():
-			for pos in data:
-				predMods.write(isodecoder + "\t" + \
-					str(pos) + "\t" + \
-					str(tRNA_dict[isodecoder]['sequence'][int(pos)]) + "\t" + \
-					inputs.split("/")[-1] + "\n")
-		
-		if not remap:	
-			for isodecoder, data in new_inosines_isodecoder.items():
-				for pos in data:
-					predMods.write(isodecoder + "\t" + \
-						str(pos) + "\t" + \
-						"A" + "\t" + \
-						inputs.split("/")[-1] + "\n")
+	# member to parent index for clusters (first parent listing a member is its cluster)
+	# if cluster_dict is empty, then clustering is disabled and in this case isodecoder in modTable is the "cluster"
+	cluster_parent = dict()
+	for parent, members in cluster_dict.items():
+		for member in members:
+			cluster_parent.setdefault(member, parent)
+
+	# misinc. proportions per type with one row per (isodecoder, pos), and coverage for the same positions
+	misinc = pd.DataFrame.from_dict({(isodecoder, pos): values for isodecoder, data in modTable.items() for pos, values in data.items()}, orient = 'index')
+	if misinc.empty:
+		candidates = list()
+	else:
+		misinc.index = pd.MultiIndex.from_tuples(misinc.index, names = ['isodecoder', 'pos'])
+		misinc_total = misinc.sum(axis = 1)
+		misinc_dominant = misinc.max(axis = 1) / misinc_total
+		misinc_top = misinc.idxmax(axis = 1)
+		pos_cov = cov_table.groupby(['isodecoder', 'pos'])['cov'].max().reindex(misinc.index)
+
+		# misinc above threshold, cov above threshold and not previously known
+		above = (misinc_total >= misinc_thresh) & (misinc_total > 0) & (pos_cov >= min_cov)
+		candidates = [(isodecoder, pos, misinc_dominant[(isodecoder, pos)], misinc_top[(isodecoder, pos)]) for isodecoder, pos in misinc.index[above.values] if pos-1 not in knownTable[isodecoder]]
+
+	anticodons = dict()
+	for isodecoder, pos, dominant, top in candidates:
+		cluster = cluster_parent[isodecoder] if cluster_dict else isodecoder
+		if not isodecoder in anticodons:
+			short_isodecoder = "-".join(isodecoder.split("-")[:-1]) if not "chr" in isodecoder else isodecoder
+			anticodons[isodecoder] = clusterAnticodon(cons_anticodon, short_isodecoder)
+		anticodon = anticodons[isodecoder]
+		# if one nucleotide dominates misinc. pattern (i.e. >= 0.9 of all misinc, likely a true SNP or misalignment)
+		if dominant > 0.95:
+			# if mod seems to be an inosine (i.e. A with G misinc at 34) add to list and modification SNPs file (see tRNAtools.ModsParser())
+			if (tRNA_dict[isodecoder]['sequence'][pos-1] == 'A' and top == 'G' and pos-1 == min(anticodon)):
+				new_inosines_cluster[cluster].append(pos-1)
+				new_inosines_isodecoder[isodecoder].append(pos-1)
+		elif not (pos-1 == min(anticodon) and tRNA_dict[isodecoder]['sequence'][pos-1] == 'A'):
+			new_mods_cluster[cluster].append(pos-1) #modTable had 1 based values - convert back to 0 based for mod_lists
+			new_mods_isodecoder[isodecoder].append(pos-1)
+
+	predicted = [(isodecoder, pos, tRNA_dict[isodecoder]['sequence'][int(pos)], inputs.split("/")[-1]) for isodecoder, data in new_mods_isodecoder.items() for pos in data]
+	if remap:
+		with open(inputs + "_predictedModstemp.csv", "w") as predMods:
+			for row in predicted:
+				predMods.write("\t".join(str(field) for field in row) + "\n")
+	else:
+		predicted.extend([(isodecoder, pos, "A", inputs.split("/")[-1]) for isodecoder, data in new_inosines_isodecoder.items() for pos in data])
+	predicted = pd.DataFrame(predicted, columns = ['isodecoder', 'pos', 'identity', 'bam']).astype({'pos':int})
 
-	return(new_mods_cluster, new_inosines_cluster)
+	return(new_mods_cluster, new_inosines_cluster, predicted)
 
-def bamMods_mp(out_dir, min_cov, info, mismatch_dict, insert_dict, del_dict, cluster_dict, cca, tRNA_struct, remap, misinc_thresh, knownTable, tRNA_dict, unique_isodecoderMMs, splitBool, isodecoder_sizes, threads, inputs):
-# modification counting and table generation, and CCA analysis
-	
+def refIndex(bam_file, tRNA_dict, unique_isodecoderMMs):
+# integer ids for every reference a read can be counted against (BAM references plus deconvoluted isodecoders) and width of per-reference position arrays
+
+	ref_ids = dict()
+	candidates = list(bam_file.references) + list(tRNA_dict.keys()) + [isodecoder[0] for data in unique_isodecoderMMs.values() for isodecoder in data.values()]
+	for reference in candidates:
+		if not reference in ref_ids:
+			ref_ids[reference] = len(ref_ids)
+	ref_names = np.array(list(ref_ids.keys()), dtype = object)
+
+	# positions are 1-based and coverage differences are recorded one past the alignment end, and reassigned reads keep parent coordinates
+	width = max(bam_file.lengths) + 2
+
+	return(ref_ids, ref_names, width)
+
+def shardReferences(bam_file, threads):
+# split references in an indexed bam into at most threads shards with similar numbers of mapped reads
+# returns a list of reference lists, or [None] (i.e. process whole file in one pass) if the bam is not indexed or only one thread is available
+
+	if threads <= 1 or not bam_file.has_index():
+		return([None])
+
+	ref_stats = sorted([(stat.mapped, stat.contig) for stat in bam_file.get_index_statistics() if stat.mapped > 0], key = lambda x: (-x[0], x[1]))
+	if len(ref_stats) <= 1:
+		return([None])
+
+	# greedily assign references with most reads first to the least loaded shard
+	shards = [list() for i in range(min(threads, len(ref_stats)))]
+	shard_sizes = [0] * len(shards)
+	for mapped, reference in ref_stats:
+		smallest = shard_sizes.index(min(shard_sizes))
+		shards[smallest].append(reference)
+		shard_sizes[smallest] += mapped
+
+	return(shards)
+
+def countAlignments_mp(cca, remap, collapsed, ref_ids, width, inputs, references):
+# count mods, stops, coverage and CCA ends for alignments to a shard of references in a bam file (all alignments if references is None)
+# reference structures are read from the shared reference context (see generateModsTable)
+# returns plain dictionaries and arrays (indexed by ref_ids) so that shards can be summed in bamMods_mp
+
+	context = getContext()
 	modTable = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-	stopTable = defaultdict(lambda: defaultdict(int))
-	counts = defaultdict(lambda: defaultdict(int))
-	cov = defaultdict(lambda: defaultdict(int))
-	geneCov = defaultdict(int)
-	condition = info[inputs][0]
-	# initialise structures and outputs if CCA analysis in on
-	if cca:
-		aln_count = 0
-		cca_dict = defaultdict(lambda: defaultdict(int))
-		dinuc_dict = defaultdict(int)
-		dinuc_prop = open(inputs + "_dinuc.csv", "w")
-		CCAvsCC_counts = open(inputs + "_CCAcounts.csv", "w")
+	cov_diff = np.zeros((len(ref_ids), width), dtype = np.int64)
+	stop_counts = np.zeros((len(ref_ids), width), dtype = np.int64)
+	gene_cov = np.zeros(len(ref_ids), dtype = np.int64)
+	aln_count = 0
+	cca_dict = defaultdict(lambda: defaultdict(int))
+	dinuc_dict = defaultdict(int)
+	# new references of reads per cluster and read bitmask (see findNewReference)
+	matched = defaultdict(dict)
 
-	# process mods by looping through alignments in bam file
 	bam_file = pysam.AlignmentFile(inputs, "rb")
-	log.info('Analysing {}...'.format(inputs))
-	for read in bam_file.fetch(until_eof=True):
-		reference = read.reference_name
+	if references is None:
+		reads = bam_file.fetch(until_eof=True)
+	else:
+		reads = (read for reference in references for read in bam_file.fetch(reference))
+
+	# identical alignments are collapsed and each unique alignment is decoded once and counted with its multiplicity (see readDecoder.collapseAlignments)
+	# collapsed is True if reads were collapsed before alignment and are counted with the number of reads in their names
+	alignments = collapseAlignments(reads, collapsed)
+	for (ref_tid, offset, cigar, md_tag, read_seq, dinuc), (count, cigartuples, aln_end) in alignments.items():
+		mapped_ref = bam_file.get_reference_name(ref_tid)
+		reference = mapped_ref
 
 		#########################
 		# Modification analysis #
 		#########################
 
-		# get MD tags for mismatches, split into list of integers and characters
-		md_tag = read.get_tag('MD')
-		md_list = re.split('(.*?)([A-Za-z]|[\^][A-Za-z]+)', md_tag)
-		md_list = list(filter(None, md_list))
-
-		# get cigar string, split as above
-		cigar = read.cigarstring
-		cigar_list = re.split('(.*?)([A-Za-z]|[\^][A-Za-z]+)', cigar)
-		cigar_list = list(filter(None, cigar_list))
-
-		# check cigar for softclipping at 5' and 3' of read (usually because of terminal transferase of RT) - if so remove soft-clipped bases from sequence
-		if cigar_list[1].upper() == "S".upper():
-			soft_clip = int(cigar_list[0])
-			read_seq = read.query_sequence[soft_clip:]
-			del cigar_list[0:2]
-		else:
-			read_seq = read.query_sequence 
-
-		if cigar_list[-1].upper() == "S".upper():
-			soft_clip = int(cigar_list[-2])
-			read_seq = read_seq[:-soft_clip]
-			del cigar_list[-3:-1]
-
-		# remove insertions in read from the sequence (MD tags do not account for deletions and effect misinc. identity matching)
-		# record ref_deletions (insertions in read) for matching later to unique differences between ref and read for isodecoder splitting - note use read_pos here so that deletions in read_seq are not subtracted from insert positions
-		read_ins_pos = 0
-		read_pos = 0
-		ref_deletions = list()
-		for index, i in enumerate(cigar_list):
-			if i.isdigit():
-				read_ins_pos += int(i)
-				read_pos += int(i)
-			elif i.isalpha() and i.upper() == 'D':
-				del_size = int(cigar_list[index-1])
-				read_ins_pos -= del_size
-				read_pos -= del_size
-			elif i.isalpha() and i.upper() == 'I':
-				ins_size = int(cigar_list[index-1])
-				ref_deletions.append(read_pos-ins_size)
-				read_seq = read_seq[0:read_ins_pos-ins_size] + read_seq[read_ins_pos:]
-				read_ins_pos -= ins_size
-
-		# get offset of read mapping position to reference start in order to adjust mismatch position, and end of alignment for coverage calculation
-		# (offset is simply start position of read alignment realtive to reference)
-		offset = read.reference_start
-		aln_end = read.reference_end
-		
+		# decode soft-clip trimmed read into mismatches, deletions in read (insertions) and insertions in read (ref_deletions) relative to the reference (see readDecoder)
+		# (offset is simply start position of read alignment realtive to reference, and aln_end the end of alignment for coverage calculation)
+		mismatches, insertions, ref_deletions, ref_pos = decodeAlignment(offset, cigartuples, md_tag, read_seq)
+
 		# count mods and find new reference
-		ref_pos = 0
-		read_pos = 0
 		adjust = 0
 		temp = defaultdict()
-		temp, ref_pos, read_pos, readRef_dif, insertions = countMods(temp, reference, ref_pos, read_pos, read_seq, offset, md_list, ref_deletions, tRNA_dict, mismatch_dict, insert_dict, del_dict, remap)
+		temp, readRef_dif, insertions = countMods(temp, reference, mismatches, insertions, ref_deletions, context.tRNA_dict, context.mismatch_dict, context.insert_dict, context.del_dict, remap)
 		if readRef_dif: # only assign new reference if readRef_dif is recorded which only happens when remap = False (i.e. after 2nd alignment or if remap is never activated)
-			reference, temp, adjust = findNewReference(unique_isodecoderMMs, splitBool, readRef_dif, reference, temp, insertions, insert_dict, del_dict, ref_deletions, adjust)
+			reference, temp, adjust = findNewReference(context.deconv_index, context.splitBool, readRef_dif, reference, temp, insertions, ref_deletions, adjust, matched)
 		# read counts, stops and coverage
-		counts[inputs][reference] += 1
-		geneCov[reference] += 1
-		
+		ref_id = ref_ids[reference]
+		gene_cov[ref_id] += count
+
 		# offset + 1 (0 to 1 based) is start of alignment - i.e. any start > 1 indicates a stop to RT at this position
 		# correct for members that are shorter than parents at 5' end using adjust variable (see countMods)
-		
+
 		# only for reads that start at the 0 position of memebers they are assigned to
 		# there are weird cases where a read is longer at 5' end than its new assigned member (probably incorrect assignment) and this would generate negative values for stop
 		if offset - adjust >= 0:
-			stopTable[reference][offset+1] += 1
-			for i in range(offset+1, aln_end+1):
-				cov[reference][i] += 1
+			stop_counts[ref_id, offset+1] += count
+			cov_diff[ref_id, offset+1] += count
 		# if it is a weird case as described above, then just assume the read is full-length and add to stop at position 1
 		else:
-			stopTable[reference][1] += 1
-			for i in range(0, aln_end+1):
-				cov[reference][i] += 1
+			stop_counts[ref_id, 1] += count
+			cov_diff[ref_id, 0] += count
+		cov_diff[ref_id, aln_end+1] -= count
 
 		for pos, identity in temp.items():
-			modTable[reference][pos][identity] += 1
+			modTable[reference][pos][identity] += count
 
 		################
 		# CCA analysis #
 		################
 
 		if cca:
-			aln_count += 1
-			dinuc = read.query_sequence[-2:]
-			dinuc_dict[dinuc] += 1
-
-			mapped_ref = read.reference_name
+			aln_count += count
+			dinuc_dict[dinuc] += count
 
 			ref_length = bam_file.get_reference_length(mapped_ref)
 			if ref_pos in [ref_length, ref_length - 1]:
-				cca_dict[reference][dinuc] += 1
+				cca_dict[reference][dinuc] += count
 			elif ref_pos == ref_length - 2:
-				dinuc = read.query_sequence[-1:]
-				cca_dict[reference][dinuc] += 1
+				cca_dict[reference][dinuc[-1:]] += count
 			elif ref_pos <= ref_length - 3:
-				dinuc = "Absent"
-				cca_dict[reference][dinuc] += 1
+				cca_dict[reference]["Absent"] += count
+	bam_file.close()
+
+	modTable = {reference: {pos: dict(identities) for pos, identities in data.items()} for reference, data in modTable.items()}
+	cca_dict = {reference: dict(data) for reference, data in cca_dict.items()}
+
+	return(modTable, cov_diff, stop_counts, gene_cov, cca_dict, dict(dinuc_dict), aln_count)
+
+def packTable(table, spill_file):
+# compact columnar form of a per-sample table to return from a bamMods_mp worker without writing text files
+# string columns are converted to categoricals, tables with more than SPILL_ROWS rows are spilled to a binary .npz file and its path is returned instead
+
+	for column in table.columns:
+		if table[column].dtype == object:
+			table[column] = table[column].astype('category')
+	if len(table) <= SPILL_ROWS:
+		return(table)
+
+	arrays = {'columns':np.array(table.columns, dtype = str)}
+	for index, column in enumerate(table.columns):
+		if isinstance(table[column].dtype, pd.CategoricalDtype):
+			arrays['codes' + str(index)] = table[column].cat.codes.values
+			arrays['categories' + str(index)] = np.array(table[column].cat.categories, dtype = str)
+		else:
+			arrays['values' + str(index)] = table[column].values
+	np.savez(spill_file + ".npz", **arrays)
+
+	return(spill_file + ".npz")
+
+def unpackTable(packed):
+# restore table from packTable (deleting spill file), with string columns converted back from categoricals
+
+	if isinstance(packed, str):
+		with np.load(packed) as arrays:
+			table = pd.DataFrame({column: pd.Categorical.from_codes(arrays['codes' + str(index)], arrays['categories' + str(index)]) if 'codes' + str(index) in arrays else arrays['values' + str(index)] \
+				for index, column in enumerate(arrays['columns'])})
+		os.remove(packed)
+	else:
+		table = packed
+	for column in table.columns:
+		if isinstance(table[column].dtype, pd.CategoricalDtype):
+			table[column] = table[column].astype(object)
+
+	return(table)
+
+def bamMods_mp(out_dir, min_cov, info, cca, remap, misinc_thresh, threads, collapsed, inputs):
+# modification counting and table generation, and CCA analysis
+# reference structures are read from the shared reference context (see generateModsTable)
+	
+	context = getContext()
+	modTable = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+	condition = info[inputs][0]
+	# initialise structures if CCA analysis in on
+	if cca:
+		aln_count = 0
+		cca_dict = defaultdict(lambda: defaultdict(int))
+		dinuc_dict = defaultdict(int)
+
+	# coverage, stops and read counts are kept in arrays indexed by integer reference id (see refIndex)
+	# coverage is recorded as +1/-1 differences at the start and end of each alignment and prefix-summed once after all reads are counted
+	bam_file = pysam.AlignmentFile(inputs, "rb")
+	ref_ids, ref_names, width = refIndex(bam_file, context.tRNA_dict, context.unique_isodecoderMMs)
+	cov_diff = np.zeros((len(ref_names), width), dtype = np.int64)
+	stop_counts = np.zeros((len(ref_names), width), dtype = np.int64)
+	gene_cov = np.zeros(len(ref_names), dtype = np.int64)
+
+	# split bam into shards of references and count alignments in each shard in parallel (see shardReferences)
+	shards = shardReferences(bam_file, threads)
+	bam_file.close()
+
+	log.info('Analysing {}...'.format(inputs))
+	func = partial(countAlignments_mp, cca, remap, collapsed, ref_ids, width, inputs)
+	if len(shards) > 1:
+		pool = contextPool(context, len(shards))
+		shard_counts = pool.map(func, shards)
+		pool.close()
+		pool.join()
+	else:
+		shard_counts = [func(shards[0])]
+
+	# sum counts from all shards
+	for shard_modTable, shard_cov_diff, shard_stop_counts, shard_gene_cov, shard_cca, shard_dinuc, shard_aln_count in shard_counts:
+		cov_diff += shard_cov_diff
+		stop_counts += shard_stop_counts
+		gene_cov += shard_gene_cov
+		for reference, data in shard_modTable.items():
+			for pos, identities in data.items():
+				for identity, count in identities.items():
+					modTable[reference][pos][identity] += count
+		if cca:
+			aln_count += shard_aln_count
+			for dinuc, count in shard_dinuc.items():
+				dinuc_dict[dinuc] += count
+			for reference, data in shard_cca.items():
+				for dinuc, count in data.items():
+					cca_dict[reference][dinuc] += count
+	del shard_counts
 
 	## Edit misincorportation and stop data before writing
 
+	# per-position coverage from start/end differences
+	cov = np.cumsum(cov_diff, axis = 1)
+
 	# build dictionaries for mismatches and stops, normalizing to total coverage per nucleotide
 	# readthroughTable is similar to stops but normalised by coverage at each base
 	# This reflects the proportion of reads at a given site that stop at this site, as opposed to the proportion of all reads for the reference that stop here
 
 	modTable_prop = {isodecoder: {pos: {
-				group: count / (cov[isodecoder][pos]) if cov[isodecoder][pos] != 0 else 0
+				group: count / (cov[ref_ids[isodecoder], pos]) if cov[ref_ids[isodecoder], pos] != 0 else 0
 				  for group, count in data.items() if group in ['A','C','G','T']
 								}
 			for pos, data in values.items()
@@ -241,39 +345,32 @@ def bamMods_mp(out_dir, min_cov, info, mismatch_dict, insert_dict, del_dict, clu
 		for isodecoder, values in modTable.items()
 					}
 
-	stopTable_prop = {isodecoder: {
-			pos: (count / geneCov[isodecoder]) if geneCov[isodecoder] != 0 else 0
-			for pos, count in values.items()
-						}
-		for isodecoder, values in stopTable.items()
-				}
-
-	readthroughTable = {isodecoder: {
-			pos: (1 - (count / cov[isodecoder][pos])) if cov[isodecoder][pos] != 0 else 0 # 1 - stops gives readthrough
-			for pos, count in values.items()
-						}
-		for isodecoder, values in stopTable.items()
-				}
-
-	# reformat cov_table and save
-	cov_table = pd.DataFrame.from_dict(cov)
-	cov_table['pos'] = cov_table.index
-	cov_table['pos'] = cov_table['pos'].astype(int)
-	cov_table_melt = cov_table.melt(id_vars='pos', var_name='isodecoder', value_name='cov')
-	cov_table_melt.dropna(inplace = True)
-	cov_table_melt['bam'] = inputs
-	cov_table_melt = cov_table_melt[['isodecoder', 'pos', 'bam', 'cov']]
+	stop_ids, stop_pos = np.nonzero(stop_counts)
+	stop_num = stop_counts[stop_ids, stop_pos]
+	stop_cov = cov[stop_ids, stop_pos]
+
+	stopTable_prop_melt = pd.DataFrame({'pos':stop_pos, 'isodecoder':ref_names[stop_ids], 'proportion':stop_num / gene_cov[stop_ids]})
+
+	# 1 - stops gives readthrough
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		readthrough = np.where(stop_cov != 0, 1 - (stop_num / stop_cov), 0)
+	readthroughTable_melt = pd.DataFrame({'pos':stop_pos, 'isodecoder':ref_names[stop_ids], 'proportion':readthrough})
+
+	# reformat cov_table and save - only positions covered by at least one read are reported
+	cov_ids, cov_pos = np.nonzero(cov)
+	cov_table_melt = pd.DataFrame({'isodecoder':ref_names[cov_ids], 'pos':cov_pos, 'bam':inputs, 'cov':cov[cov_ids, cov_pos]})
 	cov_table_melt.to_csv(out_dir + inputs.split("/")[-1] + "_coverage.txt", sep = "\t", index = False)
 
 	# convert coverages to proprtion mapped reads if it is a fraction
-	mapped_reads = sum(counts[inputs].values())
+	mapped_reads = int(gene_cov.sum())
 	cov_table_newMods = cov_table_melt.copy()
 	if min_cov < 1:
 		cov_table_newMods['cov'] = cov_table_newMods['cov'].div(mapped_reads)
 				
 	# find unknown mod sites
-	new_mods, new_Inosines = unknownMods(inputs, knownTable, cluster_dict, modTable_prop, misinc_thresh, cov_table_newMods, min_cov, tRNA_dict, remap)
+	new_mods, new_Inosines, predicted = unknownMods(inputs, context.knownTable, context.cluster_dict, modTable_prop, misinc_thresh, cov_table_newMods, min_cov, context.tRNA_dict, remap)
 	# format and output mods and stops if remap is disabled (i.e. also occurs after round 2 of mapping)
+	tables = None
 	if not remap:
 	#	new_mods = {}
 	#	new_Inosines = {}
@@ -290,86 +387,45 @@ def bamMods_mp(out_dir, min_cov, info, mismatch_dict, insert_dict, del_dict, clu
 		modTable_prop_melt.pos = pd.to_numeric(modTable_prop_melt.pos)
 		#modTable_prop_melt.to_csv("premismatchTable.csv", sep = "\t", index = False, na_rep = 'NA')
 
-		# split and parallelize addNA
-		names, dfs = splitTable(modTable_prop_melt)
-		pool = Pool(threads)
-		func = partial(addNA, tRNA_struct, "mods")
-		modTable_prop_melt = pd.concat(pool.starmap(func, zip(names, dfs)))
-		pool.close()
-		pool.join()
+		# structural positions (excluding gaps) of every cluster used to fill missing positions with NA (see addNA)
+		struct_pos = context.tRNA_struct.index.to_frame(index = False)[['cluster', 'pos']]
+		struct_pos['pos'] = struct_pos['pos'].astype(int)
+
+		modTable_prop_melt = addNA(struct_pos, "mods", modTable_prop_melt)
 
 		# copy and add NAs for correct merging with modTable
-		cov_table_na = cov_table_melt.copy()
-		names, dfs = splitTable(cov_table_na)
-		pool = Pool(threads)
-		func = partial(addNA, tRNA_struct, "cov")
-		cov_table_na = pd.concat(pool.starmap(func, zip(names, dfs)))
-		pool.close()
-		pool.join()
+		cov_table_na = addNA(struct_pos, "cov", cov_table_melt.copy())
 
 		# add coverage per nucelotide from cov
 		modTable_prop_melt = pd.merge(modTable_prop_melt, cov_table_na, on = ['isodecoder', 'pos', 'bam'], how = 'left')
-		#modTable_prop_melt = addNA(modTable_prop_melt, tRNA_struct, cluster_dict, "mods")
 		modTable_prop_melt = modTable_prop_melt[['isodecoder','pos', 'type','proportion','condition', 'bam', 'cov']]
 
-		# reformat stopTable and add gaps 
-		stopTable_prop_df = pd.DataFrame.from_dict(stopTable_prop)
-		stopTable_prop_df['pos'] = stopTable_prop_df.index
-		stopTable_prop_melt = stopTable_prop_df.melt(id_vars='pos', var_name='isodecoder', value_name='proportion')
+		# add sample info to stopTable and add gaps
 		stopTable_prop_melt['condition'] = condition
 		stopTable_prop_melt['bam'] = inputs
-		stopTable_prop_melt.pos = pd.to_numeric(stopTable_prop_melt.pos)
-
-		# split and parallelize addNA
-		stopTable_prop_melt.dropna(inplace = True)
-		names, dfs = splitTable(stopTable_prop_melt)
-		pool = Pool(threads)
-		func = partial(addNA, tRNA_struct, "stops")
-		stopTable_prop_melt = pd.concat(pool.starmap(func, zip(names, dfs)))
-		pool.close()
-		pool.join()
-		#stopTable_prop_melt = addNA(stopTable_prop_melt, tRNA_struct, cluster_dict, "stops")
+		stopTable_prop_melt = addNA(struct_pos, "stops", stopTable_prop_melt)
 		stopTable_prop_melt = stopTable_prop_melt[['isodecoder', 'pos', 'proportion', 'condition', 'bam']]
 
-		# reformat readthroughTable
-		readthroughTable = pd.DataFrame.from_dict(readthroughTable)
-		readthroughTable['pos'] = readthroughTable.index
-		readthroughTable_melt = readthroughTable.melt(id_vars='pos', var_name='isodecoder', value_name='proportion')
+		# add sample info to readthroughTable and add gaps
 		readthroughTable_melt['condition'] = condition
 		readthroughTable_melt['bam'] = inputs
-		readthroughTable_melt.pos = pd.to_numeric(readthroughTable_melt.pos)
-
-		# split and parallelize addNA
-		readthroughTable_melt.dropna(inplace = True)
-		names, dfs = splitTable(readthroughTable_melt)
-		pool = Pool(threads)
-		func = partial(addNA, tRNA_struct, "stops")
-		readthroughTable_melt = pd.concat(pool.starmap(func, zip(names, dfs)))
-		pool.close()
-		pool.join()
+		readthroughTable_melt = addNA(struct_pos, "stops", readthroughTable_melt)
 		readthroughTable_melt = readthroughTable_melt[['isodecoder', 'pos', 'proportion', 'condition', 'bam']]
 
 		# build temp counts DataFrame
-		counts_table = pd.DataFrame.from_dict(counts)
-		counts_table['isodecoder'] = counts_table.index
-		counts_table = counts_table[['isodecoder', inputs]]
+		count_ids = np.nonzero(gene_cov)[0]
+		counts_table = pd.DataFrame({'isodecoder':ref_names[count_ids], inputs:gene_cov[count_ids]})
 		# add 0 count isodecoders to table
-		temp_add = pd.DataFrame(columns = ['isodecoder', inputs])
-		for isodecoder in isodecoder_sizes.keys():
-			if not isodecoder in counts_table['isodecoder']:
-				temp_add = temp_add.append({'isodecoder':isodecoder, inputs:0}, ignore_index = True)
-		counts_table = counts_table.append(temp_add)
-
-		# save tables to temp files per sample
-		counts_table.to_csv(inputs + "countTable.csv", sep = "\t", index = False, na_rep = "0")
-		modTable_prop_melt.to_csv(inputs + "mismatchTable.csv", sep = "\t", index = False, na_rep = 'NA')
-		stopTable_prop_melt.to_csv(inputs + "RTstopTable.csv", sep = "\t", index = False, na_rep = 'NA')
-		readthroughTable_melt.to_csv(inputs + "readthroughTable.csv", sep = "\t", index = False, na_rep = 'NA')
+		counted = set(counts_table['isodecoder'])
+		temp_add = pd.DataFrame({'isodecoder':[isodecoder for isodecoder in context.isodecoder_sizes.keys() if not isodecoder in counted], inputs:0})
+		counts_table = pd.concat([counts_table, temp_add], ignore_index = True)
+
+		# hand tables back to generateModsTable in compact columnar form (see packTable)
+		tables = {'counts':counts_table, 'mismatch':modTable_prop_melt, 'stops':stopTable_prop_melt, 'readthrough':readthroughTable_melt, 'predicted':predicted}
 
 		if cca:
-			# write dinuc proportions for current bam
-			for dinuc, count in dinuc_dict.items():
-				dinuc_prop.write(dinuc + "\t" + str(count/aln_count) + "\t" + inputs.split("/")[-1] + "\n")
+			# dinuc proportions for current bam
+			tables['dinuc'] = pd.DataFrame([(dinuc, count/aln_count, inputs.split("/")[-1]) for dinuc, count in dinuc_dict.items()], columns = ['dinuc', 'proportion', 'sample'])
 
 			# add missing ends to dict to prevent issues with plotting in R
 			for end in ["CA", "CC", "C", "Absent"]:
@@ -377,108 +433,134 @@ def bamMods_mp(out_dir, min_cov, info, mismatch_dict, insert_dict, del_dict, clu
 					if not end in data.keys():
 						cca_dict[cluster][end] = 0
 
-			# write CCA outputs for current bam
-			for cluster, data in cca_dict.items():
-					for dinuc, count in data.items():
-						if dinuc.upper() in ["CA", "CC", "C", "ABSENT"]:
-							CCAvsCC_counts.write(cluster + "\t" + dinuc + "\t" + inputs + "\t" + condition + "\t" + str(count) + "\n")
+			# CCA outputs for current bam
+			tables['cca'] = pd.DataFrame([(cluster, dinuc, inputs, condition, count) for cluster, data in cca_dict.items() for dinuc, count in data.items() if dinuc.upper() in ["CA", "CC", "C", "ABSENT"]], \
+				columns = ['gene', 'end', 'sample', 'condition', 'count'])
 
-			dinuc_prop.close()
-			CCAvsCC_counts.close()
+		tables = {table:packTable(data, inputs + "_" + table) for table, data in tables.items()}
 
 	log.info('Analysis complete for {}...'.format(inputs))
 
-	return(new_mods, new_Inosines)
-
-def splitTable(table):
-# splits various tables so that addNA can be run in parallel on groupby objects
-
-	split_table = table.groupby('isodecoder')
-	dfs = [group for name, group in split_table]
-	names = [name for name, group in split_table]
+	return(new_mods, new_Inosines, tables)
 
-	return(names, dfs)
-
-def countMods(temp, reference, ref_pos, read_pos, read_seq, offset, md_list, ref_deletions, tRNA_dict, mismatch_dict, insert_dict, del_dict, remap):
+def countMods(temp, reference, mismatches, insertions, ref_deletions, tRNA_dict, mismatch_dict, insert_dict, del_dict, remap):
 # Loop though mismatches in read, assign to new deconvoluted reference (if possible) and count mods
+# mismatches, insertions and ref_deletions are as returned by readDecoder.decodeAlignment
 	
-	insertions = list()
-	#deletions = list()
+	insertions_list = list()
 	readRef_dif = tuple() # mismatches, insertions and deleteion in read relative to reference used to assign to isodecoders
-	for index, interval in enumerate(md_list):
-		if not index == 0:
-			new_offset = 0
-		else:
-			new_offset = offset
-		if not interval.startswith('^'): 
-			if interval.isdigit(): # stretch of matches
-				read_pos += int(interval)
-				interval = int(interval) + new_offset
-				ref_pos += interval
-			elif interval.isalpha(): # is a mismatch
-				identity = read_seq[read_pos]
-				ref_pos += new_offset 
-				# check if current mismatch is in cluster mismatches and add to tuple of differences for deconvolution
-				# if cluster_id not 1 and remap is disabed or this is round 2 of alignment (avoid errors in adding new mods for clusters)
-				if (ref_pos in mismatch_dict[reference]) and (not remap) and (not ref_pos in tRNA_dict[reference]['modified']):
-					toAdd = str(ref_pos) + identity
-					readRef_dif = readRef_dif + (toAdd,)				
-				# only include these positions if they aren't registered mismatches between clusters
-				elif (ref_pos not in mismatch_dict[reference]):
-					temp[ref_pos+1] = identity
-				# move forward
-				read_pos += 1
-				ref_pos += 1
-		elif interval.startswith('^'):
-			identity = 'Ins'
-			insert_length = len(interval) - 1
-			#insertions.extend([x + ref_pos for x in range(len(interval) - 1)]) # register all insertions (including consecutive insertions) to be checked later against cluster parent
-			current_inserts = [x for x in range(ref_pos,ref_pos+insert_length)]
-			insertions.extend(current_inserts)
-			for ins in current_inserts:
-				if (ins in insert_dict[reference].keys()) and (not remap): # only add position to tuple to deconvolute if it exists as a known difference in the cluster
-					toAdd = str(ref_pos) + identity
-					readRef_dif = readRef_dif + (toAdd,)
-			ref_pos += insert_length
-
-	# add applicable deletions after cycling through MD list
+	for ref_pos, identity in mismatches:
+		# check if current mismatch is in cluster mismatches and add to tuple of differences for deconvolution
+		# if cluster_id not 1 and remap is disabed or this is round 2 of alignment (avoid errors in adding new mods for clusters)
+		if (ref_pos in mismatch_dict.get(reference, ())) and (not remap) and (not ref_pos in tRNA_dict[reference]['modified']):
+			toAdd = str(ref_pos) + identity
+			readRef_dif = readRef_dif + (toAdd,)
+		# only include these positions if they aren't registered mismatches between clusters
+		elif (ref_pos not in mismatch_dict.get(reference, ())):
+			temp[ref_pos+1] = identity
+
+	identity = 'Ins'
+	for ref_pos, insert_length in insertions:
+		current_inserts = [x for x in range(ref_pos,ref_pos+insert_length)]
+		insertions_list.extend(current_inserts) # register all insertions (including consecutive insertions) to be checked later against cluster parent
+		for ins in current_inserts:
+			if (ins in insert_dict.get(reference, {})) and (not remap): # only add position to tuple to deconvolute if it exists as a known difference in the cluster
+				toAdd = str(ref_pos) + identity
+				readRef_dif = readRef_dif + (toAdd,)
+
+	# add applicable deletions
 	identity = "Del"
 	for deletion in ref_deletions:
-		if deletion in del_dict[reference].keys() and (not remap):
+		if deletion in del_dict.get(reference, {}) and (not remap):
 			toAdd = str(deletion) + identity
 			readRef_dif = readRef_dif + (toAdd,)
 
-	return(temp, ref_pos, read_pos, readRef_dif, insertions)
+	return(temp, readRef_dif, insertions_list)
+
+def nearMembers(indel_dict):
+# members of first non-empty list of cluster indels at pos, pos + 1 or pos - 1 for every position near an indel
+# (1 bp up and down are checked to account for differences in indel position due to short read aligner and usearch clustering)
+
+	near = dict()
+	for indel in indel_dict.keys():
+		for pos in (indel - 1, indel, indel + 1):
+			if not pos in near:
+				near[pos] = set(indel_dict.get(pos) or indel_dict.get(pos + 1) or indel_dict.get(pos - 1) or [])
+
+	return(near)
+
+def deconvolutionIndex(unique_isodecoderMMs, insert_dict, del_dict):
+# per-cluster index used by findNewReference to assign reads to deconvoluted isodecoders, built once per run
+# each distinguishing posIdentity of a cluster is given an integer bit and each unique subset a bitmask so that matching a read is a few integer operations
+# indel positions near which each member differs from the parent, and 5' adjustments of members shorter than the parent are also precomputed
+# dictionaries are only read with .get so that building the index does not add entries to defaultdicts
+
+	deconv_index = dict()
+	for cluster, data in unique_isodecoderMMs.items():
+		bits = dict()
+		for uss in data.keys():
+			for posIdentity in uss:
+				if not posIdentity in bits:
+					bits[posIdentity] = 1 << len(bits)
+		masks = list()
+		for uss, isodecoder in data.items():
+			mask = sum(bits[posIdentity] for posIdentity in set(uss))
+			masks.append((mask, bin(mask).count("1"), isodecoder[0]))
+
+		cluster_inserts = insert_dict.get(cluster, {})
+		cluster_dels = del_dict.get(cluster, {})
+		# adjustment for members that are shorter than parents at the 5' end: last of consecutive inserts in parent starting at pos 0
+		adjust_5 = dict()
+		for member in {member for members in cluster_inserts.values() for member in members}:
+			member_inserts = [ins for ins in cluster_inserts.keys() if member in cluster_inserts[ins]]
+			for k, g in groupby(enumerate(member_inserts), lambda ix: ix[0] - ix[1]):
+				l = list(map(itemgetter(1), g))
+				if 0 in l:
+					adjust_5[member] = max(l)
+
+		deconv_index[cluster] = {'exact':{uss:isodecoder[0] for uss, isodecoder in data.items()}, 'bits':bits, 'masks':masks, \
+			'inserts':nearMembers(cluster_inserts), 'deletions':nearMembers(cluster_dels), 'adjust_5':adjust_5}
 
-def findNewReference(unique_isodecoderMMs, splitBool, readRef_dif, reference, temp, insertions, insert_dict, del_dict, ref_deletions, adjust):
-# function to find new reference for read based on mismatches to cluster parent
+	return(deconv_index)
+
+def findNewReference(deconv_index, splitBool, readRef_dif, reference, temp, insertions, ref_deletions, adjust, matched):
+# function to find new reference for read based on mismatches to cluster parent (see deconvolutionIndex)
+# matched caches new references per cluster and read bitmask, it is owned by the caller as deconv_index is part of the read-only reference context
 
 	old_reference = reference
+	cluster_index = deconv_index.get(old_reference)
 	# Check sorted readRef_dif in unique_isodecoderMMs to update reference
 	readRef_dif = tuple(sorted(readRef_dif))
-	if readRef_dif:
-		if readRef_dif in unique_isodecoderMMs[old_reference].keys():
+	if readRef_dif and cluster_index:
+		if readRef_dif in cluster_index['exact']:
 			# set new reference only if it is not in splitBool - these are unsplit isodecoders because of significant cov difference between 3' end and mismatch used for splitting
-			reference = unique_isodecoderMMs[old_reference][readRef_dif][0]
+			reference = cluster_index['exact'][readRef_dif]
 		# if it is not found, it may be some shorter combination as unique_isodecoderMMs contains shortest possible combination set
+		# choose the unique subset sharing most differences with the read, and for ties the one with fewest differences not in the read (last in order if still tied)
+		# the choice only depends on which distinguishing differences are in the read, so it is cached per read bitmask
 		else:
-			intersectLen = dict()
-			for uss in unique_isodecoderMMs[old_reference].keys():
-				uss_set = set(uss) 
-				intersection = uss_set.intersection(readRef_dif)
-				intersectLen[uss] = len(intersection)
-			
-			maxIntersect = max(intersectLen.values())
-			matches = [match for match, length in intersectLen.items() if length == maxIntersect and not length == 0]
-			if len(matches) == 1:
-				reference = unique_isodecoderMMs[old_reference][matches[0]][0]
-			elif len(matches) > 1:
-				diffLen = dict()
-				for match in matches:
-					diff = len(set(match) - set(readRef_dif))
-					diffLen[diff] = match
-				minuss = diffLen[min(diffLen.keys())]
-				reference = unique_isodecoderMMs[old_reference][minuss][0]
+			cluster_matched = matched[old_reference]
+			read_mask = 0
+			for posIdentity in readRef_dif:
+				read_mask |= cluster_index['bits'].get(posIdentity, 0)
+			if read_mask in cluster_matched:
+				reference = cluster_matched[read_mask] or reference
+			else:
+				maxIntersect = 0
+				matches = list()
+				for mask, size, isodecoder in cluster_index['masks']:
+					intersect = bin(mask & read_mask).count("1")
+					if intersect > maxIntersect:
+						maxIntersect = intersect
+						matches = [(size - intersect, isodecoder)]
+					elif intersect == maxIntersect and intersect > 0:
+						matches.append((size - intersect, isodecoder))
+				new_reference = None
+				if matches:
+					minDiff = min(diff for diff, isodecoder in matches)
+					new_reference = [isodecoder for diff, isodecoder in matches if diff == minDiff][-1]
+				cluster_matched[read_mask] = new_reference
+				reference = new_reference or reference
 
 	# handle insertions and deletions between cluster parent and members present in read (different from insertions or deletions in read only)
 	# i.e. once new ref is found above and this member has an insertion or deletion relative to parent, subtract (ins) or add (del) 1 from all misinc positions after the insertion
@@ -486,22 +568,15 @@ def findNewReference(unique_isodecoderMMs, splitBool, readRef_dif, reference, te
 	# Note that 1 bp up and down from the insertion/deletion are checked to account for differences in insertion/deletion position due to short read aligner and usearch clustering
 	if (not reference == old_reference):
 		for i in insertions:
-			if reference in (insert_dict[old_reference][i] or insert_dict[old_reference][i+1] or insert_dict[old_reference][i-1]):
+			if reference in cluster_index['inserts'].get(i, ()):
 				temp = {(k - 1 if k > i else k):v for k,v in temp.items()}
 		for d in ref_deletions:
-			if reference in (del_dict[old_reference][d] or del_dict[old_reference][d+1] or del_dict[old_reference][d-1]):
+			if reference in cluster_index['deletions'].get(d, ()):
 				temp = {(k + 1 if k > d else k):v for k, v in temp.items()}
 			
 		# special case for members that are shorter than parents at the 5' end or 3'
 		# need to subtract the number of bases from recorded mismatches in temp to correct the position info
-		cluster_inserts = [ins for ins in insert_dict[old_reference].keys() if reference in insert_dict[old_reference][ins]] # get all inserts in parent for the new reference (child)
-		consec_inserts_5 = list()
-		if cluster_inserts:
-			for k, g in groupby(enumerate(cluster_inserts), lambda ix: ix[0] - ix[1]): # this gets lists of consecutive inserts - non-consecutive inserts could just be normal inserts in the body
-				l = list(map(itemgetter(1), g))
-				if 0 in l: # checks consecutive inserts for those starting at the 5' end of the parent
-					consec_inserts_5 = l
-					adjust = max(consec_inserts_5) #+ 1 # add one to adjustment variable because an insert at (for e.g.) pos 0 of the parent indicates that the member starts at position 1 of the parent
+		adjust = cluster_index['adjust_5'].get(reference, adjust)
 		temp = {(k - adjust):v for k,v in temp.items() if k >= adjust}
 
 	#	cluster_deletions = [deletion for deletion in del_dict[old_reference].keys() if reference in del_dict[old_reference][deletion]] # get all inserts in parent for the new reference (child)
@@ -516,27 +591,70 @@ def findNewReference(unique_isodecoderMMs, splitBool, readRef_dif, reference, te
 
 	return(reference, temp, adjust)
 
-def addNA(tRNA_struct, data_type, name, table):
-# fill mods and stops tables with 'NA' for gapped alignment
-	
-	#cluster = [parent for parent, child in cluster_dict.items() if name in child][0]
-	shortname = "-".join(name.split("-")[:-1]) if not "chr" in name else name
-	new = pd.DataFrame()
-	for pos in tRNA_struct.loc[shortname].index:
-		if not any(table.loc[table.isodecoder == name].pos == pos): #and not (data_type == "readthrough"):
-			if data_type == 'mods':
-				#new = pd.DataFrame({'isodecoder':name, 'pos':pos, 'type':pd.Categorical(['A','C','G','T']), 'proportion':'NA', 'condition':table.condition.iloc[1], 'bam':table.bam.iloc[1], 'cov':'NA'})
-				new = pd.DataFrame({'isodecoder':name, 'pos':pos, 'type':pd.Categorical(['A','C','G','T']), 'proportion':'NA', 'condition':table.condition.iloc[1], 'bam':table.bam.iloc[1]})
-			elif data_type == 'stops':
-				new = pd.DataFrame({'isodecoder':name, 'pos':pos, 'proportion':'NA', 'condition':table.condition.iloc[0], 'bam':table.bam.iloc[0]}, index=[0])
-			elif data_type == 'cov':
-				new = pd.DataFrame({'isodecoder':name, 'pos':pos, 'bam':table.bam.iloc[0], 'cov':'NA'}, index=[0])
-			
-			table = table.append(new)
+def addNA(struct_pos, data_type, table):
+# fill mods, stops and cov tables with NA for structural positions of each isodecoder that are missing from the table (i.e. gapped alignment)
+# struct_pos is a DataFrame of cluster and pos for all structural positions, where cluster is the isodecoder name without the copy number
+
+	isodecoders = pd.DataFrame({'isodecoder':table.isodecoder.unique()})
+	isodecoders['cluster'] = ["-".join(name.split("-")[:-1]) if not "chr" in name else name for name in isodecoders.isodecoder]
+	all_pos = isodecoders.merge(struct_pos, on = 'cluster')[['isodecoder', 'pos']]
+
+	# keep only positions not already in table
+	present = table[['isodecoder', 'pos']].drop_duplicates()
+	present['pos'] = present['pos'].astype(int)
+	gaps = all_pos.merge(present, on = ['isodecoder', 'pos'], how = 'left', indicator = True)
+	gaps = gaps.loc[gaps._merge == 'left_only', ['isodecoder', 'pos']]
+
+	if data_type == 'mods':
+		gaps = gaps.merge(pd.DataFrame({'type':['A','C','G','T']}), how = 'cross')
+		gaps['proportion'] = np.nan
+	elif data_type == 'stops':
+		gaps['proportion'] = np.nan
+	elif data_type == 'cov':
+		gaps['cov'] = np.nan
+	if 'condition' in table.columns:
+		gaps['condition'] = table.condition.iloc[0] if not table.empty else np.nan
+	gaps['bam'] = table.bam.iloc[0] if not table.empty else np.nan
+
+	# keep rows of each isodecoder together as before
+	table = pd.concat([table, gaps], ignore_index = True).sort_values('isodecoder', kind = 'mergesort')
 
 	return(table)
 
-def generateModsTable(sampleGroups, out_dir, name, threads, min_cov, mismatch_dict, insert_dict, del_dict, cluster_dict, cca, remap, misinc_thresh, knownTable, Inosine_lists, tRNA_dict, Inosine_clusters, unique_isodecoderMMs, splitBool, isodecoder_sizes, clustering):
+def shortIsodecoders(names):
+# remove numbering from the end of isodecoder names (except for chr names) in a Series, each unique name is only split once
+
+	short = {name:name if "chr" in name else "-".join(name.split("-")[:-1]) for name in names.unique()}
+
+	return(names.map(short))
+
+def mergeSampleTables(tables, filtered, splitBool, tRNA_ungap2canon_table):
+# concatenate per-sample position tables (mismatch, RT stop or readthrough) returned by bamMods_mp
+# filtered and unsplit isodecoders are removed, names are shortened and canonical positions are mapped once for all samples
+
+	table = pd.concat(tables, ignore_index = True)
+	table = table[~table.isodecoder.isin(filtered) & ~table.isodecoder.isin(splitBool)].copy()
+	table['isodecoder'] = shortIsodecoders(table['isodecoder'])
+	table['pos'] = table['pos'] - 1 # subtract 1 for 0-based numbering to get canon_pos
+	table = pd.merge(table, tRNA_ungap2canon_table, on = ['isodecoder', 'pos'], how = "left")
+	table['pos'] = table['pos'] + 1 # return to 1-based
+
+	return(table)
+
+def correctInosines(modTable, Inosine_clusters, cluster_dict):
+# edit misinc. proportions at position 34 of inosine containing isodecoders in mismatch table to reflect true level of Gs, set As to NA
+# G proportion is 1 - sum of all other misinc. proportions at position 34, computed for every (isodecoder, bam) at once
+
+	inosine_isodecoders = {"-".join(isodecoder.split("-")[:-1]) for cluster in Inosine_clusters for isodecoder in cluster_dict[cluster]}
+	inosine_pos = (modTable.canon_pos == '34') & modTable.isodecoder.isin(inosine_isodecoders)
+	misinc = modTable['proportion'].where(inosine_pos & (modTable['type'] != 'G'))
+	misinc_total = misinc.groupby([modTable.isodecoder, modTable.bam]).transform('sum')
+	modTable.loc[inosine_pos & (modTable['type'] == 'G'), 'proportion'] = 1 - misinc_total
+	modTable.loc[inosine_pos & (modTable['type'] == 'A'), 'proportion'] = np.nan
+
+	return(modTable)
+
+def generateModsTable(sampleGroups, out_dir, name, threads, min_cov, mismatch_dict, insert_dict, del_dict, cluster_dict, cca, remap, misinc_thresh, knownTable, Inosine_lists, tRNA_dict, Inosine_clusters, unique_isodecoderMMs, splitBool, isodecoder_sizes, clustering, seq_index = None, collapse_reads = False):
 # Wrapper function to call countMods_mp with multiprocessing
 
 	if cca:
@@ -591,12 +709,19 @@ def generateModsTable(sampleGroups, out_dir, name, threads, min_cov, mismatch_di
 	tRNA_ungap2canon_table['pos'] = tRNA_ungap2canon_table['pos'].astype(int)
 	tRNA_ungap2canon_table = tRNA_ungap2canon_table[~pd.isna(tRNA_ungap2canon_table.canon_pos)]
 
+	# reference structures are published once as a shared context rather than pickled with every task (see referenceContext)
+	# deconv_index is the index for assigning reads to deconvoluted isodecoders (see findNewReference)
+	context = ReferenceContext(mismatch_dict = mismatch_dict, insert_dict = insert_dict, del_dict = del_dict, cluster_dict = cluster_dict, tRNA_struct = tRNA_struct_df, \
+		knownTable = knownTable, tRNA_dict = tRNA_dict, unique_isodecoderMMs = unique_isodecoderMMs, deconv_index = deconvolutionIndex(unique_isodecoderMMs, insert_dict, del_dict), \
+		splitBool = splitBool, isodecoder_sizes = isodecoder_sizes)
+
 	# initiate custom non-daemonic multiprocessing pool and run with bam names
-	pool = MyPool(multi)
+	pool = contextPool(context, multi, MyPool)
 	# to avoid assigning too many threads, divide available threads by number of processes
 	threadsForMP = int(threads/multi)
-	func = partial(bamMods_mp, out_dir, min_cov, baminfo, mismatch_dict, insert_dict, del_dict, cluster_dict, cca, tRNA_struct_df, remap, misinc_thresh, knownTable, tRNA_dict, unique_isodecoderMMs, splitBool, isodecoder_sizes, threadsForMP)
-	new_mods, new_Inosines = zip(*pool.map(func, bamlist))
+	func = partial(bamMods_mp, out_dir, min_cov, baminfo, cca, remap, misinc_thresh, threadsForMP, collapse_reads)
+	new_mods, new_Inosines, sample_tables = zip(*pool.map(func, bamlist))
+	sample_tables = dict(zip(bamlist, sample_tables))
 	pool.close()
 	pool.join()
 
@@ -622,89 +747,34 @@ def generateModsTable(sampleGroups, out_dir, name, threads, min_cov, mismatch_di
 		allnewKnownTable_df = pd.merge(allnewKnownTable_df, tRNA_ungap2canon_table, on = ['isodecoder', 'pos'], how = "left")
 		allnewKnownTable_df.to_csv(out_dir + "mods/allModsTable.csv", sep = "\t", index = False, na_rep = 'NA')
 
-		modTable_total = pd.DataFrame()
-		countsTable_total = pd.DataFrame()
-		stopTable_total = pd.DataFrame()
-		readthroughTable_total = pd.DataFrame()
-		newMods_total = pd.DataFrame()
-
-		dinuc_table = pd.DataFrame()
-		CCAvsCC_table = pd.DataFrame()
-
 		# generate counts table to select tRNAs to filter
-		for bam in bamlist:
-			countsTable = pd.read_csv(bam + "countTable.csv", header = 0, sep = "\t")
-			os.remove(bam + "countTable.csv")
-			if countsTable_total.empty:
-				countsTable_total = pd.concat([countsTable_total, countsTable], ignore_index = True)
-			else:
-				countsTable_total = pd.merge(countsTable_total, countsTable, on = "isodecoder", how = "left")
+		# per-sample counts are joined in one pass on isodecoder, keeping isodecoders (and their order) of the first sample
+		countsTables = [unpackTable(sample_tables[bam]['counts']).set_index('isodecoder') for bam in bamlist]
+		countsTable_total = countsTables[0].join(countsTables[1:], how = "left")
 
 		# get isodecoders to filter
-		countsTable_total.index = countsTable_total.isodecoder
-		countsTable_total.drop(columns = ['isodecoder'], inplace = True)
 		filtered, filter_warning = filterCoverage(countsTable_total, min_cov)
 		unsplit_lowCov = set(filtered).intersection(set(splitBool))
 		log.info("{}/{} unique sequences not deconvoluted also do not meet coverage threshold...".format(len(unsplit_lowCov), len(splitBool)))
- 
+
+		# tables returned by bamMods_mp are concatenated once and filtered, renamed and mapped to canonical positions together
+		modTable_total = mergeSampleTables([unpackTable(sample_tables[bam]['mismatch']) for bam in bamlist], filtered, splitBool, tRNA_ungap2canon_table)
+		# edit misinc. propoportions of inosines to reflect true level of Gs, set As to NA
+		modTable_total = correctInosines(modTable_total, Inosine_clusters, cluster_dict)
+		stopTable_total = mergeSampleTables([unpackTable(sample_tables[bam]['stops']) for bam in bamlist], filtered, splitBool, tRNA_ungap2canon_table)
+		readthroughTable_total = mergeSampleTables([unpackTable(sample_tables[bam]['readthrough']) for bam in bamlist], filtered, splitBool, tRNA_ungap2canon_table)
+		newMods_total = pd.concat([unpackTable(sample_tables[bam]['predicted']) for bam in bamlist], ignore_index = True)
+
 		for bam in bamlist:
-			# read in temp files and then delete
-			modTable = pd.read_csv(bam + "mismatchTable.csv", header = 0, sep = "\t")
-			modTable = modTable[~modTable.isodecoder.isin(filtered)]
-			modTable = modTable[~modTable.isodecoder.isin(splitBool)]
-			modTable.loc[~modTable['isodecoder'].str.contains("chr"), 'isodecoder'] = modTable['isodecoder'].str.split("-").str[:-1].str.join("-")
-			modTable['pos'] = modTable['pos'] - 1 # subtract 1 for 0-based numbering to get canon_pos
-			modTable = pd.merge(modTable, tRNA_ungap2canon_table, on = ['isodecoder', 'pos'], how = "left")
-			modTable['pos'] = modTable['pos'] + 1 # return to 1-based
-			#modTable['canon_pos'] = modTable['pos'].map(cons_pos_dict)
-			# edit misinc. propoportions of inosines to reflect true level of Gs, set As to NA
-			for cluster in Inosine_clusters:
-				for isodecoder in cluster_dict[cluster]:
-					iso_short = "-".join(isodecoder.split("-")[:-1])
-					if any(modTable.isodecoder.str.contains(iso_short)):
-						modTable.at[(modTable.canon_pos == '34') & (modTable['type'] == 'G') & (modTable.isodecoder == iso_short), 'proportion'] = 1 - sum(modTable[(modTable.canon_pos == '34') & (modTable['type'] != 'G') & (modTable.isodecoder == iso_short)]['proportion'].dropna())
-						modTable.at[(modTable.canon_pos == '34') & (modTable['type'] == 'A') & (modTable.isodecoder == iso_short), 'proportion'] = np.nan
-			os.remove(bam + "mismatchTable.csv")
-
-			stopTable = pd.read_csv(bam + "RTstopTable.csv", header = 0, sep = "\t")
-			stopTable = stopTable[~stopTable.isodecoder.isin(filtered)]
-			stopTable = stopTable[~stopTable.isodecoder.isin(splitBool)]
-			stopTable.loc[~stopTable['isodecoder'].str.contains("chr"), 'isodecoder'] = stopTable['isodecoder'].str.split("-").str[:-1].str.join("-")
-			stopTable['pos'] = stopTable['pos'] - 1
-			stopTable = pd.merge(stopTable, tRNA_ungap2canon_table, on = ['isodecoder', 'pos'], how = "left")
-			stopTable['pos'] = stopTable['pos'] + 1
-			#stopTable['canon_pos'] = stopTable['pos'].map(cons_pos_dict)
-			os.remove(bam + "RTstopTable.csv")
-
-			readthroughTable = pd.read_csv(bam + "readthroughTable.csv", header = 0, sep = "\t")
-			readthroughTable = readthroughTable[~readthroughTable.isodecoder.isin(filtered)]
-			readthroughTable = readthroughTable[~readthroughTable.isodecoder.isin(splitBool)]
-			readthroughTable.loc[~readthroughTable['isodecoder'].str.contains("chr"), 'isodecoder'] = readthroughTable['isodecoder'].str.split("-").str[:-1].str.join("-")
-			readthroughTable['pos'] = readthroughTable['pos'] - 1
-			readthroughTable = pd.merge(readthroughTable, tRNA_ungap2canon_table, on = ['isodecoder', 'pos'], how = "left")
-			readthroughTable['pos'] = readthroughTable['pos'] + 1
-			#readthroughTable['canon_pos'] = readthroughTable['pos'].map(cons_pos_dict)
-			os.remove(bam + "readthroughTable.csv")
-
-			newModsTable = pd.read_csv(bam + "_predictedModstemp.csv", header = None, names = ['isodecoder', 'pos', 'identity', 'bam'], sep = "\t")
-			os.remove(bam + "_predictedModstemp.csv")
-
-			# add individual temp files to main concatenated table
-			modTable_total = pd.concat([modTable_total,modTable], ignore_index = True)
-			stopTable_total = pd.concat([stopTable_total, stopTable], ignore_index = True)
-			readthroughTable_total = pd.concat([readthroughTable_total, readthroughTable], ignore_index = True)
-			newMods_total = pd.concat([newMods_total, newModsTable], ignore_index = True)
-
-			if cca:
-				# same for CCA analysis files
-				dinuc = pd.read_csv(bam + "_dinuc.csv", header = None, keep_default_na=False, sep = "\t")
-				os.remove(bam + "_dinuc.csv")
-				CCA = pd.read_table(bam + "_CCAcounts.csv", header = None)
-				CCA = CCA[~CCA[0].isin(filtered)]
-				os.remove(bam + "_CCAcounts.csv")
-
-				dinuc_table = pd.concat([dinuc_table, dinuc], ignore_index = True)
-				CCAvsCC_table = pd.concat([CCAvsCC_table, CCA], ignore_index = True)
+			# predicted mods written before remapping are no longer needed
+			if os.path.isfile(bam + "_predictedModstemp.csv"):
+				os.remove(bam + "_predictedModstemp.csv")
+
+		if cca:
+			# same for CCA analysis files
+			dinuc_table = pd.concat([unpackTable(sample_tables[bam]['dinuc']) for bam in bamlist], ignore_index = True)
+			CCAvsCC_table = pd.concat([unpackTable(sample_tables[bam]['cca']) for bam in bamlist], ignore_index = True)
+			CCAvsCC_table = CCAvsCC_table[~CCAvsCC_table.gene.isin(filtered)]
 
 		# edit splitBool isodecoder names for filtering from tables and adding to Single_isodecoder in counts files
 		splitBool = ["-".join(x.split("-")[:-1]) for x in splitBool]
@@ -729,9 +799,7 @@ def generateModsTable(sampleGroups, out_dir, name, threads, min_cov, mismatch_di
 		readthroughTable_total.to_csv(out_dir + "mods/readthroughTable.csv", sep = "\t", index = False, na_rep = 'NA')	
 		
 		# add column to counts to indicate complete isodecoder split or not, sizes, and parent
-		countsTable_total['isodecoder'] = countsTable_total.index
-		countsTable_total.loc[~countsTable_total.isodecoder.str.contains("chr"), "isodecoder"] = countsTable_total.isodecoder.str.split("-").str[:-1].str.join("-")
-		countsTable_total.set_index("isodecoder", inplace=True)
+		countsTable_total.index = shortIsodecoders(countsTable_total.index.to_series())
 		countsTable_total['Single_isodecoder'] = "NA"
 		isodecoder_sizes_short = defaultdict()
 		for iso, size in isodecoder_sizes.items():
@@ -760,7 +828,7 @@ def generateModsTable(sampleGroups, out_dir, name, threads, min_cov, mismatch_di
 
 		# map canon_pos for each isodecoder ungapped pos to newMods
 		newMods_total = newMods_total[~newMods_total.isodecoder.isin(filtered)]
-		newMods_total.loc[~newMods_total['isodecoder'].str.contains("chr"), 'isodecoder'] = newMods_total['isodecoder'].str.split("-").str[:-1].str.join("-")
+		newMods_total['isodecoder'] = shortIsodecoders(newMods_total['isodecoder'])
 		newMods_total = pd.merge(newMods_total, tRNA_ungap2canon_table, on = ['isodecoder', 'pos'], how = "left")
 		# make pivot table from mods and add A, C, G, T misinc. proportions for new mods
 		pivot = modTable_total.pivot_table(index = ['isodecoder', 'bam', 'canon_pos'], columns = 'type', values = 'proportion')
@@ -772,15 +840,13 @@ def generateModsTable(sampleGroups, out_dir, name, threads, min_cov, mismatch_di
 		newMods_total.to_csv(out_dir + 'mods/predictedMods.csv', sep = "\t", index = False, na_rep = "NA")
 
 		if cca:
-			dinuc_table.columns = ['dinuc', 'proportion', 'sample']
 			dinuc_table.to_csv(out_dir + "CCAanalysis/AlignedDinucProportions.csv", sep = "\t", index = False, na_rep = 'NA')
-			CCAvsCC_table.columns = ['gene', 'end', 'sample', 'condition', 'count']
-			CCAvsCC_table.loc[~CCAvsCC_table['gene'].str.contains("chr"), 'gene'] = CCAvsCC_table['gene'].str.split("-").str[:-1].str.join("-")
+			CCAvsCC_table['gene'] = shortIsodecoders(CCAvsCC_table['gene'])
 			CCAvsCC_table.drop_duplicates(inplace = True)
 			CCAvsCC_table.to_csv(out_dir + "CCAanalysis/CCAcounts.csv", sep = "\t", index = False)
 
 		# Anticodon and/or isodecoder counts counts
-		countReads(out_dir + "Isodecoder_counts_raw.txt", out_dir, isodecoder_sizes, clustering, newtRNA_dict, clusterInfo)
+		countReads(out_dir + "Isodecoder_counts_raw.txt", out_dir, isodecoder_sizes, clustering, newtRNA_dict, clusterInfo, seq_index)
 
 		log.info("** Read counts per isodecoder saved to " + out_dir + "counts/Isodecoder_counts_raw.txt **")
 
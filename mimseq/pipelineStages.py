@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+
+##############################################################################
+# Named pipeline stages with checkpoints and a manifest for resuming runs #
+##############################################################################
+
+import os, json, pickle, hashlib, logging
+from . import version
+from . import ssAlign
+
+log = logging.getLogger(__name__)
+
+# stages in order of execution, rerunning a stage invalidates all following stages
+STAGES = ["reference", "index", "align", "split", "remap", "mods", "plots", "coverage", "deseq", "tidy"]
+
+def fileSignature(path):
+# size and modification time of an input file (or None if it does not exist) used to detect changed inputs
+
+	if path and os.path.exists(path):
+		stat = os.stat(path)
+		return([path, stat.st_size, stat.st_mtime_ns])
+	else:
+		return([path, None, None])
+
+def sampleSignature(sample_data):
+# signatures of sample sheet and all fastq files listed in it
+
+	signature = [fileSignature(sample_data)]
+	with open(sample_data, "r") as sampleData:
+		for line in sampleData:
+			line = line.strip()
+			if line:
+				signature.append(fileSignature(line.split("\t")[0]))
+
+	return(signature)
+
+def paramsHash(params):
+# hash of stage parameters recorded in the manifest
+
+	return(hashlib.sha256(json.dumps(params, sort_keys = True, default = str).encode("utf-8")).hexdigest())
+
+class PipelineStages(object):
+# runs stage functions on a shared state dictionary, recording each completed stage in a JSON manifest in out_dir
+# the full state is pickled after every stage so that a resumed run can continue from the last valid stage
+# a stage is valid if its parameters are unchanged, its outputs still exist, and no earlier stage was rerun
+# (outputs are only checked for existence as later stages rewrite some of them, e.g. bam files after remapping)
+
+	def __init__(self, out_dir, resume = False):
+
+		self.out_dir = out_dir
+		self.resume = resume
+		self.manifest_file = out_dir + "mimseq_manifest.json"
+		self.checkpoint_dir = out_dir + "checkpoints/"
+		self.manifest = {'version':version.__version__, 'stages':{}}
+		if resume and os.path.isfile(self.manifest_file):
+			with open(self.manifest_file, "r") as manifest:
+				self.manifest = json.load(manifest)
+			if not self.manifest.get('version') == version.__version__:
+				log.warning("Manifest written by mim-tRNAseq v{}: rerunning all stages...".format(self.manifest.get('version')))
+				self.manifest = {'version':version.__version__, 'stages':{}}
+		self.pending = None
+		os.makedirs(self.checkpoint_dir, exist_ok = True)
+
+	def complete(self):
+	# True if all stages of a previous run completed (i.e. output files have already been tidied)
+
+		return(self.resume and 'tidy' in self.manifest['stages'])
+
+	def changed(self, stage_params):
+	# recorded stages whose parameters differ from stage_params (dictionary of stage: parameters)
+
+		return([stage for stage in STAGES if stage in self.manifest['stages'] and not self.manifest['stages'][stage]['params'] == paramsHash(stage_params.get(stage, {}))])
+
+	def valid(self, stage, params_hash):
+
+		entry = self.manifest['stages'].get(stage)
+		if not entry or not entry['params'] == params_hash or not os.path.isfile(entry['checkpoint']):
+			return(False)
+		for path in entry['outputs']:
+			if not os.path.exists(path):
+				return(False)
+
+		return(True)
+
+	def run(self, stage, params, func, state, outputs = None, succeeded = None):
+	# run func(state) for stage unless it is valid in the manifest of a resumed run
+	# outputs(state) returns files or folders that must exist for the stage to be valid, succeeded(state) may return False to leave stage unrecorded
+
+		params_hash = paramsHash(params)
+		if self.resume and self.valid(stage, params_hash):
+			log.info("Skipping completed stage: {}".format(stage))
+			self.pending = self.manifest['stages'][stage]['checkpoint']
+			return
+
+		# restore state from last skipped stage before running
+		self.restore(state)
+
+		# rerunning a stage invalidates all downstream stages
+		for later_stage in STAGES[STAGES.index(stage):]:
+			self.manifest['stages'].pop(later_stage, None)
+		self.save()
+
+		func(state)
+
+		if succeeded and not succeeded(state):
+			log.warning("Stage {} did not complete successfully and will be rerun with --resume".format(stage))
+			return
+
+		state['stkname'] = ssAlign.stkname
+		checkpoint_file = self.checkpoint_dir + stage + ".pkl"
+		with open(checkpoint_file, "wb") as checkpoint:
+			pickle.dump(state, checkpoint)
+		output_list = [path for path in (outputs(state) if outputs else []) if path and os.path.exists(path)]
+		self.manifest['stages'][stage] = {'params':params_hash, 'checkpoint':checkpoint_file, 'outputs':output_list}
+		self.save()
+
+	def restore(self, state):
+	# load state of last skipped stage (e.g. if all remaining stages were skipped)
+
+		if self.pending:
+			with open(self.pending, "rb") as checkpoint:
+				state.update(pickle.load(checkpoint))
+			if state.get('stkname'):
+				ssAlign.setAlignment(state['stkname'])
+			self.pending = None
+
+	def save(self):
+
+		with open(self.manifest_file + ".tmp", "w") as manifest:
+			json.dump(self.manifest, manifest, indent = 1)
+		os.replace(self.manifest_file + ".tmp", self.manifest_file)
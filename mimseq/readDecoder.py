@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+
+#####################################################################################
+# Decoding of aligned reads into mismatches, insertions and deletions for mmQuant  #
+#####################################################################################
+
+import re
+from functools import lru_cache
+
+# MD tags are stretches of matches (digits), mismatched reference bases (letters) or deletions from the reference (^ followed by bases)
+md_re = re.compile('([0-9]+)|(\\^[A-Za-z]+|[A-Za-z])')
+
+# pysam cigartuples operations that consume both read and reference (M, = and X), and insertions to the reference (I)
+ALN_OPS = {0, 7, 8}
+INS_OP = 1
+
+# reads collapsed before alignment are named <index>_x<count> (see fastqCollapse)
+collapsed_re = re.compile('^[0-9]+_x([0-9]+)$')
+
+def readCount(query_name):
+# number of reads represented by an alignment, i.e. count of collapsed reads or 1
+
+	collapsed = collapsed_re.match(query_name)
+	return(int(collapsed.group(1)) if collapsed else 1)
+
+def singleRead(query_name):
+
+	return(1)
+
+def readWeight(collapsed):
+# function giving the number of reads represented by an alignment from its read name
+# counts are only taken from read names if reads were collapsed by fastqCollapse, otherwise reads that happen to be named like collapsed reads would be multiplied
+
+	return(readCount if collapsed else singleRead)
+
+@lru_cache(maxsize = 65536)
+def tokeniseMD(md_tag):
+# split MD tag once into integers (matches), single bases (mismatches) and '^' prefixed strings (deletions)
+# MD tags are shared by very many reads so tokenised tags are cached
+
+	return(tuple(int(matches) if matches else other for matches, other in md_re.findall(md_tag)))
+
+def decodeAlignment(offset, cigartuples, md_tag, read_seq):
+# walk cigartuples and MD tag of one alignment in a single pass
+# read_seq must not contain soft-clipped bases (i.e. query_alignment_sequence), soft-clips in cigartuples are skipped
+# returns:
+#	mismatches: list of (ref_pos, base) for each mismatch, ref_pos is 0-based on the reference
+#	insertions: list of (ref_pos, length) for each deletion in the read (i.e. insertions in the reference relative to the read)
+#	ref_deletions: positions in read_seq of insertions in the read (i.e. deletions in the reference relative to the read)
+#	ref_pos: end of alignment on the reference
+
+	# remove insertions in read from the sequence (MD tags do not account for these and effect misinc. identity matching)
+	# record ref_deletions (insertions in read) for matching later to unique differences between ref and read for isodecoder splitting
+	aligned = list()
+	ref_deletions = list()
+	read_pos = 0
+	for op, length in cigartuples:
+		if op in ALN_OPS:
+			aligned.append(read_seq[read_pos:read_pos+length])
+			read_pos += length
+		elif op == INS_OP:
+			ref_deletions.append(read_pos)
+			read_pos += length
+	aligned_seq = "".join(aligned)
+
+	# offset is start position of read alignment relative to reference
+	mismatches = list()
+	insertions = list()
+	ref_pos = offset
+	read_pos = 0
+	for token in tokeniseMD(md_tag):
+		if type(token) is int: # stretch of matches
+			read_pos += token
+			ref_pos += token
+		elif token[0] == '^': # deletion in read
+			insert_length = len(token) - 1
+			insertions.append((ref_pos, insert_length))
+			ref_pos += insert_length
+		else: # mismatch
+			mismatches.append((ref_pos, aligned_seq[read_pos]))
+			read_pos += 1
+			ref_pos += 1
+
+	return(mismatches, insertions, ref_deletions, ref_pos)
+
+def decodeRead(read):
+# decode a pysam AlignedSegment, trimming soft-clipped bases from the read
+
+	return(decodeAlignment(read.reference_start, read.cigartuples, read.get_tag('MD'), read.query_alignment_sequence))
+
+def collapseAlignments(reads, collapsed = False):
+# collapse identical alignments so that each is only decoded and counted once
+# counts include the multiplicity of reads if they were collapsed before alignment (see readWeight)
+# alignments are identical if reference, start, CIGAR, MD tag and soft-clip trimmed sequence are the same
+# the last two bases of the full read sequence are also part of the key as they are used for CCA analysis (and may be soft-clipped)
+# returns dictionary of key: [count, cigartuples, reference_end] in order of first occurence
+
+	weight = readWeight(collapsed)
+	alignments = dict()
+	for read in reads:
+		key = (read.reference_id, read.reference_start, read.cigarstring, read.get_tag('MD'), read.query_alignment_sequence, read.query_sequence[-2:])
+		try:
+			alignments[key][0] += weight(read.query_name)
+		except KeyError:
+			alignments[key] = [weight(read.query_name), read.cigartuples, read.reference_end]
+
+	return(alignments)
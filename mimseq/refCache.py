@@ -0,0 +1,139 @@
+#! /usr/bin/env python3
+
+###########################################################################
+# Cache of reference builds (modsToSNPIndex outputs and GSNAP indices)   #
+#    keyed by a hash of all inputs so that they can be shared across runs #
+###########################################################################
+
+import os, shutil, pickle, hashlib, json, tempfile, logging
+from . import version
+from .ssAlign import setAlignment
+
+log = logging.getLogger(__name__)
+
+# reference files written by modsToSNPIndex to out_dir + experiment_name + suffix (only those present for a given run are cached)
+reference_suffixes = ["_maturetRNA.bed", "_tRNATranscripts.fa", "_tRNA.gff", "isoacceptorInfo.txt", "_clusters.bed", "clusterInfo.txt", \
+	"_clusterTranscripts.fa", "_modificationSNPs.txt", "_tRNATranscripts_align.stk", "_clusterTranscripts_align.stk"]
+
+def modomicsSnapshot(modomics, fetch):
+# return Modomics data in a form that can be parsed by processModomics more than once, and its contents for hashing
+# local Modomics files are read into a list of lines, data fetched from the API is hashed as sorted JSON
+
+	if fetch:
+		snapshot = json.dumps(modomics, sort_keys = True).encode("utf-8")
+	else:
+		modomics_lines = modomics.readlines()
+		modomics.close()
+		modomics = modomics_lines
+		snapshot = "".join(modomics).encode("utf-8")
+
+	return(modomics, snapshot)
+
+def referenceKey(input_files, modomics_snapshot, options):
+# hash of reference inputs: contents of input files, Modomics data, options affecting the reference build and mim-tRNAseq version
+
+	key = hashlib.sha256()
+	key.update(version.__version__.encode("utf-8"))
+	for input_file in input_files:
+		key.update(b"\0file\0")
+		if input_file:
+			with open(input_file, "rb") as f:
+				for chunk in iter(lambda: f.read(1 << 20), b""):
+					key.update(chunk)
+	key.update(b"\0modomics\0")
+	key.update(modomics_snapshot)
+	key.update(b"\0options\0")
+	key.update(json.dumps(options, sort_keys = True).encode("utf-8"))
+
+	return(key.hexdigest())
+
+def restoreReference(cache_dir, key, out_dir, experiment_name):
+# copy cached reference files into out_dir with current experiment name and return cached modsToSNPIndex outputs
+# returns None if there is no cache entry for key
+
+	entry = os.path.join(cache_dir, key)
+	if not os.path.isfile(os.path.join(entry, "reference.pkl")):
+		return(None)
+
+	with open(os.path.join(entry, "reference.pkl"), "rb") as pkl:
+		coverage_suffix, stk_suffix, reference = pickle.load(pkl)
+	for suffix in reference_suffixes:
+		if os.path.isfile(os.path.join(entry, "reference" + suffix)):
+			shutil.copy(os.path.join(entry, "reference" + suffix), out_dir + experiment_name + suffix)
+	setAlignment(out_dir + experiment_name + stk_suffix)
+
+	log.info("Reference files restored from cache {}".format(entry))
+
+	return((out_dir + experiment_name + coverage_suffix,) + tuple(reference))
+
+def storeReference(cache_dir, key, out_dir, experiment_name, coverage_bed, stkname, reference):
+# save reference files from out_dir and modsToSNPIndex outputs (excluding coverage_bed) to cache entry for key
+# entries are written to a temporary folder and renamed so that concurrent runs never see partial entries
+
+	entry = os.path.join(cache_dir, key)
+	if os.path.isdir(entry):
+		return
+
+	os.makedirs(cache_dir, exist_ok = True)
+	temp_entry = tempfile.mkdtemp(dir = cache_dir, prefix = ".tmp_")
+	for suffix in reference_suffixes:
+		if os.path.isfile(out_dir + experiment_name + suffix):
+			shutil.copy(out_dir + experiment_name + suffix, os.path.join(temp_entry, "reference" + suffix))
+	coverage_suffix = coverage_bed.split(out_dir + experiment_name)[-1]
+	stk_suffix = stkname.split(out_dir + experiment_name)[-1]
+	with open(os.path.join(temp_entry, "reference.pkl"), "wb") as pkl:
+		pickle.dump((coverage_suffix, stk_suffix, reference), pkl)
+
+	publishEntry(temp_entry, entry)
+	log.info("Reference files saved to cache {}".format(entry))
+
+def restoreGSNAPIndices(cache_dir, key, species, experiment_name, out_dir):
+# copy cached GSNAP genome and SNP indices into out_dir
+# index file names contain species and experiment name so indices are cached separately for each combination of these
+# returns None if not cached
+
+	entry = os.path.join(cache_dir, key, "gsnap", species + "__" + experiment_name)
+	if not os.path.isfile(os.path.join(entry, "indices.pkl")):
+		return(None)
+
+	with open(os.path.join(entry, "indices.pkl"), "rb") as pkl:
+		genome_index_name, snp_index_name, snp_index = pickle.load(pkl)
+	genome_index_path = out_dir + species + "_tRNAgenome"
+	snp_index_path = out_dir + species + "snp_index"
+	# replace any existing indices (copytree requires that the target does not exist)
+	shutil.rmtree(genome_index_path, ignore_errors = True)
+	shutil.copytree(os.path.join(entry, "genome"), genome_index_path)
+	if snp_index:
+		shutil.rmtree(snp_index_path, ignore_errors = True)
+		shutil.copytree(os.path.join(entry, "snp"), snp_index_path)
+
+	log.info("GSNAP indices restored from cache {}".format(entry))
+
+	return(genome_index_path, genome_index_name, snp_index_path, snp_index_name)
+
+def storeGSNAPIndices(cache_dir, key, species, experiment_name, genome_index_path, genome_index_name, snp_index_path, snp_index_name):
+# save GSNAP genome and SNP indices for first round of alignment to cache entry for key
+
+	entry = os.path.join(cache_dir, key, "gsnap", species + "__" + experiment_name)
+	if os.path.isdir(entry) or not os.path.isdir(os.path.join(cache_dir, key)):
+		return
+
+	os.makedirs(os.path.dirname(entry), exist_ok = True)
+	temp_entry = tempfile.mkdtemp(dir = os.path.dirname(entry), prefix = ".tmp_")
+	shutil.copytree(genome_index_path, os.path.join(temp_entry, "genome"))
+	snp_index = bool(snp_index_name) and os.path.isdir(snp_index_path)
+	if snp_index:
+		shutil.copytree(snp_index_path, os.path.join(temp_entry, "snp"))
+	with open(os.path.join(temp_entry, "indices.pkl"), "wb") as pkl:
+		pickle.dump((genome_index_name, snp_index_name, snp_index), pkl)
+
+	publishEntry(temp_entry, entry)
+	log.info("GSNAP indices saved to cache {}".format(entry))
+
+def publishEntry(temp_entry, entry):
+# move completed temporary entry into place, discarding it if another run has already published the same entry
+
+	try:
+		os.rename(temp_entry, entry)
+	except OSError:
+		shutil.rmtree(temp_entry, ignore_errors = True)
@@ -0,0 +1,40 @@
+#! /usr/bin/env python3
+
+#################################################################################
+# Read-only reference structures shared with worker processes without pickling #
+#################################################################################
+
+from multiprocessing import Pool
+
+# reference context of the current process, set by the initializer of pool workers (see contextPool)
+context = None
+
+class ReferenceContext(object):
+# immutable bundle of reference structures (e.g. tRNA_dict, mismatch_dict) used by worker processes
+# attributes are set once on construction, workers must only read the structures themselves (use .get on defaultdicts)
+
+	def __init__(self, **structures):
+
+		for name, structure in structures.items():
+			object.__setattr__(self, name, structure)
+
+	def __setattr__(self, name, value):
+
+		raise AttributeError("ReferenceContext is read-only")
+
+def setContext(reference_context):
+
+	global context
+	context = reference_context
+
+def getContext():
+
+	return(context)
+
+def contextPool(reference_context, processes, pool_class = Pool):
+# start a pool whose workers can access reference_context with getContext()
+# the pool initializer sets the context in each worker: with the fork start method initializer arguments are inherited copy-on-write from the parent so nothing is pickled,
+# otherwise (e.g. spawn) the context is pickled once per worker instead of with every task
+# the context of the calling process is left unchanged so that it is released with the pool and later pools cannot see it
+
+	return(pool_class(processes, initializer = setContext, initargs = (reference_context,)))
@@ -0,0 +1,151 @@
+#! /usr/bin/env python3
+
+######################################################################################
+# Greedy clustering of tRNA sequences by identity (in-process alternative to usearch) #
+#    clusters are returned as records in the same form as parsed from usearch .uc    #
+######################################################################################
+
+import re
+import numpy as np
+
+# alignment scores for banded global alignment of member to centroid sequences
+MATCH = 1
+MISMATCH = -1
+GAP = -2
+BAND = 8
+
+# compressed alignments in usearch .uc files are runs of operations with optional lengths (e.g. 30M2D40M), "=" for identical sequences
+uc_re = re.compile('([0-9]*)([MDI])')
+
+def readUC(uc_file):
+# parse usearch .uc file into cluster records (type, member, centroid, alignment)
+# type is "S" for centroids and "H" for members, alignment is None for identical sequences and otherwise a list of (length, op)
+
+	records = list()
+	with open(uc_file, "r") as uc:
+		for line in uc:
+			line = line.strip().split("\t")
+			if line[0] == "S":
+				name = line[8].split(";")[0]
+				records.append(("S", name, name, None))
+			elif line[0] == "H":
+				alignment = None if line[7] == "=" else [(int(length) if length else 1, op) for length, op in uc_re.findall(line[7])]
+				records.append(("H", line[8].split(";")[0], line[9].split(";")[0], alignment))
+
+	return(records)
+
+def alignmentIndels(alignment):
+# positions of insertions (centroid bases missing from member) and deletions (member bases missing from centroid) from alignment records
+# positions are in member coordinates and follow the conventions used to build insert_dict and del_dict in modsToSNPIndex
+
+	pos = 0
+	insertion_pos = list()
+	deletion_pos = list()
+	for length, op in alignment:
+		if op == "M":
+			pos += length
+		elif op == "I":
+			insertion_pos.extend(pos + i for i in range(length))
+		elif op == "D":
+			deletion_pos.extend(range(pos, pos + length))
+			pos += length
+
+	return(insertion_pos, deletion_pos)
+
+def bandedAlignment(query, target):
+# global alignment of query (member) to target (centroid) restricted to a band around the diagonal
+# returns alignment as list of (length, op) with M for aligned bases, D for query bases against a gap and I for target bases against a gap,
+# and identity as matching columns over all alignment columns (i.e. terminal gaps are counted)
+
+	n, m = len(query), len(target)
+	width = abs(n - m) + BAND
+	score = [[None] * (m + 1) for i in range(n + 1)]
+	trace = [[None] * (m + 1) for i in range(n + 1)]
+	score[0][0] = 0
+	for i in range(n + 1):
+		for j in range(max(0, i - width), min(m, i + width) + 1):
+			if i == 0 and j == 0:
+				continue
+			best = None
+			if i > 0 and j > 0 and score[i-1][j-1] is not None:
+				best = (score[i-1][j-1] + (MATCH if query[i-1] == target[j-1] else MISMATCH), "M")
+			if i > 0 and score[i-1][j] is not None and (best is None or score[i-1][j] + GAP > best[0]):
+				best = (score[i-1][j] + GAP, "D")
+			if j > 0 and score[i][j-1] is not None and (best is None or score[i][j-1] + GAP > best[0]):
+				best = (score[i][j-1] + GAP, "I")
+			score[i][j], trace[i][j] = best
+
+	ops = list()
+	matches = 0
+	i, j = n, m
+	while i > 0 or j > 0:
+		op = trace[i][j]
+		if op == "M":
+			matches += query[i-1] == target[j-1]
+			i -= 1
+			j -= 1
+		elif op == "D":
+			i -= 1
+		else:
+			j -= 1
+		ops.append(op)
+	ops.reverse()
+
+	alignment = list()
+	for op in ops:
+		if alignment and alignment[-1][1] == op:
+			alignment[-1][0] += 1
+		else:
+			alignment.append([1, op])
+
+	return([tuple(run) for run in alignment], matches / len(ops))
+
+def greedyCluster(cluster_id, sequences):
+# cluster list of (name, sequence) of one anticodon by identity of at least cluster_id, similar to usearch -cluster_fast -sort length
+# sequences are processed longest first (ties in input order) and assigned to the most similar existing centroid, otherwise they form a new centroid
+# ungapped identity is first computed against all centroids of the same length at once, gapped alignments are only used if there is no ungapped hit
+# returns cluster records (see readUC) and centroid names sorted by cluster size
+
+	records = list()
+	centroids = list()
+	cluster_size = dict()
+	by_length = dict() # centroid length: (list of centroid names, array of encoded centroid sequences)
+	order = sorted(range(len(sequences)), key = lambda i: -len(sequences[i][1]))
+	for i in order:
+		name, seq = sequences[i]
+		seq = seq.upper()
+		encoded = np.frombuffer(seq.encode(), dtype = np.uint8)
+		hit = None
+
+		if len(seq) in by_length:
+			names, encoded_centroids = by_length[len(seq)]
+			identity = (encoded_centroids == encoded).mean(axis = 1)
+			best = int(identity.argmax())
+			if identity[best] >= cluster_id:
+				hit = (names[best], None if identity[best] == 1 else [(len(seq), "M")])
+
+		if not hit:
+			best_identity = 0
+			for centroid, centroid_seq in centroids:
+				# identity cannot exceed ratio of lengths as terminal gaps are counted
+				if min(len(seq), len(centroid_seq)) / max(len(seq), len(centroid_seq)) < cluster_id:
+					continue
+				alignment, identity = bandedAlignment(seq, centroid_seq)
+				if identity >= cluster_id and identity > best_identity:
+					best_identity = identity
+					hit = (centroid, alignment)
+
+		if hit:
+			records.append(("H", name, hit[0], hit[1]))
+			cluster_size[hit[0]] += 1
+		else:
+			records.append(("S", name, name, None))
+			centroids.append((name, seq))
+			cluster_size[name] = 1
+			if len(seq) in by_length:
+				names, encoded_centroids = by_length[len(seq)]
+				by_length[len(seq)] = (names + [name], np.vstack([encoded_centroids, encoded]))
+			else:
+				by_length[len(seq)] = ([name], encoded.reshape(1, -1))
+
+	return(records, sorted(cluster_size, key = lambda centroid: -cluster_size[centroid]))
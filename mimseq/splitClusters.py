@@ -3,12 +3,15 @@
 from __future__ import absolute_import
 import logging
 from collections import defaultdict
-from itertools import chain, combinations as comb
 from .ssAlign import aligntRNA
 from .getCoverage import getBamList
+from .readDecoder import readWeight
+from .tRNAtools import SequenceIndex
+from .referenceContext import ReferenceContext, getContext, contextPool
 import re
-import pybedtools
-from multiprocessing import Pool
+import pysam
+import numpy as np
+import pandas as pd
 from functools import partial
 import pickle
 
@@ -24,11 +27,6 @@ def dd_set():
 def dd():
 	return(defaultdict(list))
 
-def GetPowerset(s):
-#Get the powerset of a given set (all subsets incl. empty and full set).
-    
-    return list(chain(*map(lambda x: comb(s, x), range(0, len(s)+1))))
-
 def reformatInDelDict (dict, newDict, type):
 # Code to reformat insert and delete dictionary information for processing to find unique sites
 
@@ -65,38 +63,57 @@ def natural_keys_list(text):
     
     return(l)
 
-def findUniqueSubset (inputDict, outputDict, tRNA_dict):
+def uniqueSubsets(mismatches, others, max_size = None):
+# find minimal subsets of mismatches (set of mismatches/indels of an isodecoder) that are not a subset of any set in others
+# subsets are searched from small to large, only subsets still shared with another isodecoder are extended as supersets of unique subsets are not minimal
+# each mismatch is represented by a bitmask of the other sets containing it, so a subset is unique if the intersection (AND) of its bitmasks is 0
+# returns unique subsets of the smallest size found, most 3' first, or an empty list if there are none of at most max_size (no limit if None)
+
+    # no subset can be unique if all mismatches are shared with another isodecoder
+    if any(mismatches <= other for other in others):
+        return([])
+
+    # mismatches sorted most 3' first so that combinations are generated in order of preference
+    elements = sorted(mismatches, key = natural_keys, reverse = True)
+    masks = [sum(1 << j for j, other in enumerate(others) if element in other) for element in elements]
+    level = [((), (1 << len(others)) - 1)]
+    for size in range(1, (max_size or len(elements)) + 1):
+        unique = list()
+        next_level = list()
+        for subset, shared in level:
+            for k in range((subset[-1] + 1) if subset else 0, len(elements)):
+                if shared & masks[k]:
+                    next_level.append((subset + (k,), shared & masks[k]))
+                else:
+                    unique.append(tuple(elements[index] for index in subset + (k,)))
+        if unique or not next_level:
+            return(unique)
+        level = next_level
+
+    return([])
+
+def findUniqueSubset (inputDict, outputDict, tRNA_dict, max_size = None):
 # For dictionary of mismatches, insertions and deletions, find unique minimal distinguishing subset of positions and update outputDict
 
     for cluster, data in inputDict.items():
-        powersets  = [GetPowerset(data[s]) for s in data]
         # temp dictionary of all isodecoder unique sets in the case that a subsequenct isodecoder unique set matches a previous one
         temp_uss_dict = defaultdict(list)
         # same for all total set of mismatches in the case that no subsets can be found for previous isodecoders that are unique
         temp_fullset_dict = defaultdict(list)
-        for i in range(0, len(data)):
-            # declare isodecoder name and powerset for current loop iteration (isodecoder)
-            isodecoder, mismatch_powerset = list(data)[i], powersets[i]
-            temp_fullset_dict[isodecoder] = tuple(sorted((max(mismatch_powerset, key=len))))
-            # list the other powersets to compare against
-            ops = [x for ind, x in enumerate(powersets) if ind != i]
-            # find unique subsets: those that are only a subset of the current set
-            # and not found in the powerset of any of the other sets
-            uss = list(set(mismatch_powerset)-set([x for y in ops for x in y if x in mismatch_powerset]))
+        for isodecoder, mismatches in data.items():
+            temp_fullset_dict[isodecoder] = tuple(sorted(mismatches))
+            # find unique subsets: those that are only a subset of the current set and not of the set of any other isodecoder
+            uss = uniqueSubsets(mismatches, [data[other] for other in data if other != isodecoder], max_size)
             # if the unique set is empty it means the the full set of mismatches is also found as some subset in another isodecoder
             # this is ok because this other isodecoder will have this full set subtracted - therefore use the full set as the unique set of mismatches
+            # (the full set is also used if no unique subset of at most max_size exists, it is then still unique)
             if not uss:
-                uss = [(max(mismatch_powerset, key=len))]
-            # filter empty tuples
-            uss = list(filter(None, uss))
-            # sort descending within whole list
-            uss = sorted(uss, key = natural_keys_list, reverse = True)
+                uss = [tuple(mismatches)]
             # sort within individual subsets 
-            for i, s in enumerate(uss):
-                uss[i] = tuple(sorted(s, key=natural_keys))
+            uss = [tuple(sorted(s, key=natural_keys)) for s in uss]
             temp_uss_dict[isodecoder] = uss # add full uss set to temp dict
-            # choose the shortest/minimal unique subset
-            min_uss = tuple(sorted(min(uss, key = len)))
+            # choose the shortest/minimal unique subset (all are the same size, most 3' first)
+            min_uss = tuple(sorted(uss[0]))
             index = 0
             while min_uss in outputDict[cluster].keys(): # if min_uss already in outputDict
                 index += 1
@@ -132,7 +149,7 @@ def findUniqueSubset (inputDict, outputDict, tRNA_dict):
 
     return(outputDict)
 
-def splitIsodecoder(cluster_perPos_mismatchMembers, insert_dict, del_dict, tRNA_dict, cluster_dict, out_dir, experiment_name):
+def splitIsodecoder(cluster_perPos_mismatchMembers, insert_dict, del_dict, tRNA_dict, cluster_dict, out_dir, experiment_name, seq_index = None, max_subset = None):
 # Determine minimal set of most 3' mismatches and/or insertions that characterise an isodecoder
     log.info("\n+------------------------------------------------------------------------------+\
         \n| Characterizing cluster mismatches for read splitting by unique tRNA sequence |\
@@ -169,8 +186,11 @@ def splitIsodecoder(cluster_perPos_mismatchMembers, insert_dict, del_dict, tRNA_
     
     # Build nested dictionary of unique minimal set of mismatches and insertions that distinguish an isodecoder from parent and all others in cluster
     unique_isodecoderMMs = defaultdict(dd)
-    unique_isodecoderMMs = findUniqueSubset(cluster_MemberMismatchPos, unique_isodecoderMMs, tRNA_dict)
+    # max_subset limits the size of subsets searched (see uniqueSubsets), isodecoders without a unique subset of at most this size are split by their full set
+    unique_isodecoderMMs = findUniqueSubset(cluster_MemberMismatchPos, unique_isodecoderMMs, tRNA_dict, max_subset)
     isodecoder_sizes = defaultdict(int)
+    if not seq_index:
+        seq_index = SequenceIndex(tRNA_dict)
 
     # Check that all unique sequences can be deconvoluted
     # count clusters in cluster_dict that are composed of only one sequence and those that are composed of multiple sequences
@@ -191,9 +211,9 @@ def splitIsodecoder(cluster_perPos_mismatchMembers, insert_dict, del_dict, tRNA_
     deconv_names = set()
     for cluster, data in unique_isodecoderMMs.items():
         # count isodecoder sizes
-        isodecoder_sizes[cluster] = len([info['sequence'].upper() for tRNA, info in tRNA_dict.items() if info['sequence'].upper() == tRNA_dict[cluster]['sequence'].upper()])
+        isodecoder_sizes[cluster] = seq_index.size(cluster, ignore_case = True)
         for isodecoder in data.values():
-            isodecoder_sizes[isodecoder[0]] = len([info['sequence'].upper() for tRNA, info in tRNA_dict.items() if info['sequence'].upper() == tRNA_dict[isodecoder[0]]['sequence'].upper()])
+            isodecoder_sizes[isodecoder[0]] = seq_index.size(isodecoder[0], ignore_case = True)
         deconv_sequences_num += 1
         unique_deconv = {member[0] for member in data.values()}
         deconv_sequences_num += len(unique_deconv)
@@ -240,14 +260,43 @@ The following isodecoders were not distinguished uniquely from the cluster paren
 
     return(unique_isodecoderMMs, splitBool, isodecoder_sizes)
 
-def covCheck_mp(bedTool, unique_isodecoderMMs, covDiff, input):
+def bedCoverage(coverageBed, input, collapsed = False):
+    # per-base coverage of each interval in coverageBed by reads in input on the same strand (as bedtools coverage -s -d)
+    # each alignment counts with the number of reads it represents if reads were collapsed before alignment (see readDecoder.readWeight)
+    # returns data frame with interval name, 1-based position in interval (thickStart) and coverage (thickEnd)
+
+    weight = readWeight(collapsed)
+    names = list()
+    positions = list()
+    coverage = list()
+    bam = pysam.AlignmentFile(input, "rb")
+    with open(coverageBed, "r") as bed:
+        for line in bed:
+            chrom, start, end, name, score, strand = line.strip().split("\t")[:6]
+            start, end = int(start), int(end)
+            cov_diff = np.zeros(end - start + 1, dtype = np.int64)
+            if chrom in bam.references:
+                for read in bam.fetch(chrom, start, end):
+                    if read.is_unmapped or read.is_reverse != (strand == "-"):
+                        continue
+                    count = weight(read.query_name)
+                    cov_diff[max(read.reference_start, start) - start] += count
+                    cov_diff[min(read.reference_end, end) - start] -= count
+            names.extend([name] * (end - start))
+            positions.extend(range(1, end - start + 1))
+            coverage.extend(np.cumsum(cov_diff)[:-1])
+    bam.close()
+
+    return(pd.DataFrame({'name':names, 'thickStart':positions, 'thickEnd':coverage}))
+
+def covCheck_mp(coverageBed, covDiff, collapsed, input):
     # get positional coverage per cluster per bam file and check if 3':5' coverage is greater than covDiff
+    # unique_isodecoderMMs is read from the shared reference context (see unsplitClusters)
+    unique_isodecoderMMs = getContext().unique_isodecoderMMs
     unsplit = set()
     unsplit_isosOnly = set()
     log.info("Calculating nucleotide coverage for {}".format(input))
-    bam = pybedtools.BedTool(input)
-    cov = bedTool.coverage(bam, s = True, d = True)
-    cov_df = cov.to_dataframe()
+    cov_df = bedCoverage(coverageBed, input, collapsed)
 
     # check coverage diff for each unique sequence in each cluster
     for cluster in unique_isodecoderMMs.keys():
@@ -271,7 +320,7 @@ def covCheck_mp(bedTool, unique_isodecoderMMs, covDiff, input):
 
     return(unsplit, unsplit_isosOnly)
 
-def unsplitClusters(coverageData, coverageBed, unique_isodecoderMMs, threads, covDiff = 0.5):
+def unsplitClusters(coverageData, coverageBed, unique_isodecoderMMs, threads, covDiff = 0.5, collapse_reads = False):
     # Define unique sequences not able to be split based on significant drop in coverage before distinguishing mismatch
    
     log.info("\n+---------------------------------------------------------------------------------+\
@@ -288,9 +337,8 @@ def unsplitClusters(coverageData, coverageBed, unique_isodecoderMMs, threads, co
 
     # initiate custom non-daemonic multiprocessing pool and run with bam names
     log.info("Determining unsplittable sequences...")
-    pool = Pool(multi)
-    bed = pybedtools.BedTool(coverageBed)
-    func = partial(covCheck_mp, bed, unique_isodecoderMMs, covDiff)
+    pool = contextPool(ReferenceContext(unique_isodecoderMMs = unique_isodecoderMMs), multi)
+    func = partial(covCheck_mp, coverageBed, covDiff, collapse_reads)
     unsplit, unsplit_isosOnly = zip(*pool.map(func, bamlist))
     pool.close()
     pool.join()
@@ -311,14 +359,16 @@ def writeIsodecoderTranscripts(out_dir, experiment_name, cluster_dict, tRNA_dict
 			tempSeqs.write(">" + shortname + "\n" + tRNA_dict[seq]['sequence'] + "\n")
 	aligntRNA(tempSeqs.name, out_dir)
 
-def getIsodecoderSizes(out_dir, experiment_name, tRNAdict):
+def getIsodecoderSizes(out_dir, experiment_name, tRNAdict, seq_index = None):
 	# get isodecoder sizes for tRNA sequences - useful for when clustering is disabled and above function is not applicable
 
+	if not seq_index:
+		seq_index = SequenceIndex(tRNAdict)
 	isodecoder_sizes = defaultdict(int)
 	already_added = set()
 	for tRNA in tRNAdict:
 		if tRNA not in already_added:
-			sameSeq = [tRNAs for tRNAs, data in tRNAdict.items() if data['sequence'] == tRNAdict[tRNA]['sequence']]
+			sameSeq = seq_index.members(tRNA)
 			already_added.update(sameSeq)
 			isodecoder_sizes[tRNA] = len(sameSeq)
 
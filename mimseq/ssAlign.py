@@ -2,221 +2,399 @@
 
 ## Mature tRNA cluster alignments and secondary structure parsing
 
-import subprocess, os, re
+import subprocess, os, re, copy
 from Bio import AlignIO
 from collections import defaultdict, Counter
 from itertools import groupby
 from operator import itemgetter
 
 stkname = ''
+# parsed alignments (see getStructureModel) keyed by Stockholm file name and modification time
+structure_models = dict()
 
-def aligntRNA(tRNAseqs, out):
-# run cmalign to generate Stockholm file for tRNA sequences
-	global stkname
-	stkname = tRNAseqs.split(".fa")[0] + '_align.stk'
-	cmfile = os.path.dirname(os.path.realpath(__file__)) + '/data/tRNAmatureseq.cm'
-	cmcommand = ['cmalign', '-o', stkname, '--nonbanded', '-g', cmfile, tRNAseqs]
-	subprocess.check_call(cmcommand, stdout = open(out + 'cm.log', 'w'))
+class TRNAStructureModel(object):
+# Stockholm alignment of tRNAs parsed once, with structure, canonical numbering and anticodon positions computed on first use and cached
+# only plain dictionaries and strings are stored so that models can be passed to worker processes
+# cached results are shared between callers and should not be modified (the module level functions below return copies)
 
-def extraCCA():
-	# look for extra CCA's added spuriously that fall outside of canonical tRNA structure
-	# Seems to be a problem in certain sequences in mouse - either an artifact from gtRNAdb or tRNAScan, or CCA is genomically encoded for these tRNAs?
-	extra_cca = list()
-	stk = AlignIO.read(stkname, "stockholm")
-	for record in stk:
-		if record.seq[-3:] == 'cca': #lowercase here indicates alignment issue to other clusters
-			extra_cca.append(record.name)
+	def __init__(self, stk):
 
-	os.remove(stkname)
+		self.stkname = stk
+		self.records = {record.id: str(record.seq) for record in AlignIO.read(stk, "stockholm")}
+		ss_cons = list()
+		rf_cons = list()
+		with open(stk) as stkfile:
+			for line in stkfile:
+				if line.startswith("#=GC SS_cons"):
+					ss_cons.append(line.split()[-1])
+				elif line.startswith("#=GC RF"):
+					rf_cons.append(line.split()[-1])
+		self.ss_cons = "".join(ss_cons)
+		self.rf_cons = "".join(rf_cons)
+		self.cache = dict()
 
-	return(extra_cca)
+	def cached(self, key, func, *args):
+	# compute and store result of func the first time key is requested
 
-def tRNAclassifier(ungapped = False):
+		if not key in self.cache:
+			self.cache[key] = func(*args)
 
-	struct_dict = structureParser()
-	stk = AlignIO.read(stkname, "stockholm")
-
-	# Get canonical tRNA position numbering (cons_pos_list). Useful to retain cononical numbering of tRNA positions (i.e. anticodon at 34 - 36, m1A 58 etc...)
-	# Return list of characters with pos or '-'. To be used in all plots with positional data such as heatmaps for stops or modifications.
-	# cons_pos_dict is a dictionary of 1 based positions and canonical positions to create extra column in mods tables (mismatchTable and RTstopTable) mapping ungapped positions to canonical ones
-	ss_cons = "".join([line.split()[-1] for line in open(stkname) if line.startswith("#=GC SS_cons")])
-	if ungapped:
-		ss_cons_orig = ss_cons
-		ss_cons = ss_cons.replace(".", "")
-	cons_pos = 0
-	cons_pos_list = list()
-	cons_pos_dict = defaultdict()
-	openstem_count = 0
-	closestem_count = 0
-	enum = 0
-	for pos, char in enumerate(ss_cons):
-		if not ss_cons[pos] == ".":
-			if cons_pos < 46:
-				if (not cons_pos == 17) and (not cons_pos == 20):
-					cons_pos_list.append(str(cons_pos))
-					cons_pos_dict[pos+1] = str(cons_pos)
-					cons_pos += 1
-				elif (cons_pos == 17) and not ('17' in cons_pos_list):
-					cons_pos_dict[pos+1] = '17'
-					cons_pos_list.append('17')
-				elif (cons_pos == 17) and ('17' in cons_pos_list):
-					cons_pos_dict[pos+1] = '17a'
-					cons_pos_list.append('17a')
-					cons_pos += 1
+		return(self.cache[key])
+
+	def structure(self):
+	# structural region for each (1-based) position in gapped alignment
+
+		return(self.cached('structure', self._parseStructure))
+
+	def classifier(self, ungapped = False):
+	# tRNA_struct, tRNA_ungap2canon, cons_pos_list and cons_pos_dict (see tRNAclassifier)
+
+		return(self.cached(('classifier', ungapped), self._classify, ungapped))
 
-				elif cons_pos == 20: 
-					if not '20' in cons_pos_list:
-						cons_pos_dict[pos+1] = '20'
-						cons_pos_list.append('20')
-					elif not '20a' in cons_pos_list:
-						cons_pos_dict[pos+1] = '20a'
-						cons_pos_list.append('20a')
-					elif not '20b' in cons_pos_list:
-						cons_pos_dict[pos+1] = '20b'
-						cons_pos_list.append('20b')
+	def classifierNoGaps(self, oneBased = False):
+	# structural region for each ungapped position of each tRNA (see tRNAclassifier_nogaps)
+
+		return(self.cached(('classifier_nogaps', oneBased), self._classifyNoGaps, oneBased))
+
+	def anticodon(self, oneBased = False):
+	# anticodon positions from conserved alignment, using '*' in RF line to delimit the anticodon positions
+
+		return(self.cached(('anticodon', oneBased), self._anticodon, oneBased))
+
+	def clusterAnticodon(self, cons_anticodon, cluster):
+	# anticodon position without gaps for specific cluster
+
+		return(self.cached(('cluster_anticodon', tuple(cons_anticodon), cluster), self._clusterAnticodon, cons_anticodon, cluster))
+
+	def _anticodon(self, oneBased):
+
+		anticodon = list()
+		for pos, char in enumerate(self.rf_cons, int(oneBased)):
+			if char == "*":
+				anticodon.append(pos)
+
+		return(anticodon)
+
+	def _clusterAnticodon(self, cons_anticodon, cluster):
+
+		bases = ["A", "C", "G", "U"]
+		cluster_anticodon = list()
+		if cluster in self.records:
+			seq = self.records[cluster]
+			for pos in cons_anticodon:
+				gapcount = 0
+				for char in seq[:pos]:
+					if char.upper() not in bases:
+						gapcount += 1
+				cluster_anticodon.append(pos - gapcount)
+
+		return(cluster_anticodon)
+
+	def _classify(self, ungapped):
+
+		struct_dict = self.structure()
+
+		# Get canonical tRNA position numbering (cons_pos_list). Useful to retain cononical numbering of tRNA positions (i.e. anticodon at 34 - 36, m1A 58 etc...)
+		# Return list of characters with pos or '-'. To be used in all plots with positional data such as heatmaps for stops or modifications.
+		# cons_pos_dict is a dictionary of 1 based positions and canonical positions to create extra column in mods tables (mismatchTable and RTstopTable) mapping ungapped positions to canonical ones
+		ss_cons = self.ss_cons
+		if ungapped:
+			ss_cons_orig = ss_cons
+			ss_cons = ss_cons.replace(".", "")
+		cons_pos = 0
+		cons_pos_list = list()
+		cons_pos_dict = defaultdict()
+		openstem_count = 0
+		closestem_count = 0
+		enum = 0
+		for pos, char in enumerate(ss_cons):
+			if not ss_cons[pos] == ".":
+				if cons_pos < 46:
+					if (not cons_pos == 17) and (not cons_pos == 20):
+						cons_pos_list.append(str(cons_pos))
+						cons_pos_dict[pos+1] = str(cons_pos)
+						cons_pos += 1
+					elif (cons_pos == 17) and not ('17' in cons_pos_list):
+						cons_pos_dict[pos+1] = '17'
+						cons_pos_list.append('17')
+					elif (cons_pos == 17) and ('17' in cons_pos_list):
+						cons_pos_dict[pos+1] = '17a'
+						cons_pos_list.append('17a')
+						cons_pos += 1
+
+					elif cons_pos == 20: 
+						if not '20' in cons_pos_list:
+							cons_pos_dict[pos+1] = '20'
+							cons_pos_list.append('20')
+						elif not '20a' in cons_pos_list:
+							cons_pos_dict[pos+1] = '20a'
+							cons_pos_list.append('20a')
+						elif not '20b' in cons_pos_list:
+							cons_pos_dict[pos+1] = '20b'
+							cons_pos_list.append('20b')
+							cons_pos += 1
+
+				elif cons_pos == 46:
+					if (not closestem_count == openstem_count) or (closestem_count == 0 or openstem_count == 0):
+						if ss_cons[pos] == "<":
+							openstem_count += 1
+							enum += 1
+							current_e = "e" + str(enum)
+							cons_pos_dict[pos+1] = current_e
+							cons_pos_list.append(current_e)
+						elif ss_cons[pos] == ">":
+							closestem_count += 1
+							enum += 1
+							current_e = "e" + str(enum)
+							cons_pos_dict[pos+1] = current_e
+							cons_pos_list.append(current_e)
+						elif ss_cons[pos] == "_":
+							enum += 1
+							current_e = "e" + str(enum)
+							cons_pos_dict[pos+1] = current_e
+							cons_pos_list.append(current_e)
+
+					elif (closestem_count == openstem_count) and (not closestem_count == 0 or not openstem_count == 0):
+						cons_pos_dict[pos+1] = str(cons_pos)
+						cons_pos_list.append(str(cons_pos))
 						cons_pos += 1
 
-			elif cons_pos == 46:
-				if (not closestem_count == openstem_count) or (closestem_count == 0 or openstem_count == 0):
-					if ss_cons[pos] == "<":
-						openstem_count += 1
-						enum += 1
-						current_e = "e" + str(enum)
-						cons_pos_dict[pos+1] = current_e
-						cons_pos_list.append(current_e)
-					elif ss_cons[pos] == ">":
-						closestem_count += 1
-						enum += 1
-						current_e = "e" + str(enum)
-						cons_pos_dict[pos+1] = current_e
-						cons_pos_list.append(current_e)
-					elif ss_cons[pos] == "_":
-						enum += 1
-						current_e = "e" + str(enum)
-						cons_pos_dict[pos+1] = current_e
-						cons_pos_list.append(current_e)
-
-				elif (closestem_count == openstem_count) and (not closestem_count == 0 or not openstem_count == 0):
+				elif cons_pos > 46:
 					cons_pos_dict[pos+1] = str(cons_pos)
 					cons_pos_list.append(str(cons_pos))
 					cons_pos += 1
 
-			elif cons_pos > 46:
-				cons_pos_dict[pos+1] = str(cons_pos)
-				cons_pos_list.append(str(cons_pos))
-				cons_pos += 1
+			elif ss_cons[pos] == ".":
+				cons_pos_dict[pos+1] = '-'
+				#cons_pos_list.append("-")
+
+		cons_pos_list = "_".join(cons_pos_list)
+
+		# Loop thorugh every tRNA in alignment and create dictionary entry for pos-structure and pos-canonpos information (1-based to match to mismatchTable from mmQuant)
+		tRNA_struct = defaultdict(dict)
+		tRNA_ungap2canon = defaultdict(dict)
+
+		for tRNA, seq in self.records.items():
+			ungapped_pos = 0
+			bases = ["A", "C", "G", "U"]
+
+			if not ungapped:
+				for i, letter in enumerate(seq, 1):
+					if letter.upper() in bases:
+						tRNA_ungap2canon[tRNA][ungapped_pos] = cons_pos_dict[i]
+						ungapped_pos += 1
+						tRNA_struct[tRNA][i] = struct_dict[i]
+					else:
+						tRNA_struct[tRNA][i] = 'gap'
+			elif ungapped:
+				n = 0
+				for i, letter in enumerate(seq,1):
+					if letter.upper() in bases:
+						n += 1
+						try:
+							tRNA_ungap2canon[tRNA][ungapped_pos] = cons_pos_dict[n]
+						except KeyError:
+							break
+						tRNA_struct[tRNA][n] = struct_dict[i]
+						ungapped_pos += 1
+					elif letter == "-" and ss_cons_orig[i-1] != ".":
+						n += 1
+						tRNA_struct[tRNA][n] = 'gap'
+						#tRNA_ungap2canon[tRNA][ungapped_pos] = cons_pos_dict[n]
+						#ungapped_pos += 1
+
+		return(tRNA_struct, tRNA_ungap2canon, cons_pos_list, cons_pos_dict)
+
+	def _classifyNoGaps(self, oneBased):
+
+		struct_dict = self.structure()
+		tRNA_struct = defaultdict(dict)
+
+		# Loop thorugh every tRNA in alignment and create dictionary entry for pos - structure information (1-based to match to mismatchTable from mmQuant)
+		for tRNA, seq in self.records.items():
+			pos = 0
+			bases = ["A", "C", "G", "U"]
+
+			for i, letter in enumerate(seq):
+				if letter.upper() in bases:
+					if oneBased:
+						tRNA_struct[tRNA][pos+1] = struct_dict[i+1]
+					else:
+						tRNA_struct[tRNA][pos] = struct_dict[i+1]
+					pos += 1
+
+		return(tRNA_struct)
 
-		elif ss_cons[pos] == ".":
-			cons_pos_dict[pos+1] = '-'
-			#cons_pos_list.append("-")
+	def _parseStructure(self):
+	# define structural regions for each tRNA input from conserved structure
+	
+		struct_dict = dict()
+		# get conserved tRNA structure from alignment
+		ss_cons = self.ss_cons
+
+		acc = defaultdict()
+
+		term = defaultdict()
+		term_type = "5'"
+
+		bulge_list = []
+		bulge_items = []
+		bulge_count = 0
+
+		stemloops = defaultdict()
+		stemloops_count = 0
+		stemloops_type = ['D stem-loop','Anticodon stem-loop','Variable loop','T stem-loop']
+		open_count = 0
+		close_count = 0
+
+		for pos, char in enumerate(ss_cons):
+			# terminal ends
+			if char == ':':
+				if pos < 10:
+					term[pos+1] = term_type
+				else:
+					term_type = "3'"
+					term[pos+1] = term_type
+
+			# Acceptor stem
+			if char == '(':
+				acc[pos+1] = "Acceptor stem 5'"
+
+			if char == ')':
+				acc[pos+1] = "Acceptor stem 3'"
+
+			# Internal stem loops
+			if char == "<":
+				open_count += 1
+				stemloops[pos+1] = stemloops_type[stemloops_count]
+			if char == ">":
+				close_count +=1
+				stemloops[pos+1] = stemloops_type[stemloops_count]
+				if close_count == open_count: # when the stems on either side have equal base pairs...
+					stemloops_count += 1
+					open_count = 0
+					close_count = 0
+
+		# create full ranges for acceptor stem
+		for i in ["Acceptor stem 5'","Acceptor stem 3'"]:
+			pos_list = [k for k, v in acc.items() if v == i]
+			start = min(pos_list)
+			stop = max(pos_list)
+			acc.update([(n, i) for n in range(start, stop +1)])
+
+		# create full ranges for stem loops
+		for i in stemloops_type:
+			pos_list = [k for k, v in stemloops.items() if v == i]
+			start = min(pos_list)
+			stop = max(pos_list)
+			stemloops.update([(n, i) for n in range(start,stop+1)])
+
+		# combine all into one dict
+		struct_dict = {**term, **acc}
+		struct_dict.update(stemloops)
+
+		# bulges classification - i.e. everyhting that isn't already classified as a strucutral element
+		for pos, char in enumerate(ss_cons):
+			if (pos+1) not in [x for x in struct_dict.keys()]:
+				bulge_list.append(pos+1)
+
+		# separate bulges into distinct lists based on consecutive positions
+		for k, g in groupby(enumerate(bulge_list), lambda x:x[0] - x[1]):
+			group = map(itemgetter(1), g)
+			group = list(map(int,group))
+			bulge_items.append(group)
+
+		# add bulges to struct_dict with naming
+		for bulge in bulge_items:
+			bulge_count += 1
+			# bulges 3 and 4 form part of the variable loop
+			if bulge_count == 3 or bulge_count == 4:
+				for pos in bulge:
+					struct_dict[pos] = 'Variable loop'
+			# everything else is a bulge
+			elif bulge_count == 5:
+				for pos in bulge:
+					struct_dict[pos] = 'bulge3' # set bulge 5 to bulge 3 because of variable loop bulges above
+			else:
+				for pos in bulge:
+					struct_dict[pos] = 'bulge' + str(bulge_count)
 
-	cons_pos_list = "_".join(cons_pos_list)
+		return(struct_dict)
 
-	# Loop thorugh every tRNA in alignment and create dictionary entry for pos-structure and pos-canonpos information (1-based to match to mismatchTable from mmQuant)
-	tRNA_struct = defaultdict(dict)
-	tRNA_ungap2canon = defaultdict(dict)
+def setAlignment(stk):
+# set Stockholm alignment used by module level functions (e.g. when resuming from an existing alignment)
 
-	for record in stk:
-		tRNA = record.id
-		seq = record.seq
-		ungapped_pos = 0
-		bases = ["A", "C", "G", "U"]
+	global stkname
+	stkname = stk
 
-		if not ungapped:
-			for i, letter in enumerate(seq, 1):
-				if letter.upper() in bases:
-					tRNA_ungap2canon[tRNA][ungapped_pos] = cons_pos_dict[i]
-					ungapped_pos += 1
-					tRNA_struct[tRNA][i] = struct_dict[i]
-				else:
-					tRNA_struct[tRNA][i] = 'gap'
-		elif ungapped:
-			n = 0
-			for i, letter in enumerate(seq,1):
-				if letter.upper() in bases:
-					n += 1
-					try:
-						tRNA_ungap2canon[tRNA][ungapped_pos] = cons_pos_dict[n]
-					except KeyError:
-						break
-					tRNA_struct[tRNA][n] = struct_dict[i]
-					ungapped_pos += 1
-				elif letter == "-" and ss_cons_orig[i-1] != ".":
-					n += 1
-					tRNA_struct[tRNA][n] = 'gap'
-					#tRNA_ungap2canon[tRNA][ungapped_pos] = cons_pos_dict[n]
-					#ungapped_pos += 1
-
-	return(tRNA_struct, tRNA_ungap2canon, cons_pos_list, cons_pos_dict)
+def clearStructureModel(stk):
+# remove cached model for a Stockholm file that has been rewritten or deleted
 
-def tRNAclassifier_nogaps(oneBased = False):
+	for key in [key for key in structure_models.keys() if key[0] == stk]:
+		del structure_models[key]
 
-	struct_dict = structureParser()
-	tRNA_struct = defaultdict(dict)
+def getStructureModel(stk = None):
+# return parsed alignment for stk (current alignment if not given), only parsing the Stockholm file again if it has changed
 
-	# Loop thorugh every tRNA in alignment and create dictionary entry for pos - structure information (1-based to match to mismatchTable from mmQuant)
-	stk = AlignIO.read(stkname, "stockholm")
-	for record in stk:
-		tRNA = record.id
-		seq = record.seq
-		pos = 0
-		bases = ["A", "C", "G", "U"]
+	if stk is None:
+		stk = stkname
+	key = (stk, os.stat(stk).st_mtime_ns)
+	if not key in structure_models:
+		clearStructureModel(stk)
+		structure_models[key] = TRNAStructureModel(stk)
 
-		for i, letter in enumerate(seq):
-			if letter.upper() in bases:
-				if oneBased:
-					tRNA_struct[tRNA][pos+1] = struct_dict[i+1]
-				else:
-					tRNA_struct[tRNA][pos] = struct_dict[i+1]
-				pos += 1
+	return(structure_models[key])
+
+def aligntRNA(tRNAseqs, out):
+# run cmalign to generate Stockholm file for tRNA sequences
+	global stkname
+	stkname = tRNAseqs.split(".fa")[0] + '_align.stk'
+	clearStructureModel(stkname)
+	cmfile = os.path.dirname(os.path.realpath(__file__)) + '/data/tRNAmatureseq.cm'
+	cmcommand = ['cmalign', '-o', stkname, '--nonbanded', '-g', cmfile, tRNAseqs]
+	subprocess.check_call(cmcommand, stdout = open(out + 'cm.log', 'w'))
+
+def extraCCA():
+	# look for extra CCA's added spuriously that fall outside of canonical tRNA structure
+	# Seems to be a problem in certain sequences in mouse - either an artifact from gtRNAdb or tRNAScan, or CCA is genomically encoded for these tRNAs?
+	extra_cca = list()
+	for name, seq in getStructureModel().records.items():
+		if seq[-3:] == 'cca': #lowercase here indicates alignment issue to other clusters
+			extra_cca.append(name)
+
+	clearStructureModel(stkname)
+	os.remove(stkname)
+
+	return(extra_cca)
+
+def tRNAclassifier(ungapped = False):
+
+	return(copy.deepcopy(getStructureModel().classifier(ungapped)))
+
+def tRNAclassifier_nogaps(oneBased = False):
 
-	return(tRNA_struct)
+	return(copy.deepcopy(getStructureModel().classifierNoGaps(oneBased)))
 
 def getAnticodon():
 	# return anticodon position from conserved alignment
 
-	anticodon = list()
-	rf_cons = "".join([line.split()[-1] for line in open(stkname) if line.startswith("#=GC RF")])
-	# use '*' in rf_cons from stk to delimit the anticodon positions
-	for pos, char in enumerate(rf_cons):
-	 	if char == "*":
-	 		anticodon.append(pos)
-
-	return(anticodon)
+	return(list(getStructureModel().anticodon()))
 
 def getAnticodon_1base():
 	# return anticodon position from conserved alignment in 1-based positions - specifically for modContext()
 
-	anticodon = list()
-	rf_cons = "".join([line.split()[-1] for line in open(stkname) if line.startswith("#=GC RF")])
-	# use '*' in rf_cons from stk to delimit the anticodon positions
-	for pos, char in enumerate(rf_cons, 1):
-	 	if char == "*":
-	 		anticodon.append(pos)
-
-	return(anticodon)
+	return(list(getStructureModel().anticodon(oneBased = True)))
 
 def clusterAnticodon(cons_anticodon, cluster):
 	# return anticodon position without gaps for specific cluster
 
-	bases = ["A", "C", "G", "U"]
-	stk = AlignIO.read(stkname, "stockholm")
-	cluster_anticodon = list()
-	for record in stk:
-		if record.id == cluster:
-			for pos in cons_anticodon:
-				gapcount = 0
-				for char in record.seq[:pos]:
-					if char.upper() not in bases:
-						gapcount += 1
-				cluster_anticodon.append(pos - gapcount)
-
-	return(cluster_anticodon)
+	return(list(getStructureModel().clusterAnticodon(cons_anticodon, cluster)))
 
 def modContext(out):
 # outputs file of defined mods of interest pos, identity and context sequence for each cluster
 
-	cons_pos_list, cons_pos_dict = tRNAclassifier()[2:4]
+	model = getStructureModel()
+	cons_pos_list, cons_pos_dict = model.classifier()[2:4]
 	#anticodon = getAnticodon_1base()
 
 	# Define positions of conserved mod sites in gapped alignment for each tRNA
@@ -228,10 +406,7 @@ def modContext(out):
 
 	upstream_dict = defaultdict(lambda: defaultdict(list))
 
-	stk = AlignIO.read(stkname, "stockholm") 
-	for record in stk:
-		gene = record.id
-		seq = record.seq
+	for gene, seq in model.records.items():
 		for pos in sites_dict.values():
 			identity = seq[pos-1] # identity of base at modification position
 			if identity in ['A','C','G','U','T']:
@@ -266,96 +441,5 @@ def modContext(out):
 
 def structureParser():
 # read in stk file generated above and define structural regions for each tRNA input
-	
-	struct_dict = dict()
-	# get conserved tRNA structure from alignment
-	ss_cons = "".join([line.split()[-1] for line in open(stkname) if line.startswith("#=GC SS_cons")])
-
-	acc = defaultdict()
-
-	term = defaultdict()
-	term_type = "5'"
-
-	bulge_list = []
-	bulge_items = []
-	bulge_count = 0
-
-	stemloops = defaultdict()
-	stemloops_count = 0
-	stemloops_type = ['D stem-loop','Anticodon stem-loop','Variable loop','T stem-loop']
-	open_count = 0
-	close_count = 0
-
-	for pos, char in enumerate(ss_cons):
-		# terminal ends
-		if char == ':':
-			if pos < 10:
-				term[pos+1] = term_type
-			else:
-				term_type = "3'"
-				term[pos+1] = term_type
-
-		# Acceptor stem
-		if char == '(':
-			acc[pos+1] = "Acceptor stem 5'"
-
-		if char == ')':
-			acc[pos+1] = "Acceptor stem 3'"
-
-		# Internal stem loops
-		if char == "<":
-			open_count += 1
-			stemloops[pos+1] = stemloops_type[stemloops_count]
-		if char == ">":
-			close_count +=1
-			stemloops[pos+1] = stemloops_type[stemloops_count]
-			if close_count == open_count: # when the stems on either side have equal base pairs...
-				stemloops_count += 1
-				open_count = 0
-				close_count = 0
-
-	# create full ranges for acceptor stem
-	for i in ["Acceptor stem 5'","Acceptor stem 3'"]:
-		pos_list = [k for k, v in acc.items() if v == i]
-		start = min(pos_list)
-		stop = max(pos_list)
-		acc.update([(n, i) for n in range(start, stop +1)])
-
-	# create full ranges for stem loops
-	for i in stemloops_type:
-		pos_list = [k for k, v in stemloops.items() if v == i]
-		start = min(pos_list)
-		stop = max(pos_list)
-		stemloops.update([(n, i) for n in range(start,stop+1)])
-
-	# combine all into one dict
-	struct_dict = {**term, **acc}
-	struct_dict.update(stemloops)
-
-	# bulges classification - i.e. everyhting that isn't already classified as a strucutral element
-	for pos, char in enumerate(ss_cons):
-		if (pos+1) not in [x for x in struct_dict.keys()]:
-			bulge_list.append(pos+1)
-
-	# separate bulges into distinct lists based on consecutive positions
-	for k, g in groupby(enumerate(bulge_list), lambda x:x[0] - x[1]):
-		group = map(itemgetter(1), g)
-		group = list(map(int,group))
-		bulge_items.append(group)
-
-	# add bulges to struct_dict with naming
-	for bulge in bulge_items:
-		bulge_count += 1
-		# bulges 3 and 4 form part of the variable loop
-		if bulge_count == 3 or bulge_count == 4:
-			for pos in bulge:
-				struct_dict[pos] = 'Variable loop'
-		# everything else is a bulge
-		elif bulge_count == 5:
-			for pos in bulge:
-				struct_dict[pos] = 'bulge3' # set bulge 5 to bulge 3 because of variable loop bulges above
-		else:
-			for pos in bulge:
-				struct_dict[pos] = 'bulge' + str(bulge_count)
-
-	return(struct_dict)
+
+	return(dict(getStructureModel().structure()))
@@ -4,22 +4,52 @@
 # Wrapper functions for read aligmnent and placement #
 ######################################################
 
-import subprocess, os, re, logging, copy
-from pybedtools import BedTool
+import subprocess, os, re, logging, shutil, threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import pysam
 from collections import defaultdict
-from pathlib import Path
-import glob
 import pandas as pd
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt 
 import seaborn as sns
+from .fastqCollapse import collapseFastq
+from .readDecoder import readWeight
 
 log = logging.getLogger(__name__)
 
+class ThreadBudget(object):
+# shared budget of processor threads for concurrently running gsnap and samtools jobs of different samples
+# reserve() blocks until at least minimum threads are free and grants up to requested threads
+
+	def __init__(self, total):
+
+		self.total = max(1, total)
+		self.free = self.total
+		self.condition = threading.Condition()
+
+	@contextmanager
+	def reserve(self, requested, minimum = 1):
+
+		requested = max(1, min(requested, self.total))
+		minimum = max(1, min(minimum, requested))
+		with self.condition:
+			while self.free < minimum:
+				self.condition.wait()
+			granted = min(requested, self.free)
+			self.free -= granted
+		try:
+			yield granted
+		finally:
+			with self.condition:
+				self.free += granted
+				self.condition.notify_all()
+
 def mainAlign(sampleData, experiment_name, genome_index_path, genome_index_name, snp_index_path, \
-	snp_index_name, out_dir, threads, snp_tolerance, keep_temp, mismatches, map_round):
+	snp_index_name, out_dir, threads, snp_tolerance, keep_temp, mismatches, map_round, collapse_reads = False, remap = False, remap_plan = None):
+# align all samples in sampleData
+# multi-mapping and unmapped reads are kept for realignment if remap (or keep_temp), and if remap_plan is given in map_round 2 only these are realigned along with reads aligned to affected clusters (see remapReads)
 
 	if map_round == 2:
 		log.info("\n+------------------+ \
@@ -32,34 +62,41 @@ def mainAlign(sampleData, experiment_name, genome_index_path, genome_index_name,
 			\n+-----------+")
 
 	# Read sampleData 
-	unique_bam_list = list()
-	alignstats_total = defaultdict(list)
+	samples = list()
 	coverageData = open(out_dir + sampleData.split("/")[-1].split(".")[0] + "_cov." + sampleData.split(".")[-1], "w")
 	with open(sampleData, "r") as sampleData:
 		for line in sampleData:
 			line = line.strip()
 			if not line.startswith("#"):
-				log.info("**** {} ****".format(line.split("\t")[0].split("/")[-1]))
 				fq = line.split("\t")[0]
 				group = line.split("\t")[1]
+				samples.append((fq, group))
+
+	# align samples concurrently, sharing threads between gsnap and samtools jobs of all samples so that post-processing of one sample overlaps alignment of the next
+	# results are collected in sample order so that coverage data and mapping stats are always written in the order of the sample data file
+	budget = ThreadBudget(threads) if len(samples) > 1 else None
+	with ThreadPoolExecutor(max_workers = max(1, min(len(samples), threads))) as executor:
+		if map_round == 2 and remap_plan is not None:
+			alignments = [executor.submit(remapReads, fq, genome_index_path, genome_index_name, snp_index_path, snp_index_name, threads, out_dir, snp_tolerance, keep_temp, mismatches, remap_plan, budget, collapse_reads) \
+				for fq, group in samples]
+		else:
+			alignments = [executor.submit(mapReads, fq, genome_index_path, genome_index_name, snp_index_path, snp_index_name, threads, out_dir, snp_tolerance, keep_temp, mismatches, remap, budget, collapse_reads) \
+				for fq, group in samples]
+		results = [alignment.result() for alignment in alignments]
 
-				# align
-				if map_round == 1:
-					unique_bam, librarySize, alignstats = mapReads(fq, genome_index_path, genome_index_name, snp_index_path, snp_index_name, threads, out_dir, snp_tolerance, keep_temp, mismatches, remap)
-				elif map_round == 2:
-					with open(out_dir + "mapping_stats.txt","a") as stats_out:
-						stats_out.write("** NEW ALIGNMENT **\n\n")
-					unique_bam, librarySize, alignstats = mapReads(fq, genome_index_path, genome_index_name, snp_index_path, snp_index_name, threads, out_dir, snp_tolerance, keep_temp, mismatches, remap)
-				
-				unique_bam_list.append(unique_bam)
-				coverageData.write(unique_bam + "\t" + group + "\t" + str(librarySize) + "\n")
-
-				if len(alignstats_total) == 0:
-					alignstats_total = copy.deepcopy(alignstats)
-				else:
-					for key, value in alignstats.items():
-						for item in value:
-							alignstats_total[key].append(item)
+	unique_bam_list = list()
+	alignstats_total = defaultdict(list)
+	with open(out_dir + "mapping_stats.txt","a") as stats_out:
+		for (fq, group), (unique_bam, librarySize, alignstats, stats) in zip(samples, results):
+			if map_round == 2:
+				stats_out.write("** NEW ALIGNMENT **\n\n")
+			stats_out.write(stats)
+
+			unique_bam_list.append(unique_bam)
+			coverageData.write(unique_bam + "\t" + group + "\t" + str(librarySize) + "\n")
+
+			for key, value in alignstats.items():
+				alignstats_total[key].extend(value)
 
 	# alignstats plot and save
 	alignstats_df = pd.DataFrame.from_dict(alignstats_total)
@@ -81,100 +118,145 @@ def mainAlign(sampleData, experiment_name, genome_index_path, genome_index_name,
 
 	return(unique_bam_list, coverageData.name)
 
-def remap(fq, genome_index_path, genome_index_name, snp_index_path, \
-	snp_index_name, threads, out_dir, snp_tolerance, keep_temp, mismatches):
-# remapping of multi and unmapped reads from round 1
-
-	# generate fastq from unmaped reads
-	nomap = out_dir + fq.split("/")[-1].split(".")[0] + ".nomapping.bam"
-	nomap_bed = BedTool(nomap)
-	nomap_fastq = "".join(nomap.split(".bam")[:-1]) + ".fastq"
-	nomap_bed.bam_to_fastq(fq = nomap_fastq)
-
-	# generate fastq from multi-mapping reads
-	# first generate sam of primary alignments from multi-mappers
-	multi = out_dir + fq.split("/")[-1].split(".")[0] + ".unpaired_mult.bam"
-	cmd = "samtools view -@ " + str(threads) + " -F 0x904 -o " + out_dir + "temp_multi.bam " + multi
-	subprocess.call(cmd, shell = True)
-	multi_bed = BedTool(out_dir + "temp_multi.bam")
-	multi_fastq = "".join(multi.split(".bam")[:-1]) + ".fastq"
-	multi_bed.bam_to_fastq(fq = multi_fastq)
-	os.remove(out_dir + "temp_multi.bam")
-
-	if not keep_temp:
-		os.remove(nomap)
-		os.remove(multi)
+def writeFastq(read, fastq):
+# write read (in original orientation) to fastq, reads without base qualities are given maximum quality
+
+	seq = read.get_forward_sequence()
+	quals = read.get_forward_qualities()
+	qual = pysam.qualities_to_qualitystring(quals) if quals is not None else "I" * len(seq)
+	fastq.write("@" + read.query_name + "\n" + seq + "\n+\n" + qual + "\n")
+
+def realignmentPlan(new_mods, new_Inosines, mod_lists, Inosine_lists):
+# clusters gaining new SNPs from new mods and inosines found by generateModsTable
+# must be called before newModsParser adds these to mod_lists and Inosine_lists
+
+	affected = set()
+	for new, known in [(new_mods, mod_lists), (new_Inosines, Inosine_lists)]:
+		for l in new:
+			for cluster, positions in l.items():
+				if set(positions) - set(known.get(cluster, [])):
+					affected.add(cluster)
+
+	return(sorted(affected))
+
+def remapReads(fq, genome_index_path, genome_index_name, snp_index_path, \
+	snp_index_name, threads, out_dir, snp_tolerance, keep_temp, mismatches, remap_plan, budget = None, collapsed = False):
+# incremental remapping after new modifications are added to the SNP index (see realignmentPlan)
+# unique alignments from round 1 to clusters without new SNPs are kept, reads uniquely aligned to affected clusters and unmapped reads can only gain alignments to affected clusters
+# and are realigned to an index of only these clusters, multi-mapping reads are realigned to the full index
+# this only holds if mismatches is the same as in round 1, otherwise all reads must be realigned with mapReads (see remapStage in mimseq.py)
+# if no clusters are affected, round 1 alignments are kept as they are
+# realigned unique reads are merged with kept round 1 alignments into .unpaired_uniq.bam, round 1 unique alignments are kept as .unpaired_uniq_round1.bam
+# so that remapping can be rerun (e.g. with --resume)
+# if collapsed, reads were collapsed in round 1 and realigned reads keep their collapsed names and counts (see readDecoder.readWeight)
+# returns the same as mapReads with counts and stats of the merged alignments
+
+	# gsnap threads are only shared if a budget is given (see mapReads)
+	map_budget = budget
+	if not budget:
+		budget = ThreadBudget(threads)
+	changed_refs = set(remap_plan['changed_refs'])
+	weight = readWeight(collapsed)
+	output_prefix = outputPrefix(fq)
+	sample_name = fq.split("/")[-1]
+	unique_bam = out_dir + output_prefix + ".unpaired_uniq.bam"
+	round1_bam = out_dir + output_prefix + ".unpaired_uniq_round1.bam"
+	multi = out_dir + output_prefix + ".unpaired_mult.bam"
+	nomap = out_dir + output_prefix + ".nomapping.bam"
+	kept_bam = out_dir + output_prefix + ".unpaired_uniq_kept.bam"
+	affected_fastq = out_dir + output_prefix + "_remapAffected.fastq"
+	multi_fastq = out_dir + output_prefix + "_remap.fastq"
+
+	# merged alignments replace round 1 unique alignments, which are moved aside unless this was already done by an earlier (interrupted) remapping
+	if not os.path.isfile(round1_bam):
+		os.replace(unique_bam, round1_bam)
+		if os.path.isfile(unique_bam + ".bai"):
+			os.remove(unique_bam + ".bai")
+
+	# generate fastqs of reads to realign and bam of kept unique alignments
+	log.info("**** {} **** Realigning reads aligned to {} clusters with new modifications, and multi-mapped and unmapped reads...".format(sample_name, len(changed_refs)))
+	kept_count = 0
+	multi_count = 0
+	unmapped_count = 0
+	realign_counts = defaultdict(int)
+	with budget.reserve(1), open(affected_fastq, "w") as affected, open(multi_fastq, "w") as multi_out:
+		with pysam.AlignmentFile(round1_bam, "rb") as uniq, pysam.AlignmentFile(kept_bam, "wb", template = uniq) as kept:
+			for read in uniq.fetch(until_eof = True):
+				if read.reference_name in changed_refs:
+					writeFastq(read, affected)
+					realign_counts[affected_fastq] += 1
+				else:
+					kept.write(read)
+					kept_count += weight(read.query_name)
+		# primary alignments only from multi-mappers
+		with pysam.AlignmentFile(multi, "rb", check_sq = False) as mult:
+			for read in mult.fetch(until_eof = True):
+				if not read.flag & 0x904:
+					if changed_refs:
+						writeFastq(read, multi_out)
+						realign_counts[multi_fastq] += 1
+					else:
+						multi_count += weight(read.query_name)
+		with pysam.AlignmentFile(nomap, "rb", check_sq = False) as unmapped:
+			for read in unmapped.fetch(until_eof = True):
+				if changed_refs:
+					writeFastq(read, affected)
+					realign_counts[affected_fastq] += 1
+				else:
+					unmapped_count += weight(read.query_name)
+
+	# realign to affected clusters and full index
+	unique_count = kept_count
+	remap_bams = list()
+	realignments = list()
+	if realign_counts[affected_fastq]:
+		realignments.append((affected_fastq, remap_plan['indices'], bool(remap_plan['indices'][3])))
+	if realign_counts[multi_fastq]:
+		realignments.append((multi_fastq, (genome_index_path, genome_index_name, snp_index_path, snp_index_name), snp_tolerance))
+	for remap_fastq, indices, remap_snp_tolerance in realignments:
+		remap_bam, _, remap_stats, _ = mapReads(remap_fastq, *indices, threads, out_dir, remap_snp_tolerance, keep_temp, mismatches, False, map_budget, False, collapsed)
+		unique_count += remap_stats["Count"][0]
+		multi_count += remap_stats["Count"][1]
+		unmapped_count += remap_stats["Count"][2]
+		remap_bams.append(remap_bam)
+	os.remove(affected_fastq)
+	os.remove(multi_fastq)
 
-	if not mismatches == None:
-		mismatch_string = "--max-mismatches " + str(mismatches) + " "
-	elif mismatches == None:
-		mismatch_string = "" 
-
-	output_prefix = fq.split("/")[-1].split(".")[0] + "_remap"
-	if snp_tolerance:
- 		map_cmd = "gsnap -D " + genome_index_path + " -d " + genome_index_name + " -V " + snp_index_path + " -v " \
- 		+ snp_index_name + " -t " + str(threads) + " --split-output " + out_dir + output_prefix + \
- 		" --format=sam --genome-unk-mismatch=0 --md-lowercase-snp  --ignore-trim-in-filtering 1 --force-single-end " + mismatch_string +\
- 		nomap_fastq + " " + multi_fastq + " &>> " + out_dir + "remap_align.log"
+	# merge kept round 1 bam and remapped bams
+	if remap_bams:
+		with budget.reserve(max(1, threads // 4)) as merge_threads:
+			cmd = ["samtools", "merge", "-f", "-@", str(merge_threads), unique_bam, kept_bam] + remap_bams
+			subprocess.check_call(cmd)
+		os.remove(kept_bam)
+		if not keep_temp:
+			for remap_bam in remap_bams:
+				os.remove(remap_bam)
+				os.remove(remap_bam + ".bai")
 	else:
- 		map_cmd = "gsnap -D " + genome_index_path + " -d " + genome_index_name + " -t " + str(threads) + \
- 		" --split-output " + out_dir + output_prefix + " --format=sam --genome-unk-mismatch=0 --md-lowercase-snp --ignore-trim-in-filtering 1 --force-single-end " + mismatch_string + " " + \
- 		nomap_fastq + " " + multi_fastq + " &>> " + out_dir + "remap_align.log"
+		os.replace(kept_bam, unique_bam)
+	index_cmd = ["samtools", "index", unique_bam]
+	subprocess.check_call(index_cmd)
 
-	log.info("Realigning multi-mapped and unmapped reads to {} with updated SNP index...".format(genome_index_name))
-	subprocess.call(map_cmd, shell = True)
+	alignstats_dict, stats = mappingStats(fq, unique_count, multi_count, unmapped_count)
 
-	os.remove(multi_fastq)
-	os.remove(nomap_fastq)
-	
-	# remove transloc sam output if no reads present (often the case)
-	cmd = "samtools view -c " + out_dir + output_prefix + ".unpaired_transloc"
-	readcount = int(subprocess.check_output(cmd, shell = True))
-	if readcount == 0:
-		os.remove(out_dir + output_prefix + ".unpaired_transloc")
-
-	# write mapping stats and compress to bam - remove mutlimapping and unmapped unless keep_temp = True
-	log.info("Compressing SAM files, sorting, and computing mapping stats...")
-	with open(out_dir + "mapping_stats.txt","a") as stats_out:
-		align_pathlist = Path(out_dir).glob(output_prefix + "*")
-		for file in align_pathlist:
-			if re.search("mult",file.name) and not re.search("bam", file.name):
-				cmd = "samtools view -@ " + str(threads) + " -F 0x904 -c " + out_dir + file.name
-				multi_count = int(subprocess.check_output(cmd, shell = True))
-				if keep_temp:
-					cmd = "samtools view -@ " + str(threads) + " -bh -o " + out_dir + file.name + ".bam " + out_dir + file.name
-					subprocess.call(cmd, shell = True)
-					os.remove(out_dir + file.name)
-				else:
-					os.remove(out_dir + file.name)
-			elif re.search("uniq",file.name) and not re.search("bam", file.name):
-				cmd = "samtools view -@ " + str(threads) + " -bh " + out_dir + file.name + " | samtools sort -@ " + str(threads) + " -o " + out_dir + file.name + ".bam" + " - "
-				subprocess.call(cmd, shell = True)
-				os.remove(out_dir + file.name)
-				# merge 1st run bam and remapped bam
-				merged_bam = out_dir + fq.split("/")[-1].split(".")[0] + ".unpaired_uniq_remapMerge.bam"
-				cmd = "samtools merge " + merged_bam + " " + out_dir + file.name + ".bam " + out_dir + fq.split("/")[-1].split(".")[0] + ".unpaired_uniq.bam"
-				subprocess.call(cmd, shell = True) 
-				#os.remove(out_dir + file.name + ".bam")  
-				cmd = "samtools view -@ " + str(threads) + " -c " + merged_bam
-				unique_count = int(subprocess.check_output(cmd, shell = True))
-				unique_bam = merged_bam
-
-			elif re.search("nomapping",file.name) and not re.search("bam", file.name):
-				cmd = "samtools view -@ " + str(threads) + " -c " + out_dir + file.name
-				unmapped_count = int(subprocess.check_output(cmd, shell = True))
-				if keep_temp:
-					cmd = "samtools view -@ " + str(threads) + " -bh -o " + out_dir + file.name + ".bam " + out_dir + file.name
-					subprocess.call(cmd, shell = True)
-					os.remove(out_dir + file.name)
-				else:
-					os.remove(out_dir + file.name)
+	return(unique_bam, unique_count, alignstats_dict, stats)
+
+def outputPrefix(fq):
+# prefix of alignment outputs for fastq file
+
+	if re.search(".gz",fq):
+		return(fq.split("/")[-1].split(".fastq.gz")[0])
+	else:
+		return(fq.split("/")[-1].split(".fastq")[0])
 
-		total_count = unique_count + multi_count + unmapped_count
+def mappingStats(fq, unique_count, multi_count, unmapped_count):
+# alignment stats of a sample for plotting and mapping_stats.txt
 
-		stats_out.write("{}\nUniquely mapped reads: {:d} ({:.0%}) \nMulti-mapping reads: {:d} ({:.0%}) \nUnmapped reads: {:d} ({:.0%}) \nTotal: {:d}\n\n"\
-			.format(fq.split("/")[-1], unique_count, (unique_count/total_count),multi_count, (multi_count/total_count), unmapped_count, (unmapped_count/total_count), total_count))
+	total_count = unique_count + multi_count + unmapped_count
 
+	stats = "{}\nUniquely mapped reads: {:d} ({:.0%}) \nMulti-mapping reads: {:d} ({:.0%}) \nUnmapped reads: {:d} ({:.0%}) \nTotal: {:d}\n\n"\
+		.format(fq.split("/")[-1], unique_count, (unique_count/total_count),multi_count, (multi_count/total_count), unmapped_count, (unmapped_count/total_count), total_count)
+	
 	alignstats_dict = defaultdict(list)
 	type_list = ["Uniquely mapped", "Multi-mapped", "Unmapped"]
 	for i, count in enumerate([unique_count, multi_count, unmapped_count]):
@@ -182,86 +264,142 @@ def remap(fq, genome_index_path, genome_index_name, snp_index_path, \
 		alignstats_dict["Type"].append(type_list[i])
 		alignstats_dict["Count"].append(count)
 
-	return(unique_bam, unique_count, alignstats_dict)
+	return(alignstats_dict, stats)
+
+def bamWriter(bam_file, template, threads, sort = False):
+# write alignments from pysam as uncompressed BAM to a samtools process compressing to bam_file at fast compression (level 1) or sorting into bam_file
+# returns samtools process and pysam writer, see closeWriter
+
+	if sort:
+		cmd = ["samtools", "sort", "-@", str(threads), "-o", bam_file, "-"]
+	else:
+		cmd = ["samtools", "view", "-@", str(threads), "-b", "-1", "-o", bam_file, "-"]
+	process = subprocess.Popen(cmd, stdin = subprocess.PIPE)
+	writer = pysam.AlignmentFile(process.stdin, "wbu", template = template)
+
+	return(process, writer)
+
+def closeWriter(process, writer):
+
+	writer.close()
+	process.stdin.close()
+	if not process.wait() == 0:
+		raise subprocess.CalledProcessError(process.returncode, process.args)
 
 def mapReads(fq, genome_index_path, genome_index_name, snp_index_path, snp_index_name, threads, \
-	out_dir,snp_tolerance, keep_temp, mismatches, remap):
+	out_dir,snp_tolerance, keep_temp, mismatches, remap, budget = None, collapse_reads = False, collapsed = False):
 # map with or without SNP index and report initial map statistics
+# if collapse_reads, identical reads are collapsed before alignment and counted with their multiplicity (see fastqCollapse and readDecoder.readWeight)
+# collapsed is True if reads in fq were already collapsed (i.e. reads realigned by remapReads) so that they are counted with their multiplicity without collapsing again
+# GSNAP SAM output is streamed and routed by output type (XO tag) to BAM writers while counting reads, no SAM files are written
+# threads for gsnap and samtools are reserved from budget (shared between samples aligned concurrently)
+# returns mapping stats text so that caller can write stats of all samples in order
+
+	# when threads are shared between samples, gsnap leaves some threads for other samples
+	if budget:
+		gsnap_threads = max(1, threads - max(1, threads // 4))
+	else:
+		budget = ThreadBudget(threads)
+		gsnap_threads = threads
+
+	weight = readWeight(collapse_reads or collapsed)
 
 	# check zip status of input reads for command building
-	zipped = ''
-	if re.search(".gz",fq):
- 		zipped = '--gunzip'
- 		output_prefix = fq.split("/")[-1].split(".fastq.gz")[0]
-	else:
- 		output_prefix = fq.split("/")[-1].split(".fastq")[0]
+	zipped = '--gunzip' if re.search(".gz",fq) else ''
+	output_prefix = outputPrefix(fq)
+	sample_name = fq.split("/")[-1]
 
 	if not mismatches == None:
 		mismatch_list = ["--max-mismatches", str(mismatches)]
 	elif mismatches == None:
 		mismatch_list = ""
 
-	if snp_tolerance:
-		map_cmd = ["gsnap", zipped, "-D", genome_index_path, "-d", genome_index_name, "-V", snp_index_path, "-v", \
-		snp_index_name, "-t", str(threads), "--split-output", out_dir + output_prefix, \
-		"--format", "sam", "--genome-unk-mismatch", "0", "--md-lowercase-snp", "--ignore-trim-in-filtering", "1", fq]
-		map_cmd = list(filter(None, map_cmd))
-		map_cmd[-1:-1] = mismatch_list
-	else:
-		map_cmd = ["gsnap", zipped, "-D", genome_index_path, "-d", genome_index_name, "-t", str(threads),\
-		"--split-output", out_dir + output_prefix, "--format", "sam", "--genome-unk-mismatch", "0", "--md-lowercase-snp", "--ignore-trim-in-filtering", "1", fq]
-		map_cmd = list(filter(None, map_cmd))
-		map_cmd[-1:-1] = mismatch_list
-
-	log.info("Aligning reads to {}...".format(genome_index_name))
-	subprocess.check_call(map_cmd, stderr = open(out_dir + "align.log", "a"))
-	
-	# remove transloc sam output if no reads present (often the case)
-	readcount = int(pysam.view("-@",str(threads),"-c", out_dir + output_prefix + ".unpaired_transloc").strip())
-	if readcount == 0:
-		os.remove(out_dir + output_prefix + ".unpaired_transloc")
-
-	# write mapping stats and compress to bam - remove mutlimapping and unmapped unless keep_temp = True
-	log.info("Compressing SAM files, sorting, and computing mapping stats...")
-	with open(out_dir + "mapping_stats.txt","a") as stats_out:
-		align_pathlist = Path(out_dir).glob(output_prefix + "*")
-		for file in align_pathlist:
-			if re.search("mult",file.name) and not re.search("bam", file.name):
-				multi_count = int(pysam.view("-@",str(threads),"-F", "0x904", "-c", out_dir + file.name).strip())
-				if keep_temp or remap:
-					cmd = ["samtools", "view", "-@", str(threads), "-bh", "-o", out_dir + file.name + ".bam", out_dir + file.name]
-					subprocess.check_call(cmd)
-					os.remove(out_dir + file.name)
-				elif not keep_temp or not remap:
-					os.remove(out_dir + file.name)
-			elif re.search("uniq",file.name) and not re.search("bam", file.name):
-				unique_count = int(pysam.view("-@",str(threads),"-c", out_dir + file.name).strip())
-				unique_bam = out_dir + file.name + ".bam"
-				ps = subprocess.Popen(["samtools", "view", "-@", str(threads), "-bh", out_dir + file.name], stdout = subprocess.PIPE)
-				cmd = ["samtools", "sort", "-@", str(threads), "-o", unique_bam]
-				subprocess.check_call(cmd, stdin = ps.stdout)
-				index_cmd = ["samtools", "index", "-@", str(threads), unique_bam]
-				subprocess.check_call(index_cmd)
-				os.remove(out_dir + file.name)
-			elif re.search("nomapping",file.name) and not re.search("bam", file.name):
-				unmapped_count = int(pysam.view("-@",str(threads),"-c", out_dir + file.name).strip())
-				if keep_temp or remap:
-					cmd = ["samtools", "view", "-@", str(threads), "-bh", "-o", out_dir + file.name + ".bam", out_dir + file.name]
-					subprocess.check_call(cmd)
-					os.remove(out_dir + file.name)
-				elif not keep_temp or not remap:
-				 	os.remove(out_dir + file.name)
-
-		total_count = unique_count + multi_count + unmapped_count
-
-		stats_out.write("{}\nUniquely mapped reads: {:d} ({:.0%}) \nMulti-mapping reads: {:d} ({:.0%}) \nUnmapped reads: {:d} ({:.0%}) \nTotal: {:d}\n\n"\
-			.format(fq.split("/")[-1], unique_count, (unique_count/total_count),multi_count, (multi_count/total_count), unmapped_count, (unmapped_count/total_count), total_count))
-	
-	alignstats_dict = defaultdict(list)
-	type_list = ["Uniquely mapped", "Multi-mapped", "Unmapped"]
-	for i, count in enumerate([unique_count, multi_count, unmapped_count]):
-		alignstats_dict["Lib"].append(fq.split("/")[-1].split(".")[0])
-		alignstats_dict["Type"].append(type_list[i])
-		alignstats_dict["Count"].append(count)
-
-	return(unique_bam, unique_count, alignstats_dict)
+	# outputs of this sample, named as GSNAP --split-output files
+	unique_bam = out_dir + output_prefix + ".unpaired_uniq.bam"
+	mult_bam = out_dir + output_prefix + ".unpaired_mult.bam"
+	nomap_bam = out_dir + output_prefix + ".nomapping.bam"
+	transloc_bam = out_dir + output_prefix + ".unpaired_transloc.bam"
+
+	# align unique sequences only - collapsed fastq is written uncompressed
+	map_fq = fq
+	if collapse_reads:
+		log.info("**** {} **** Collapsing identical reads...".format(sample_name))
+		map_fq = out_dir + output_prefix + ".collapsed.fastq"
+		with budget.reserve(1):
+			collapseFastq(fq, map_fq)
+		zipped = ''
+
+	with budget.reserve(gsnap_threads, max(1, gsnap_threads // 2)) as map_threads:
+		# samtools writers share the reserved threads with gsnap: they mostly wait on gsnap while streaming so only get a quarter of the threads (possibly no extra threads)
+		# unique alignments are always written, multi-mapping and unmapped reads only if keep_temp = True or for realignment if remap (see remapReads)
+		writer_count = 3 if keep_temp or remap else 1
+		sam_threads = (map_threads // 4) // writer_count
+		gsnap_threads = max(1, map_threads - sam_threads * writer_count)
+		if snp_tolerance:
+			map_cmd = ["gsnap", zipped, "-D", genome_index_path, "-d", genome_index_name, "-V", snp_index_path, "-v", \
+			snp_index_name, "-t", str(gsnap_threads), \
+			"--format", "sam", "--genome-unk-mismatch", "0", "--md-lowercase-snp", "--ignore-trim-in-filtering", "1", map_fq]
+			map_cmd = list(filter(None, map_cmd))
+			map_cmd[-1:-1] = mismatch_list
+		else:
+			map_cmd = ["gsnap", zipped, "-D", genome_index_path, "-d", genome_index_name, "-t", str(gsnap_threads),\
+			"--format", "sam", "--genome-unk-mismatch", "0", "--md-lowercase-snp", "--ignore-trim-in-filtering", "1", map_fq]
+			map_cmd = list(filter(None, map_cmd))
+			map_cmd[-1:-1] = mismatch_list
+
+		log.info("**** {} **** Aligning reads to {} with {} threads, sorting unique alignments and computing mapping stats...".format(sample_name, genome_index_name, gsnap_threads))
+		with open(out_dir + output_prefix + ".align.log", "w") as align_log:
+			gsnap = subprocess.Popen(map_cmd, stdout = subprocess.PIPE, stderr = align_log)
+			try:
+				sam = pysam.AlignmentFile(gsnap.stdout, "r")
+			except ValueError:
+				gsnap.wait()
+				raise subprocess.CalledProcessError(gsnap.returncode, map_cmd)
+
+			# unique alignments are sorted as they are streamed
+			writers = {"UU":bamWriter(unique_bam, sam, sam_threads, sort = True)}
+			if writer_count == 3:
+				writers["UM"] = bamWriter(mult_bam, sam, sam_threads)
+				writers["NM"] = bamWriter(nomap_bam, sam, sam_threads)
+			counts = defaultdict(int)
+			for read in sam:
+				if read.has_tag("XO"):
+					output_type = read.get_tag("XO")
+				elif read.is_unmapped:
+					output_type = "NM"
+				else:
+					output_type = "UM" if read.has_tag("NH") and read.get_tag("NH") > 1 else "UU"
+				# multi-mapping reads are counted once (primary alignment)
+				if not output_type == "UM" or not read.flag & 0x904:
+					counts[output_type] += weight(read.query_name)
+				# translocations are kept if any are present (often not the case)
+				if output_type == "UT" and "UT" not in writers:
+					writers["UT"] = bamWriter(transloc_bam, sam, 0)
+				if output_type in writers:
+					writers[output_type][1].write(read)
+			sam.close()
+			if not gsnap.wait() == 0:
+				raise subprocess.CalledProcessError(gsnap.returncode, map_cmd)
+			for process, writer in writers.values():
+				closeWriter(process, writer)
+
+		index_cmd = ["samtools", "index", "-@", str(map_threads), unique_bam]
+		subprocess.check_call(index_cmd)
+		# round 1 unique alignments moved aside by an earlier remapping are outdated (see remapReads)
+		if os.path.isfile(out_dir + output_prefix + ".unpaired_uniq_round1.bam"):
+			os.remove(out_dir + output_prefix + ".unpaired_uniq_round1.bam")
+
+	if collapse_reads:
+		os.remove(map_fq)
+
+	# gsnap logs are written per sample and appended to align.log in order of completion
+	with open(out_dir + output_prefix + ".align.log", "r") as align_log, open(out_dir + "align.log", "a") as main_log:
+		shutil.copyfileobj(align_log, main_log)
+	os.remove(out_dir + output_prefix + ".align.log")
+
+	unique_count = counts["UU"]
+	multi_count = counts["UM"]
+	unmapped_count = counts["NM"]
+	alignstats_dict, stats = mappingStats(fq, unique_count, multi_count, unmapped_count)
+
+	return(unique_bam, unique_count, alignstats_dict, stats)
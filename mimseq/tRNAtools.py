@@ -10,13 +10,16 @@ from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 #from Bio.Blast.Applications import NcbiblastnCommandline
 #from Bio.Blast import NCBIXML
-import re, copy, sys, os, shutil, subprocess, logging, glob
-from pathlib import Path
+import re, copy, sys, os, shutil, subprocess, logging, hashlib
 from collections import defaultdict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from functools import partial
 import pandas as pd
 import requests
 from requests.models import HTTPError
 from .ssAlign import aligntRNA, extraCCA, tRNAclassifier, tRNAclassifier_nogaps, getAnticodon, clusterAnticodon
+from .seqCluster import readUC, alignmentIndels, greedyCluster
 
 log = logging.getLogger(__name__)
 
@@ -30,7 +33,33 @@ def dd():
 def dd_list():
 	return(defaultdict(list))
 
-def tRNAparser (gtRNAdb, tRNAscan_out, mitotRNAs, modifications_table, posttrans_mod_off, double_cca, pretrnas, local_mod):
+class SequenceIndex(object):
+# index of tRNA_dict by sequence to find all tRNAs with the same sequence without scanning tRNA_dict
+# built once tRNA_dict is final (sequences are not edited after modsToSNPIndex), members are listed in tRNA_dict order
+# sequences are compared exactly or, with ignore_case, after conversion to upper case (lower case bases occur in gtRNAdb sequences)
+
+	def __init__(self, tRNA_dict):
+
+		self.sequences = {tRNA:data['sequence'] for tRNA, data in tRNA_dict.items()}
+		self.exact = defaultdict(list)
+		self.upper = defaultdict(list)
+		for tRNA, sequence in self.sequences.items():
+			self.exact[sequence].append(tRNA)
+			self.upper[sequence.upper()].append(tRNA)
+
+	def members(self, tRNA, ignore_case = False):
+	# all tRNAs with the same sequence as tRNA (including tRNA itself)
+
+		if ignore_case:
+			return(self.upper[self.sequences[tRNA].upper()])
+		else:
+			return(self.exact[self.sequences[tRNA]])
+
+	def size(self, tRNA, ignore_case = False):
+
+		return(len(self.members(tRNA, ignore_case)))
+
+def tRNAparser (gtRNAdb, tRNAscan_out, mitotRNAs, modifications_table, posttrans_mod_off, double_cca, pretrnas, local_mod, modomics = None):
 # tRNA sequence files parser and dictionary building
 
 	# Generate modification reference table
@@ -88,8 +117,12 @@ def tRNAparser (gtRNAdb, tRNAscan_out, mitotRNAs, modifications_table, posttrans
 	# Read in and parse modomics file to contain similar headers to tRNA_dict
 	# Save in new dict
 
+	# Modomics data can be prefetched (e.g. for hashing inputs of reference cache, see refCache)
 	log.info("Processing modomics database...")
-	modomics_file, fetch = getModomics(local_mod)
+	if modomics:
+		modomics_file, fetch = modomics
+	else:
+		modomics_file, fetch = getModomics(local_mod)
 	modomics_dict, perSpecies_count = processModomics(modomics_file, fetch, species, modifications)
 
 	for s in species:
@@ -228,7 +261,87 @@ def getModomics(local_mod):
 
 	return modomics, fetch
 
-def modsToSNPIndex(gtRNAdb, tRNAscan_out, mitotRNAs, modifications_table, experiment_name, out_dir, double_cca, threads, snp_tolerance = False, cluster = False, cluster_id = 0.95, posttrans_mod_off = False, pretrnas = False, local_mod = False):
+def modomicsIndex(modomics_dict):
+# group Modomics entries by tRNA type and anticodon, keeping order of entries in modomics_dict
+
+	modomics_index = defaultdict(list)
+	for mod_id, data in modomics_dict.items():
+		modomics_index[(data['type'], data['anticodon'])].append(mod_id)
+
+	return(modomics_index)
+
+def modomicsMatches(modomics_index, modomics_dict, tRNA_type, anticodon):
+# candidate Modomics matches for a tRNA where types are the same and anticodons match
+# Modomics anticodons are used as regex patterns to match anticodons with "." to all possible matching input anticodons
+
+	match_ids = set()
+	for (mod_type, mod_anticodon), mod_ids in modomics_index.items():
+		if mod_type == tRNA_type and re.match("^" + mod_anticodon + "+$", anticodon):
+			match_ids.update(mod_ids)
+	# keep order of modomics_dict for selecting between equally good hits
+	match_ids = [mod_id for mod_id in modomics_dict.keys() if mod_id in match_ids]
+	match = {mod_id:modomics_dict[mod_id] for mod_id in match_ids}
+
+	return(match)
+
+def exactModomicsHit(sequence, match):
+# top hit is a Modomics unmodified sequence containing the full tRNA sequence without mismatches or gaps (i.e. 100% identity over the full tRNA length)
+# where several candidates contain the tRNA the shortest is taken, and then the first in Modomics order
+
+	sequence = sequence.upper()
+	tophit = ''
+	for mod_id, data in match.items():
+		if sequence in data['unmod_sequence'].upper():
+			if not tophit or len(data['unmod_sequence']) < len(match[tophit]['unmod_sequence']):
+				tophit = mod_id
+
+	return(tophit)
+
+def blastModomicsHit(seq, sequence, match, temp_dir, threads):
+# alternative to exactModomicsHit using blastn - hit with highest bitscore and 100% identity over the full tRNA length
+
+	temp_tRNAFasta = open(temp_dir + seq + ".fa","w")
+	temp_tRNAFasta.write(">" + seq + "\n" + sequence + "\n")
+	temp_tRNAFasta.close()
+
+	temp_matchFasta = open(temp_dir + "modomicsMatch.fasta","w")
+	for i in match:	
+		temp_matchFasta.write(">" + i + "\n" + match[i]['unmod_sequence'] + "\n")
+	temp_matchFasta.close()
+
+	#blast
+	blastn_cmd = ["blastn", "-query", temp_tRNAFasta.name, "-subject", temp_matchFasta.name, "-task", "blastn-short", "-out", temp_dir + "blast_temp.xml", "-outfmt", "5", "-num_threads", str(threads)]
+	subprocess.check_call(blastn_cmd, stdout = subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+	#parse XML result and store hit with highest bitscore	
+	blast_record = SearchIO.read(temp_dir + "blast_temp.xml", "blast-xml")
+	maxbit = 0
+	tophit = ''
+	for hit in blast_record:
+		for hsp in hit:
+			if (hsp.bitscore > maxbit) and (hsp.aln_span / blast_record.seq_len == 1) and (hsp.ident_num / blast_record.seq_len == 1):
+				maxbit = hsp.bitscore
+				tophit = hit.id.split(' ')[0]
+
+	return(tophit)
+
+def usearchCluster(temp_dir, cluster_id, usearch_threads, anticodon):
+# cluster sequences of one anticodon with usearch, writes clusters (.uc) and final centroids for anticodon to temp_dir
+# cluster_fast uses all cores unless limited with -threads
+
+	cluster_cmd = ["usearch", "-cluster_fast", temp_dir + anticodon + "_allseqs.fa", "-id", str(cluster_id), "-threads", str(usearch_threads), "-sizeout" ,"-centroids", temp_dir + anticodon + "_centroids.fa", "-uc", temp_dir + anticodon + "_clusters.uc"]
+	#cluster_cmd = ["usearch", "-cluster_smallmem", temp_dir + anticodon + "_allseqs.fa", "-id", str(cluster_id), "--sortedby", "other" ,"-sizeout" ,"-centroids", temp_dir + anticodon + "_centroids.fa", "-uc", temp_dir + anticodon + "_clusters.uc"]			#cluster_cmd = "usearch -cluster_fast " + temp_dir + anticodon + "_allseqs.fa -sort length -id " + str(cluster_id) + " -centroids " + temp_dir + anticodon + "_centroids.fa -uc " + temp_dir + anticodon + "_clusters.uc &> /dev/null"
+	subprocess.check_call(cluster_cmd, stdout = subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	# sort clusters by size (i.e. number of members in cluster)
+	sort_cmd = ["usearch", "-sortbysize", temp_dir + anticodon + "_centroids.fa", "-fastaout", temp_dir + anticodon + "_centroids_sort.fa"]
+	subprocess.check_call(sort_cmd, stdout = subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	# recluster based on sorted by size clusters
+	final_cluster_cmd = ["usearch", "-cluster_smallmem", temp_dir + anticodon + "_centroids_sort.fa", "-sortedby", "size", "-id", str(cluster_id), "-centroids", temp_dir + anticodon + "_centroidsFinal.fa"]
+	subprocess.check_call(final_cluster_cmd, stdout = subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+	return(anticodon)
+
+def modsToSNPIndex(gtRNAdb, tRNAscan_out, mitotRNAs, modifications_table, experiment_name, out_dir, double_cca, threads, snp_tolerance = False, cluster = False, cluster_id = 0.95, posttrans_mod_off = False, pretrnas = False, local_mod = False, modomics_blast = False, modomics = None, cluster_engine = "usearch"):
 # Builds SNP index needed for GSNAP based on modificaiton data for each tRNA and clusters tRNAs
 
 	nomatch_count = 0
@@ -240,7 +353,7 @@ def modsToSNPIndex(gtRNAdb, tRNAscan_out, mitotRNAs, modifications_table, experi
 	anticodon_list = list()
 	tRNAbed = open(out_dir + experiment_name + "_maturetRNA.bed","w")
 	# generate modomics_dict and tRNA_dict
-	tRNA_dict, modomics_dict, species = tRNAparser(gtRNAdb, tRNAscan_out, mitotRNAs, modifications_table, posttrans_mod_off, double_cca, pretrnas, local_mod)
+	tRNA_dict, modomics_dict, species = tRNAparser(gtRNAdb, tRNAscan_out, mitotRNAs, modifications_table, posttrans_mod_off, double_cca, pretrnas, local_mod, modomics)
 	temp_dir = out_dir + "/tmp/"
 
 	try:
@@ -273,40 +386,32 @@ def modsToSNPIndex(gtRNAdb, tRNAscan_out, mitotRNAs, modifications_table, experi
 		\n| Beginning SNP indexing |\
 		\n+------------------------+")	
 
+	# index Modomics entries by type and anticodon so that candidate matches are only searched once per type and anticodon (see modomicsMatches)
+	modomics_index = modomicsIndex(modomics_dict)
+	match_cache = dict()
+	tophit_cache = dict()
+
 	for seq in tRNA_dict:
 		# Initialise list of modified sites for each tRNA
 		tRNA_dict[seq]['modified'] = []
 		tRNA_dict[seq]['InosinePos'] = []
-		temp_tRNAFasta = open(temp_dir + seq + ".fa","w")
-		temp_tRNAFasta.write(">" + seq + "\n" + tRNA_dict[seq]['sequence'] + "\n")
-		temp_tRNAFasta.close()
 		tRNA_dict[seq]['anticodon'] = anticodon = re.search('.*tR(NA|X)-.*?-(.*?)-', seq).group(2)
 		if not anticodon in anticodon_list:
 			anticodon_list.append(anticodon)
 		# find initial possible matches to modomics where anticodons match and types are the same (here regex is used to match anticodons with "." in modomics to all possible matching sequences from input tRNAs)
-		match = {k:v for k,v in modomics_dict.items() if re.match("^" + v['anticodon'] + "+$", anticodon) and tRNA_dict[seq]['type'] == v['type']}
+		match_key = (tRNA_dict[seq]['type'], anticodon)
+		if not match_key in match_cache:
+			match_cache[match_key] = modomicsMatches(modomics_index, modomics_dict, tRNA_dict[seq]['type'], anticodon)
+		match = match_cache[match_key]
 		if len(match) >= 1:
-			temp_matchFasta = open(temp_dir + "modomicsMatch.fasta","w")
-			for i in match:	
-				temp_matchFasta.write(">" + i + "\n" + match[i]['unmod_sequence'] + "\n")
-			temp_matchFasta.close()
-
-			#blast
-			blastn_cmd = ["blastn", "-query", temp_tRNAFasta.name, "-subject", temp_matchFasta.name, "-task", "blastn-short", "-out", temp_dir + "blast_temp.xml", "-outfmt", "5", "-num_threads", str(threads)]
-			subprocess.check_call(blastn_cmd, stdout = subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-			#blastn_cline = NcbiblastnCommandline(query = temp_tRNAFasta.name, subject = temp_matchFasta.name, task = 'blastn-short', out = temp_dir + "blast_temp.xml", outfmt = 5)
-			#blastn_cline()
-
-			#parse XML result and store hit with highest bitscore	
-			#blast_record = NCBIXML.read(open(temp_dir + "blast_temp.xml","r"))
-			blast_record = SearchIO.read(temp_dir + "blast_temp.xml", "blast-xml")
-			maxbit = 0
-			tophit = ''
-			for hit in blast_record:
-				for hsp in hit:
-					if (hsp.bitscore > maxbit) and (hsp.aln_span / blast_record.seq_len == 1) and (hsp.ident_num / blast_record.seq_len == 1):
-						maxbit = hsp.bitscore
-						tophit = hit.id.split(' ')[0]
+			# identical tRNA sequences with the same candidates always have the same top hit
+			hit_key = match_key + (tRNA_dict[seq]['sequence'].upper(),)
+			if modomics_blast:
+				tophit = blastModomicsHit(seq, tRNA_dict[seq]['sequence'], match, temp_dir, threads)
+			elif hit_key in tophit_cache:
+				tophit = tophit_cache[hit_key]
+			else:
+				tophit = tophit_cache[hit_key] = exactModomicsHit(tRNA_dict[seq]['sequence'], match)
 			
 			# return list of all modified positions for the match as long as there is only 1, add to tRNA_dict
 			if tophit:
@@ -421,34 +526,45 @@ def modsToSNPIndex(gtRNAdb, tRNAscan_out, mitotRNAs, modifications_table, experi
 		log.info("Clustering tRNA sequences by {:.0%} similarity...".format(cluster_id))
 		# dictionary of final centroid sequences
 		final_centroids = defaultdict()
-		# get dictionary of sequences for each anticodon and write to fastas
-		for anticodon in anticodon_list:
-			seq_set = {k:{'sequence':v['sequence'],'modified':v['modified']} for k,v in tRNA_dict.items() if v['anticodon'] == anticodon}
-			with open(temp_dir + anticodon + "_allseqs.fa","w") as anticodon_seqs:
-				for sequence in seq_set:
-					anticodon_seqs.write(">" + sequence + "\n" + seq_set[sequence]['sequence'] + "\n")
-			# run usearch on each anticodon sequence fatsa to cluster
-			cluster_cmd = ["usearch", "-cluster_fast", temp_dir + anticodon + "_allseqs.fa", "-id", str(cluster_id), "-sizeout" ,"-centroids", temp_dir + anticodon + "_centroids.fa", "-uc", temp_dir + anticodon + "_clusters.uc"]
-			#cluster_cmd = ["usearch", "-cluster_smallmem", temp_dir + anticodon + "_allseqs.fa", "-id", str(cluster_id), "--sortedby", "other" ,"-sizeout" ,"-centroids", temp_dir + anticodon + "_centroids.fa", "-uc", temp_dir + anticodon + "_clusters.uc"]			#cluster_cmd = "usearch -cluster_fast " + temp_dir + anticodon + "_allseqs.fa -sort length -id " + str(cluster_id) + " -centroids " + temp_dir + anticodon + "_centroids.fa -uc " + temp_dir + anticodon + "_clusters.uc &> /dev/null"
-			subprocess.check_call(cluster_cmd, stdout = subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-			# sort clusters by size (i.e. number of members in cluster)
-			sort_cmd = ["usearch", "-sortbysize", temp_dir + anticodon + "_centroids.fa", "-fastaout", temp_dir + anticodon + "_centroids_sort.fa"]
-			subprocess.check_call(sort_cmd, stdout = subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-			# recluster based on sorted by size clusters
-			final_cluster_cmd = ["usearch", "-cluster_smallmem", temp_dir + anticodon + "_centroids_sort.fa", "-sortedby", "size", "-id", str(cluster_id), "-centroids", temp_dir + anticodon + "_centroidsFinal.fa"]
-			subprocess.check_call(final_cluster_cmd, stdout = subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-		# combine centroids files into one file
-		for filename in glob.glob(temp_dir + "*_centroidsFinal.fa"):
-			with open(filename, "r") as fileh:
-				with open(temp_dir + "all_centroids.fa", "a") as outh:
-					outh.write(fileh.read())
-		centroids = SeqIO.parse(temp_dir + "all_centroids.fa", "fasta")
-		for centroid in centroids:
-			centroid.id = centroid.id.split(";")[0]
-			final_centroids[centroid.id] = SeqRecord(Seq(str(centroid.seq).upper()), id = centroid.id) 
-
-		# read cluster files, get nonredudant set of mod positions of all members of a cluster, create snp_records for writing SNP index
-		cluster_pathlist = Path(temp_dir).glob("**/*_clusters.uc")
+		if cluster_engine == "usearch":
+			# get dictionary of sequences for each anticodon and write to fastas
+			for anticodon in anticodon_list:
+				seq_set = {k:{'sequence':v['sequence'],'modified':v['modified']} for k,v in tRNA_dict.items() if v['anticodon'] == anticodon}
+				with open(temp_dir + anticodon + "_allseqs.fa","w") as anticodon_seqs:
+					for sequence in seq_set:
+						anticodon_seqs.write(">" + sequence + "\n" + seq_set[sequence]['sequence'] + "\n")
+			# run usearch on each anticodon sequence fasta to cluster, anticodons are independent so are clustered in parallel
+			# usearch runs in subprocesses so a thread pool is sufficient, threads are divided between concurrent usearch jobs
+			processes = max(1, min(threads, len(anticodon_list)))
+			pool = ThreadPool(processes)
+			pool.map(partial(usearchCluster, temp_dir, cluster_id, max(1, threads // processes)), anticodon_list)
+			pool.close()
+			pool.join()
+			# combine centroids files into one file - in order of anticodon_list so that cluster numbering is reproducible
+			with open(temp_dir + "all_centroids.fa", "a") as outh:
+				for anticodon in anticodon_list:
+					with open(temp_dir + anticodon + "_centroidsFinal.fa", "r") as fileh:
+						outh.write(fileh.read())
+			centroids = SeqIO.parse(temp_dir + "all_centroids.fa", "fasta")
+			for centroid in centroids:
+				centroid.id = centroid.id.split(";")[0]
+				final_centroids[centroid.id] = SeqRecord(Seq(str(centroid.seq).upper()), id = centroid.id) 
+			cluster_records = [readUC(temp_dir + anticodon + "_clusters.uc") for anticodon in anticodon_list]
+
+		else:
+			# cluster each anticodon in-process (see seqCluster), records are returned directly in anticodon_list order
+			anticodon_seqs = [[(k, v['sequence']) for k,v in tRNA_dict.items() if v['anticodon'] == anticodon] for anticodon in anticodon_list]
+			pool = Pool(max(1, min(threads, len(anticodon_list))))
+			clusters = pool.map(partial(greedyCluster, cluster_id), anticodon_seqs)
+			pool.close()
+			pool.join()
+			cluster_records = list()
+			for records, centroid_names in clusters:
+				cluster_records.append(records)
+				for centroid in centroid_names:
+					final_centroids[centroid] = SeqRecord(Seq(tRNA_dict[centroid]['sequence'].upper()), id = centroid)
+
+		# read cluster records, get nonredudant set of mod positions of all members of a cluster, create snp_records for writing SNP index
 		mod_lists = defaultdict(list) # stores non-redundant sets of mismatches and mod positions for clusters
 		Inosine_lists = defaultdict(list) # stores positions of inosines for clusters
 		snp_records = list()
@@ -463,115 +579,78 @@ def modsToSNPIndex(gtRNAdb, tRNAscan_out, mitotRNAs, modifications_table, experi
 		clusterbed = open(out_dir + experiment_name + "_clusters.bed","w")
 		coverage_bed = clusterbed.name
 		clustergff = open(out_dir + experiment_name + "_tRNA.gff","w")
-		for path in cluster_pathlist:
-			with open(str(path),"r") as cluster_file:
-				for line in cluster_file:
-					line = line.strip()
-
-					# Handle cluster centroids and initialise modified positions list
-					if line.split("\t")[0] == "S":
-						cluster_num += 1
-						cluster_name = line.split("\t")[8].split(";")[0]
-						mod_lists[cluster_name] = tRNA_dict[cluster_name]["modified"]
-						Inosine_lists[cluster_name] = tRNA_dict[cluster_name]['InosinePos']
-						clusterbed.write(cluster_name + "\t0\t" + str(len(tRNA_dict[cluster_name]['sequence'])) + "\t" + cluster_name + "\t1000\t+\n" )
-						clustergff.write(cluster_name + "\ttRNAseq\texon\t1\t" + str(len(tRNA_dict[cluster_name]['sequence'])) + "\t.\t+\t0\tgene_id '" + cluster_name + "'\n")
-						cluster_dict[cluster_name].append(cluster_name)
-				
-					# Handle members of clusters
-					elif line.split("\t")[0] == "H":
-						member_name = line.split("\t")[8].split(";")[0]
-						cluster_name = line.split("\t")[9].split(";")[0]
-						compr_aln = line.split("\t")[7]
-						# if member of cluster is 100% identical (i.e. "=" in 8th column of cluster file)
-						if compr_aln == "=":
-							mod_lists[cluster_name] = list(set(mod_lists[cluster_name] + tRNA_dict[member_name]["modified"]))
-							Inosine_lists[cluster_name] = list(set(Inosine_lists[cluster_name] + tRNA_dict[member_name]["InosinePos"]))
-							cluster_dict[cluster_name].append(member_name)
-						
-						# if there are insertions or deletions in the centroid, edit member or centroid sequences to ignore these positions
-						# and edit modified positions list in order to make non-redundant positions list, similar to next else statement
-						elif re.search("[ID]", compr_aln):
-							cluster_seq = tRNA_dict[cluster_name]["sequence"]
-							member_seq = tRNA_dict[member_name]["sequence"]
-							pos = 0
-							adjust_pos_del = 0
-							adjust_pos_ins = 0
-							insertion_pos = list()
-							deletion_pos = list()
-							aln_list = re.split('(.*?[A-Z])', compr_aln)
-							aln_list = list(filter(None, aln_list))
-
-							for phrase in aln_list:
-								
-								if ("M" in phrase) and (phrase.split("M")[0] != ""):
-									pos += int(phrase.split("M")[0])
-								elif ("M" in phrase) and (phrase.split("M")[0] == ""):
-									pos += 1
-
-								if ("I" in phrase) and (phrase.split("I")[0] != ""):
-									insert_len = int(phrase.split("I")[0])
-
-									for i in range(insert_len):
-										insertion_pos.append(pos+i)
-										#pos += 1
-								elif ("I" in phrase) and (phrase.split("I")[0] == ""):
-									insertion_pos.append(pos)
-									#pos += 1
-
-								if ("D" in phrase) and (phrase.split("D")[0] != ""):
-									delete_len = int(phrase.split("D")[0])
-
-									for i in range(delete_len):
-										deletion_pos.append(pos)
-										pos += 1
-								elif ("D" in phrase) and (phrase.split("D")[0] == ""):
-									deletion_pos.append(pos)
-									pos += 1
-
+		for records in cluster_records:
+			for record_type, member_name, cluster_name, alignment in records:
+
+				# Handle cluster centroids and initialise modified positions list
+				if record_type == "S":
+					cluster_num += 1
+					mod_lists[cluster_name] = tRNA_dict[cluster_name]["modified"]
+					Inosine_lists[cluster_name] = tRNA_dict[cluster_name]['InosinePos']
+					clusterbed.write(cluster_name + "\t0\t" + str(len(tRNA_dict[cluster_name]['sequence'])) + "\t" + cluster_name + "\t1000\t+\n" )
+					clustergff.write(cluster_name + "\ttRNAseq\texon\t1\t" + str(len(tRNA_dict[cluster_name]['sequence'])) + "\t.\t+\t0\tgene_id '" + cluster_name + "'\n")
+					cluster_dict[cluster_name].append(cluster_name)
+			
+				# Handle members of clusters
+				elif record_type == "H":
+					# if member of cluster is 100% identical (i.e. "=" in 8th column of cluster file)
+					if alignment is None:
+						mod_lists[cluster_name] = list(set(mod_lists[cluster_name] + tRNA_dict[member_name]["modified"]))
+						Inosine_lists[cluster_name] = list(set(Inosine_lists[cluster_name] + tRNA_dict[member_name]["InosinePos"]))
+						cluster_dict[cluster_name].append(member_name)
+					
+					# if there are insertions or deletions in the centroid, edit member or centroid sequences to ignore these positions
+					# and edit modified positions list in order to make non-redundant positions list, similar to next else statement
+					elif any(op in "ID" for length, op in alignment):
+						cluster_seq = tRNA_dict[cluster_name]["sequence"]
+						member_seq = tRNA_dict[member_name]["sequence"]
+						adjust_pos_del = 0
+						adjust_pos_ins = 0
+						insertion_pos, deletion_pos = alignmentIndels(alignment)
+
+						for delete in deletion_pos:
+							adjust_pos_len = 0
+							for insert in insertion_pos:
+								if insert < delete:
+									adjust_pos_len -= 1
+							new_delete = delete + adjust_pos_del + adjust_pos_len
+							member_seq = member_seq[ :new_delete] + member_seq[new_delete+1: ]
+							del_dict[cluster_name][new_delete].append(member_name)
+							adjust_pos_del -= 1
+
+						for index, insert in enumerate(insertion_pos):
+							adjust_pos_len = 0
 							for delete in deletion_pos:
-								adjust_pos_len = 0
-								for insert in insertion_pos:
-									if insert < delete:
-										adjust_pos_len -= 1
-								new_delete = delete + adjust_pos_del + adjust_pos_len
-								member_seq = member_seq[ :new_delete] + member_seq[new_delete+1: ]
-								del_dict[cluster_name][new_delete].append(member_name)
-								adjust_pos_del -= 1
-
-							for index, insert in enumerate(insertion_pos):
-								adjust_pos_len = 0
-								for delete in deletion_pos:
-									if delete < insert:
-										adjust_pos_len -= 1
-								new_insert = insert + adjust_pos_len + adjust_pos_ins
-								member_seq = member_seq[ :new_insert] + cluster_seq[insert] + member_seq[new_insert: ]
-								insert_dict[cluster_name][new_insert].append(member_name)
-
-							mismatches = [i for i in range(len(member_seq)) if member_seq[i].upper() != cluster_seq[i].upper()]
-							mismatch_dict[cluster_name] = list(set(mismatch_dict[cluster_name] + mismatches))
-							for mismatch in mismatches:
-								cluster_perPos_mismatchMembers[cluster_name][mismatch].append(member_name)
-							member_mods = list(set(tRNA_dict[member_name]["modified"] + mismatches))
-							member_Inosines = tRNA_dict[member_name]["InosinePos"]
-							mod_lists[cluster_name] = list(set(mod_lists[cluster_name] + member_mods))
-							Inosine_lists[cluster_name] = list(set(Inosine_lists[cluster_name] + member_Inosines))
-							cluster_dict[cluster_name].append(member_name)
-
-						# handle members that are not exact sequence matches but have no indels either
-						# find mismatches and build non-redundant set
-						else:
-							cluster_seq = tRNA_dict[cluster_name]["sequence"]
-							member_seq = tRNA_dict[member_name]["sequence"]
-							mismatches = [i for i in range(len(member_seq)) if member_seq[i].upper() != cluster_seq[i].upper()]
-							mismatch_dict[cluster_name] = list(set(mismatch_dict[cluster_name] + mismatches))
-							for mismatch in mismatches:
-								cluster_perPos_mismatchMembers[cluster_name][mismatch].append(member_name)
-							member_mods = list(set(tRNA_dict[member_name]["modified"] + mismatches))
-							member_Inosines = tRNA_dict[member_name]["InosinePos"]
-							mod_lists[cluster_name] = list(set(mod_lists[cluster_name] + member_mods))
-							Inosine_lists[cluster_name] = list(set(Inosine_lists[cluster_name] + member_Inosines))
-							cluster_dict[cluster_name].append(member_name)
+								if delete < insert:
+									adjust_pos_len -= 1
+							new_insert = insert + adjust_pos_len + adjust_pos_ins
+							member_seq = member_seq[ :new_insert] + cluster_seq[insert] + member_seq[new_insert: ]
+							insert_dict[cluster_name][new_insert].append(member_name)
+
+						mismatches = [i for i in range(len(member_seq)) if member_seq[i].upper() != cluster_seq[i].upper()]
+						mismatch_dict[cluster_name] = list(set(mismatch_dict[cluster_name] + mismatches))
+						for mismatch in mismatches:
+							cluster_perPos_mismatchMembers[cluster_name][mismatch].append(member_name)
+						member_mods = list(set(tRNA_dict[member_name]["modified"] + mismatches))
+						member_Inosines = tRNA_dict[member_name]["InosinePos"]
+						mod_lists[cluster_name] = list(set(mod_lists[cluster_name] + member_mods))
+						Inosine_lists[cluster_name] = list(set(Inosine_lists[cluster_name] + member_Inosines))
+						cluster_dict[cluster_name].append(member_name)
+
+					# handle members that are not exact sequence matches but have no indels either
+					# find mismatches and build non-redundant set
+					else:
+						cluster_seq = tRNA_dict[cluster_name]["sequence"]
+						member_seq = tRNA_dict[member_name]["sequence"]
+						mismatches = [i for i in range(len(member_seq)) if member_seq[i].upper() != cluster_seq[i].upper()]
+						mismatch_dict[cluster_name] = list(set(mismatch_dict[cluster_name] + mismatches))
+						for mismatch in mismatches:
+							cluster_perPos_mismatchMembers[cluster_name][mismatch].append(member_name)
+						member_mods = list(set(tRNA_dict[member_name]["modified"] + mismatches))
+						member_Inosines = tRNA_dict[member_name]["InosinePos"]
+						mod_lists[cluster_name] = list(set(mod_lists[cluster_name] + member_mods))
+						Inosine_lists[cluster_name] = list(set(Inosine_lists[cluster_name] + member_Inosines))
+						cluster_dict[cluster_name].append(member_name)
 
 		clusterbed.close()
 
@@ -746,8 +825,7 @@ def additionalModsParser(input_species, out_dir):
 			additionalMods[tRNA]['species'] = species
 
 	# initialise dictionaries of structure (with and without gapped numbering) and anticodon positions to define canonical mod sites
-	tRNA_struct = tRNAclassifier()[0]
-	cons_pos_dict = tRNAclassifier()[3]
+	tRNA_struct, tRNA_ungap2canon, cons_pos_list, cons_pos_dict = tRNAclassifier()
 	tRNA_struct_nogap = tRNAclassifier_nogaps(oneBased=False)
 	cons_anticodon = getAnticodon()
 
@@ -801,10 +879,23 @@ def getModSite(cluster, cons_pos, cons_pos_dict, tRNA_struct, tRNA_struct_nogap)
 	
 	return(mod_site)
 
-def generateGSNAPIndices(species, name, out_dir, map_round, snp_tolerance = False, cluster = False):
+def fastaHash(fasta):
+# sha256 of sequence names and sequences in fasta, independent of line wrapping and descriptions
+
+	fasta_hash = hashlib.sha256()
+	for record in SeqIO.parse(fasta, "fasta"):
+		fasta_hash.update((record.id + "\t" + str(record.seq) + "\n").encode("utf-8"))
+
+	return(fasta_hash.hexdigest())
+
+def generateGSNAPIndices(species, name, out_dir, map_round, snp_tolerance = False, cluster = False, subset = None):
 # Builds genome and snp index files required by GSNAP
+# if subset is given, indices are built for only these clusters (i.e. those with new SNPs for realignment after remap, see tRNAmap.remapReads)
+
+	if subset is not None:
+		log.info("Generating GSNAP indices for {} clusters with new modifications...".format(len(subset)))
 
-	if map_round == 1:
+	elif map_round == 1:
 		log.info("\n+--------------------------+ \
 		 \n| Generating GSNAP indices |\
 		 \n+--------------------------+")
@@ -814,24 +905,49 @@ def generateGSNAPIndices(species, name, out_dir, map_round, snp_tolerance = Fals
 		\n| Regenerating GSNAP indices |\
 		\n+----------------------------+")
 
-	genome_index_path = out_dir + species + "_tRNAgenome"
+	index_suffix = "_remap" if subset is not None else ""
+	genome_index_path = out_dir + species + index_suffix + "_tRNAgenome"
 	genome_index_name = genome_index_path.split("/")[-1]
 	
-	try:
-		os.mkdir(genome_index_path)
-	except FileExistsError:
-		log.warning("Genome index folder found! Rebuilding index anyway...")
-	
 	if cluster:
 		genome_file = out_dir + name + "_clusterTranscripts.fa"
 	else:
 		genome_file = out_dir + name + "_tRNATranscripts.fa"
+	snp_file = out_dir + name + "_modificationSNPs.txt"
+
+	# write transcripts and SNPs of subset only
+	if subset is not None:
+		subset = set(subset)
+		subset_file = out_dir + name + "_remapTranscripts.fa"
+		SeqIO.write((record for record in SeqIO.parse(genome_file, "fasta") if record.id in subset), subset_file, "fasta")
+		genome_file = subset_file
+		subset_snps = 0
+		with open(snp_file, "r") as snps, open(out_dir + name + "_remap_modificationSNPs.txt", "w") as subset_snp_file:
+			for line in snps:
+				if line.split()[1].rsplit(":", 1)[0] in subset:
+					subset_snp_file.write(line)
+					subset_snps += 1
+		snp_file = subset_snp_file.name
+		snp_tolerance = snp_tolerance and subset_snps > 0
+
+	# genome index is only rebuilt if transcript sequences changed (newModsParser rewrites them unchanged before round 2, so only SNP index is rebuilt)
+	# hash of sequences in genome_file is saved in index folder after building
+	genome_hash = fastaHash(genome_file)
+	hash_file = genome_index_path + "/" + genome_index_name + ".fasta.sha256"
+	if os.path.isfile(hash_file) and open(hash_file, "r").read().strip() == genome_hash:
+		log.info("Transcript sequences unchanged, reusing genome index...")
+	else:
+		try:
+			os.mkdir(genome_index_path)
+		except FileExistsError:
+			log.warning("Genome index folder found! Rebuilding index anyway...")
+		index_cmd = ["gmap_build", "-q", "1", "-D", out_dir, "-d", genome_index_name, genome_file]
+		subprocess.check_call(index_cmd, stderr = open(out_dir + "genomeindex.log", "w"), stdout = subprocess.DEVNULL) 
+		with open(hash_file, "w") as genome_hash_file:
+			genome_hash_file.write(genome_hash + "\n")
+		log.info("Genome indices done...")
 
-	index_cmd = ["gmap_build", "-q", "1", "-D", out_dir, "-d", species + "_tRNAgenome", genome_file]
-	subprocess.check_call(index_cmd, stderr = open(out_dir + "genomeindex.log", "w"), stdout = subprocess.DEVNULL) 
-	log.info("Genome indices done...")
-
-	snp_index_path = out_dir + species + "snp_index"
+	snp_index_path = out_dir + species + index_suffix + "snp_index"
 
 	if snp_tolerance:
 
@@ -840,14 +956,12 @@ def generateGSNAPIndices(species, name, out_dir, map_round, snp_tolerance = Fals
 		except FileExistsError:
 			log.warning("SNP index folder found! Rebuilding index anyway...")
 
-		snp_file = out_dir + name + "_modificationSNPs.txt"
 		snp_index_name = snp_file.split("/")[-1]. split(".txt")[0]
 		ps = subprocess.Popen(('cat', snp_file), stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
 		index_cmd = ["iit_store", "-o", snp_index_path + "/" + snp_index_name]
 		subprocess.check_call(index_cmd, stdin = ps.stdout, stdout = open(out_dir + "snpindex.log", "w"), stderr = subprocess.DEVNULL)
-		index_cmd = ["snpindex", "-q", "1", "-D", genome_index_path, "-d", species + "_tRNAgenome", "-V", snp_index_path, \
-					"-v", name + "_modificationSNPs", snp_index_path + "/" + name + \
-					"_modificationSNPs.iit"]
+		index_cmd = ["snpindex", "-q", "1", "-D", genome_index_path, "-d", genome_index_name, "-V", snp_index_path, \
+					"-v", snp_index_name, snp_index_path + "/" + snp_index_name + ".iit"]
 		subprocess.check_call(index_cmd, stderr = open(out_dir + "snpindex.log", "w"), stdout = subprocess.DEVNULL)
 		log.info("SNP indices done...")
 		return(genome_index_path, genome_index_name, snp_index_path, snp_index_name)
@@ -976,7 +1090,7 @@ def intronRemover (Intron_dict, seqIO_dict, seqIO_record, posttrans_mod_off, dou
 
 	return(seq)
 
-def countReads(input_counts, out_dir, isodecoder_sizes, clustering, tRNA_dict, clusterInfo):
+def countReads(input_counts, out_dir, isodecoder_sizes, clustering, tRNA_dict, clusterInfo, seq_index = None):
 
 	# Counts per anticodon
 	count_dict_anticodon = defaultdict(lambda: defaultdict(int))
@@ -1008,8 +1122,10 @@ def countReads(input_counts, out_dir, isodecoder_sizes, clustering, tRNA_dict, c
 
 	if not clustering:
 		new_count_isodecoder = defaultdict(lambda: defaultdict(int))
+		if not seq_index:
+			seq_index = SequenceIndex(tRNA_dict)
 		for isodecoder in isodecoder_sizes:
-			sameSeq = [tRNAs for tRNAs in tRNA_dict.keys() if tRNA_dict[tRNAs]['sequence'] == tRNA_dict[isodecoder]['sequence']]
+			sameSeq = seq_index.members(isodecoder)
 			for i in sameSeq:
 				i = "-".join(i.split("-")[:-1])
 				for lib in count_dict_isodecoder[isodecoder].keys():